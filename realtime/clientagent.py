@@ -650,6 +650,15 @@ class Client(io.NetworkHandler):
         self.handle_send_datagram(datagram)
         self.handle_disconnect()
 
+    def handle_slow_consumer(self):
+        # throw away whatever the client has not received yet so that
+        # the disconnect reason can still make it's way to them...
+        self.clear_outbound()
+
+        self.handle_send_disconnect(types.CLIENT_DISCONNECT_SLOW_CONSUMER,
+            'Channel: %d could not keep up with it\'s send queue!' % (
+                self.channel))
+
     def handle_datagram(self, di):
         try:
             message_type = di.get_uint16()
@@ -998,12 +1007,15 @@ class Client(io.NetworkHandler):
         self.handle_send_datagram(datagram)
 
     def handle_object_delete_ram(self, di):
-        do_id = di.get_uint32()
+        # the state server may delete several objects in one message,
+        # such as when an AI shard goes down...
+        while di.get_remaining_size():
+            do_id = di.get_uint64()
 
-        datagram = io.NetworkDatagram()
-        datagram.add_uint16(types.CLIENT_OBJECT_DELETE_RESP)
-        datagram.add_uint32(do_id)
-        self.handle_send_datagram(datagram)
+            datagram = io.NetworkDatagram()
+            datagram.add_uint16(types.CLIENT_OBJECT_DELETE_RESP)
+            datagram.add_uint32(do_id)
+            self.handle_send_datagram(datagram)
 
     def handle_object_update_field(self, di):
         try:
@@ -1082,6 +1094,13 @@ class ClientAgent(io.NetworkListener, io.NetworkConnector):
         io.NetworkListener.setup(self)
         io.NetworkConnector.setup(self)
 
+    def has_subscription(self, channel):
+        # our clients register their channels through their own handlers...
+        if self.get_handler_from_channel(channel):
+            return True
+
+        return io.NetworkConnector.has_subscription(self, channel)
+
     def handle_datagram(self, channel, sender, message_type, di):
         handler = self.get_handler_from_channel(channel)
 
@@ -232,7 +232,7 @@ class DatabaseManager(object):
         self.remove_file(file)
 
     def shutdown(self):
-        for file in self._files:
+        for file in self._files.values():
             self.remove_file(file)
 
 class DatabaseJSONBackend(DatabaseManager):
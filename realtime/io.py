@@ -4,14 +4,14 @@
  * Licensing information can found in 'LICENSE', which is part of this source code package.
 """
 
-import Queue
-
-from panda3d.core import QueuedConnectionManager, QueuedConnectionListener, QueuedConnectionReader, \
-    ConnectionWriter, PointerToConnection, NetAddress, NetDatagram, DatagramIterator, Filename
+import time
+import threading
+import collections
 
+from panda3d.core import NetDatagram, DatagramIterator, Filename
 from panda3d.direct import DCFile, DCPacker
 from direct.distributed.PyDatagramIterator import PyDatagramIterator
-from realtime import types
+from realtime import types, transport
 from direct.directnotify.DirectNotifyGlobal import directNotify
 
 class NetworkError(RuntimeError):
@@ -19,6 +19,8 @@ class NetworkError(RuntimeError):
     A network specific runtime error
     """
 
+MAX_HEADER_CHANNELS = 255
+
 class NetworkDatagram(NetDatagram):
     """
     A class that inherits from panda's C++ NetDatagram buffer.
@@ -32,6 +34,19 @@ class NetworkDatagram(NetDatagram):
         self.add_uint64(sender)
         self.add_uint16(message_type)
 
+    def add_multi_header(self, channels, sender, message_type):
+        if not channels or len(channels) > MAX_HEADER_CHANNELS:
+            raise NetworkError('Cannot add header for %d channels, expected 1 to %d!' % (
+                len(channels), MAX_HEADER_CHANNELS))
+
+        self.add_uint8(len(channels))
+
+        for channel in channels:
+            self.add_uint64(channel)
+
+        self.add_uint64(sender)
+        self.add_uint16(message_type)
+
     def add_control_header(self, channel, message_type):
         self.add_uint8(1)
         self.add_uint64(types.CONTROL_MESSAGE)
@@ -45,6 +60,183 @@ class NetworkDatagramIterator(PyDatagramIterator):
     to the OTP's internal cluster participants...
     """
 
+    def __init__(self, datagram, offset=0):
+        PyDatagramIterator.__init__(self, datagram, offset)
+
+        # hold on to the datagram we are iterating, so that it can be
+        # forwarded as is and so it outlives the C++ iterator...
+        self._datagram = datagram
+
+    @property
+    def datagram(self):
+        return self._datagram
+
+class NetworkBudget(object):
+    """
+    A per tick count and/or time budget for a unit of work,
+    the budget keeps track of the backlog each tick leaves behind...
+    """
+
+    notify = directNotify.newCategory('NetworkBudget')
+
+    def __init__(self, name, max_count=None, max_time=None):
+        if max_count is None:
+            max_count = config.GetInt('network-read-budget-count', 1000)
+
+        if max_time is None:
+            max_time = config.GetInt('network-read-budget-time', 10000)
+
+        self._name = name
+        self._max_count = max_count
+        self._max_time = max_time
+
+        self._deadline = 0
+
+        self._count = 0
+        self._total_count = 0
+
+        self._saturated = False
+        self._saturated_ticks = 0
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def max_count(self):
+        return self._max_count
+
+    @max_count.setter
+    def max_count(self, max_count):
+        self._max_count = max_count
+
+    @property
+    def max_time(self):
+        return self._max_time
+
+    @max_time.setter
+    def max_time(self, max_time):
+        self._max_time = max_time
+
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def total_count(self):
+        return self._total_count
+
+    @property
+    def saturated(self):
+        return self._saturated
+
+    @property
+    def saturated_ticks(self):
+        return self._saturated_ticks
+
+    @property
+    def exhausted(self):
+        if self._max_count and self._count >= self._max_count:
+            return True
+
+        # always allow at least one unit of work per tick so that
+        # a tiny time budget can never stall the work entirely...
+        if self._max_time and self._count and time.time() >= self._deadline:
+            return True
+
+        return False
+
+    def begin(self):
+        """
+        Resets the budget for a new tick
+        """
+
+        self._count = 0
+
+        if self._max_time:
+            self._deadline = time.time() + self._max_time / 1000000.0
+
+    def spend(self):
+        """
+        Spends one unit of the budget, returns False if there
+        is nothing left of the budget to spend this tick
+        """
+
+        if self.exhausted:
+            return False
+
+        self._count += 1
+        self._total_count += 1
+
+        return True
+
+    def end(self, backlog):
+        """
+        Records whether or not the tick left a backlog behind
+        """
+
+        if not backlog:
+            if self._saturated:
+                self.notify.info('%s drained it\'s backlog after %d saturated tick(s).' % (
+                    self._name, self._saturated_ticks))
+
+            self._saturated = False
+            self._saturated_ticks = 0
+            return
+
+        if not self._saturated:
+            self.notify.warning('%s exhausted it\'s budget, %d datagram(s) left in the backlog!' % (
+                self._name, backlog))
+
+        self._saturated = True
+        self._saturated_ticks += 1
+
+class NetworkReadQueue(NetworkBudget):
+    """
+    A local queue of datagrams drained from a connection reader,
+    the queue hands the datagrams back out limited by a per tick count
+    and/or time budget and keeps track of the backlog left behind...
+    """
+
+    notify = directNotify.newCategory('NetworkReadQueue')
+
+    def __init__(self, name, max_count=None, max_time=None):
+        NetworkBudget.__init__(self, name, max_count, max_time)
+
+        self._datagrams = collections.deque()
+
+    @property
+    def backlog(self):
+        return len(self._datagrams)
+
+    def push(self, datagram):
+        """
+        Places a new datagram at the end of the queue
+        """
+
+        self._datagrams.append(datagram)
+
+    def pop(self):
+        """
+        Returns the next queued datagram, or None if the queue is empty
+        or the read budget for this tick has been spent
+        """
+
+        if not self._datagrams or not self.spend():
+            return None
+
+        return self._datagrams.popleft()
+
+    def end(self):
+        """
+        Records whether or not the tick left a backlog behind
+        """
+
+        NetworkBudget.end(self, len(self._datagrams))
+
+    def clear(self):
+        self._datagrams.clear()
+
 class NetworkDatabaseInterface(object):
     notify = directNotify.newCategory('NetworkDatabaseInterface')
 
@@ -458,19 +650,37 @@ class NetworkConnector(NetworkManager):
         self._channel = channel
         self.__timeout = timeout
 
-        self.__manager = QueuedConnectionManager()
-        self.__reader = QueuedConnectionReader(self.__manager, 0)
-        self.__writer = ConnectionWriter(self.__manager, 0)
+        # the links between the cluster's components are never
+        # allowed to lose datagrams, so they are left uncapped...
+        self.__transport = transport.create_transport(capped=False)
 
         self.__socket = None
+        self.__disconnected = False
+        self.__read_queue = NetworkReadQueue(self.get_unique_name('connection-read-queue'))
+
+        self.__channels = {}
+        self.__ranges = {}
 
         self.__read_task = None
+        self.__flush_task = None
         self.__disconnect_task = None
 
     @property
     def dc_loader(self):
         return self._dc_loader
 
+    @property
+    def connected(self):
+        return self.__socket is not None and not self.__disconnected
+
+    @property
+    def connection_read_queue(self):
+        return self.__read_queue
+
+    @property
+    def connection_outbound(self):
+        return self.__transport.get_outbound(self.__socket)
+
     @property
     def channel(self):
         return self._channel
@@ -481,19 +691,30 @@ class NetworkConnector(NetworkManager):
 
     def setup(self):
         if not self.__socket:
-            self.__socket = self.__manager.open_TCP_client_connection(self.__address,
+            self.__socket = self.__transport.open_client(self.__address,
                 self.__port, self.__timeout)
 
             if not self.__socket:
                 raise NetworkError('Failed to connect TCP socket on address: <%s:%d>!' % (
                     self.__address, self.__port))
 
-            self.__reader.add_connection(self.__socket)
-            self.register_for_channel(self._channel)
+            # a new socket starts out without any of the
+            # subscriptions that were made on the old one...
+            self.__disconnected = False
+            self.__channels.clear()
+            self.__ranges.clear()
+
+            self.__transport.add_connection(self.__socket)
+
+            if self._channel:
+                self.register_for_channel(self._channel)
 
         self.__read_task = task_mgr.add(self.__read_incoming, self.get_unique_name(
             'read-incoming'), taskChain=task_chain)
 
+        self.__flush_task = task_mgr.add(self.__flush_outgoing, self.get_unique_name(
+            'flush-outgoing'), sort=10, taskChain=task_chain)
+
         self.__disconnect_task = task_mgr.add(self.__listen_disconnect, self.get_unique_name(
             'listen-disconnect'), taskChain=task_chain)
 
@@ -502,6 +723,8 @@ class NetworkConnector(NetworkManager):
         Registers our connections channel with the MessageDirector
         """
 
+        self.__channels[channel] = self.__channels.get(channel, 0) + 1
+
         datagram = NetworkDatagram()
         datagram.add_control_header(channel, types.CONTROL_SET_CHANNEL)
         self.handle_send_connection_datagram(datagram)
@@ -511,34 +734,123 @@ class NetworkConnector(NetworkManager):
         Unregisters our connections channel from the MessageDirector
         """
 
+        if self.__channels.get(channel, 0) > 1:
+            self.__channels[channel] -= 1
+        else:
+            self.__channels.pop(channel, None)
+
         datagram = NetworkDatagram()
         datagram.add_control_header(channel, types.CONTROL_REMOVE_CHANNEL)
         self.handle_send_connection_datagram(datagram)
 
+    def register_for_range(self, low, high):
+        """
+        Registers every channel from low to high inclusive with the MessageDirector
+        """
+
+        self.__ranges[(low, high)] = self.__ranges.get((low, high), 0) + 1
+
+        datagram = NetworkDatagram()
+        datagram.add_control_header(low, types.CONTROL_ADD_RANGE)
+        datagram.add_uint64(high)
+        self.handle_send_connection_datagram(datagram)
+
+    def unregister_for_range(self, low, high):
+        """
+        Unregisters a range of channels from the MessageDirector
+        """
+
+        if self.__ranges.get((low, high), 0) > 1:
+            self.__ranges[(low, high)] -= 1
+        else:
+            self.__ranges.pop((low, high), None)
+
+        datagram = NetworkDatagram()
+        datagram.add_control_header(low, types.CONTROL_REMOVE_RANGE)
+        datagram.add_uint64(high)
+        self.handle_send_connection_datagram(datagram)
+
+    def has_subscription(self, channel):
+        """
+        Returns True if our connection is subscribed to the channel
+        either directly or through one of it's ranges
+        """
+
+        if channel in self.__channels:
+            return True
+
+        for low, high in self.__ranges:
+            if low <= channel <= high:
+                return True
+
+        return False
+
     def __read_incoming(self, task):
         """
-        Polls for incoming data
+        Drains all available incoming data and handles as much
+        of it as the read budget allows for this tick
         """
 
-        if self.__reader.data_available():
+        while self.__transport.data_available():
             datagram = NetworkDatagram()
 
-            if self.__reader.get_data(datagram):
-                self.__handle_data(datagram)
+            if self.__transport.get_data(datagram) is None:
+                break
+
+            self.__read_queue.push(datagram)
+
+        self.__read_queue.begin()
+        datagram = self.__read_queue.pop()
+
+        while datagram is not None:
+            self.__handle_data(datagram)
+            datagram = self.__read_queue.pop()
+
+        self.__read_queue.end()
+
+        if self.__read_queue.backlog:
+            self.__transport.keep_awake()
 
         return task.cont
 
-    def __listen_disconnect(self, task):
+    def __flush_outgoing(self, task):
         """
-        Watches our connected socket object and determines if the stream has ended..
+        Writes out everything that was sent to our connection this tick
         """
 
-        if not self.__reader.is_connection_ok(self.__socket):
-            self.handle_disconnected()
-            return task.done
+        self.__transport.flush()
+
+        # there is nobody to evict on this side of the connection,
+        # but we do want to know when the other end falls behind...
+        while self.__transport.pressure_event_available():
+            connection, event = self.__transport.get_pressure_event()
+
+            if event == transport.PRESSURE_BLOCKED:
+                self.notify.warning('Send queue to <%s:%d> rose above the high watermark!' % (
+                    self.__address, self.__port))
 
         return task.cont
 
+    def __listen_disconnect(self, task):
+        """
+        Waits for our connected socket object to be reported as reset,
+        either by the manager or by a failed write...
+        """
+
+        # our transport only ever holds our own socket, so any
+        # connection it reports as reset must be ours...
+        while self.__transport.reset_connection_available():
+            if self.__transport.get_reset_connection() is None:
+                break
+
+            self.__disconnected = True
+
+        if not self.__disconnected:
+            return task.cont
+
+        self.handle_disconnected()
+        return task.done
+
     def __handle_data(self, datagram):
         """
         Handles incoming data from the connector
@@ -547,17 +859,69 @@ class NetworkConnector(NetworkManager):
         if not datagram.get_length():
             return
 
+        self.handle_connection_datagram(datagram)
+
+    def handle_connection_datagram(self, datagram):
+        """
+        Reads the header of a datagram received from our connection
+        and handles it for each of the channels it was sent to
+        """
+
         di = NetworkDatagramIterator(datagram)
-        code = di.get_uint8()
+        channel_count = di.get_uint8()
+
+        if channel_count == 1:
+            self.handle_datagram(di.get_uint64(), di.get_uint64(), di.get_uint16(), di)
+            return
+
+        channels = [di.get_uint64() for _ in xrange(channel_count)]
+        sender = di.get_uint64()
+        message_type = di.get_uint16()
+        offset = di.get_current_index()
 
-        self.handle_datagram(di.get_uint64(), di.get_uint64(), di.get_uint16(), di)
+        # the message director sends a multi channel datagram to us once,
+        # so handle it once for each of the channels we are subscribed to,
+        # each with it's own iterator positioned at the start of the message...
+        handled_channels = set()
+
+        for channel in channels:
+            if channel in handled_channels or not self.has_subscription(channel):
+                continue
+
+            handled_channels.add(channel)
+            self.handle_datagram(channel, sender, message_type, NetworkDatagramIterator(
+                datagram, offset))
+
+    @property
+    def copied_bytes(self):
+        return self.__transport.copied_bytes
 
     def handle_send_connection_datagram(self, datagram):
         """
         Sends a datagram to our connection
         """
 
-        self.__writer.send(datagram, self.__socket)
+        if not self.__transport.send(datagram, self.__socket):
+            self.__disconnected = True
+
+    def handle_send_connection_multi_datagram(self, channels, sender, message_type, datagram):
+        """
+        Sends the message in datagram to every one of the channels, using a
+        single multi channel header for up to MAX_HEADER_CHANNELS channels at once
+        """
+
+        channels = list(channels)
+        message = datagram.get_message()
+
+        # the message is taken from the datagram once, every chunk
+        # of channels only adds it's own header in front of it...
+        for index in xrange(0, len(channels), MAX_HEADER_CHANNELS):
+            multi_datagram = NetworkDatagram()
+            multi_datagram.add_multi_header(channels[index:index + MAX_HEADER_CHANNELS],
+                sender, message_type)
+
+            multi_datagram.append_data(message)
+            self.handle_send_connection_datagram(multi_datagram)
 
     def handle_datagram(self, channel, sender, message_type, di):
         """
@@ -569,26 +933,37 @@ class NetworkConnector(NetworkManager):
         Disconnects our client socket instance
         """
 
-        self.__manager.close_connection(self.__socket)
+        self.__transport.close_connection(self.__socket)
+        self.__disconnected = True
 
     def handle_disconnected(self):
         """
         Handles disconnection when the socket connection closes
         """
 
-        self.unregister_for_channel(self._channel)
-        self.__reader.remove_connection(self.__socket)
+        if self._channel:
+            self.unregister_for_channel(self._channel)
+
+        self.__transport.remove_connection(self.__socket)
+        self.__socket = None
 
     def shutdown(self):
         if self.__read_task:
             task_mgr.remove(self.__read_task)
 
+        if self.__flush_task:
+            task_mgr.remove(self.__flush_task)
+
         if self.__disconnect_task:
             task_mgr.remove(self.__disconnect_task)
 
         self.__read_task = None
+        self.__flush_task = None
         self.__disconnect_task = None
 
+        self.__transport.flush()
+        self.__read_queue.clear()
+
 class NetworkHandler(NetworkManager):
     notify = directNotify.newCategory('NetworkHandler')
 
@@ -599,9 +974,14 @@ class NetworkHandler(NetworkManager):
         self._connection = connection
         self._channel = channel
         self._allocated_channel = channel
+        self._registered_channels = set()
+
+        self._readable = collections.deque()
+        self._pending = False
 
-        self._readable = Queue.Queue()
-        self.__update_task = None
+        # the read and dispatch tasks may run on different task chain threads,
+        # the queue and the pending flag are only ever changed together...
+        self._pending_lock = threading.Lock()
 
     @property
     def network(self):
@@ -638,11 +1018,32 @@ class NetworkHandler(NetworkManager):
     def allocated_channel(self, allocated_channel):
         self._allocated_channel = allocated_channel
 
-    def setup(self):
-        if not self.__update_task:
-            self.__update_task = task_mgr.add(self.__update, self.get_unique_name(
-                'update-handler'), taskChain=task_chain)
+    @property
+    def registered_channels(self):
+        return self._registered_channels
+
+    @property
+    def outbound(self):
+        return self._network.get_outbound(self._connection)
+
+    @property
+    def send_blocked(self):
+        outbound = self.outbound
+        return bool(outbound and outbound.blocked)
+
+    @property
+    def pending(self):
+        return self._pending
+
+    @property
+    def backlog(self):
+        return len(self._readable)
+
+    @pending.setter
+    def pending(self, pending):
+        self._pending = pending
 
+    def setup(self):
         if self._channel:
             self.register_for_channel(self._channel)
 
@@ -651,6 +1052,12 @@ class NetworkHandler(NetworkManager):
         Registers our connections channel with the MessageDirector
         """
 
+        if channel in self._registered_channels:
+            return
+
+        self._registered_channels.add(channel)
+        self._network.add_handler_channel(self, channel)
+
         datagram = NetworkDatagram()
         datagram.add_control_header(channel, types.CONTROL_SET_CHANNEL)
         self._network.handle_send_connection_datagram(datagram)
@@ -660,6 +1067,12 @@ class NetworkHandler(NetworkManager):
         Unregisters our connections channel from the MessageDirector
         """
 
+        if channel not in self._registered_channels:
+            return
+
+        self._registered_channels.remove(channel)
+        self._network.remove_handler_channel(self, channel)
+
         datagram = NetworkDatagram()
         datagram.add_control_header(channel, types.CONTROL_REMOVE_CHANNEL)
         self._network.handle_send_connection_datagram(datagram)
@@ -674,29 +1087,54 @@ class NetworkHandler(NetworkManager):
         self._channel = channel
         self.register_for_channel(channel)
 
-    def __update(self, task):
+    def dispatch(self, quota, budget=None):
         """
-        Pops a datagram from the queue and handles it
+        Pops up to quota datagrams from the queue and handles them, while the
+        budget allows it. returns True if there are still datagrams left in the queue.
+        once the queue is empty the handler is no longer pending
         """
 
-        if self._readable.empty():
-            return task.cont
+        readable = self._readable
+        count = 0
 
-        datagram = self._readable.get_nowait()
-        di = NetworkDatagramIterator(datagram)
+        while readable and count < quota:
+            if budget is not None and not budget.spend():
+                break
 
-        if not di.get_remaining_size():
-            return task.cont
+            datagram = readable.popleft()
+            count += 1
 
-        self.handle_datagram(di)
-        return task.cont
+            di = NetworkDatagramIterator(datagram)
+
+            if not di.get_remaining_size():
+                continue
+
+            self.handle_datagram(di)
+
+        # the queue is checked again while holding the lock, so a datagram
+        # queued right now will either be seen here or queue us again...
+        with self._pending_lock:
+            if readable:
+                return True
+
+            self._pending = False
+            return False
 
     def queue(self, datagram):
         """
-        Places a new datagram in the data queue
+        Places a new datagram in the data queue and tells the network
+        that this handler has data ready to be dispatched
         """
 
-        self._readable.put_nowait(datagram)
+        with self._pending_lock:
+            self._readable.append(datagram)
+
+            if self._pending:
+                return
+
+            self._pending = True
+
+        self._network.add_ready_handler(self)
 
     def handle_send_datagram(self, datagram):
         """
@@ -705,11 +1143,46 @@ class NetworkHandler(NetworkManager):
 
         self._network.handle_send_datagram(datagram, self._connection)
 
+    def handle_send_message(self, message):
+        """
+        Sends a message that was already taken from it's datagram to our connection
+        """
+
+        self._network.handle_send_message(message, self._connection)
+
     def handle_datagram(self, di):
         """
         Handles a datagram that was pulled from the queue
         """
 
+    def handle_send_blocked(self):
+        """
+        Handles the data queued toward our connection rising above the high
+        watermark, producers should hold back until it is unblocked again
+        """
+
+    def handle_send_unblocked(self):
+        """
+        Handles the data queued toward our connection falling back below the low watermark
+        """
+
+    def handle_slow_consumer(self):
+        """
+        Handles our connection not keeping up with the data sent to it
+        """
+
+        self.notify.warning('Disconnecting slow consumer on channel: %r, %d bytes queued!' % (
+            self._channel, self.outbound.queued_bytes if self.outbound else 0))
+
+        self.handle_disconnect()
+
+    def clear_outbound(self):
+        """
+        Discards the datagrams queued toward our connection that were not yet written
+        """
+
+        self._network.clear_outbound(self._connection)
+
     def handle_disconnect(self):
         """
         Disconnects our client socket instance
@@ -731,15 +1204,12 @@ class NetworkHandler(NetworkManager):
         if self._channel:
             self.unregister_for_channel(self._channel)
 
-        if self.__update_task:
-            task_mgr.remove(self.__update_task)
-
-        self.__update_task = None
+        self._readable.clear()
 
 class NetworkListener(NetworkManager):
     notify = directNotify.newCategory('NetworkListener')
 
-    def __init__(self, address, port, handler, backlog=10000):
+    def __init__(self, address, port, handler, backlog=10000, capped=True):
         NetworkManager.__init__(self)
 
         self.__address = address
@@ -747,35 +1217,66 @@ class NetworkListener(NetworkManager):
         self.__handler = handler
         self.__backlog = backlog
 
-        self.__manager = QueuedConnectionManager()
-        self.__listener = QueuedConnectionListener(self.__manager, 0)
-        self.__reader = QueuedConnectionReader(self.__manager, 0)
-        self.__writer = ConnectionWriter(self.__manager, 0)
+        self.__transport = transport.create_transport(capped=capped)
 
         self.__socket = None
         self.__handlers = {}
+        self.__channels = {}
+        self.__read_queue = NetworkReadQueue(self.get_unique_name('read-queue'))
+
+        self.__ready_handlers = collections.deque()
+        self.__disconnects = collections.deque()
+        self.__dispatch_quota = config.GetInt('network-dispatch-quota', 32)
+        self.__dispatch_budget = NetworkBudget(self.get_unique_name('dispatch-budget'))
+        self.__send_timeout = config.GetFloat('network-send-high-watermark-timeout', 10.0)
 
         self.__listen_task = None
         self.__read_task = None
+        self.__dispatch_task = None
+        self.__flush_task = None
         self.__disconnect_task = None
 
+    @property
+    def read_queue(self):
+        return self.__read_queue
+
+    @property
+    def dispatch_quota(self):
+        return self.__dispatch_quota
+
+    @property
+    def dispatch_budget(self):
+        return self.__dispatch_budget
+
+    @property
+    def copied_bytes(self):
+        return self.__transport.copied_bytes
+
+    @dispatch_quota.setter
+    def dispatch_quota(self, dispatch_quota):
+        self.__dispatch_quota = dispatch_quota
+
     def setup(self):
         if not self.__socket:
-            self.__socket = self.__manager.open_TCP_server_rendezvous(self.__address,
+            self.__socket = self.__transport.open_server(self.__address,
                 self.__port, self.__backlog)
 
             if not self.__socket:
                 raise NetworkError('Failed to bind TCP socket on address: <%s:%d>!' % (
                     self.__address, self.__port))
 
-            self.__listener.add_connection(self.__socket)
-
         self.__listen_task = task_mgr.add(self.__listen_incoming, self.get_unique_name(
             'listen-incoming'), taskChain=task_chain)
 
         self.__read_task = task_mgr.add(self.__read_incoming, self.get_unique_name(
             'read-incoming'), taskChain=task_chain)
 
+        self.__dispatch_task = task_mgr.add(self.__dispatch_handlers, self.get_unique_name(
+            'dispatch-handlers'), taskChain=task_chain)
+
+        self.__flush_task = task_mgr.add(self.__flush_outgoing, self.get_unique_name(
+            'flush-outgoing'), sort=10, taskChain=task_chain)
+
         self.__disconnect_task = task_mgr.add(self.__listen_disconnect, self.get_unique_name(
             'listen-disconnect'), taskChain=task_chain)
 
@@ -784,40 +1285,156 @@ class NetworkListener(NetworkManager):
         Polls for incoming connections
         """
 
-        if self.__listener.new_connection_available():
-            rendezvous = PointerToConnection()
-            address = NetAddress()
-            connection = PointerToConnection()
+        while self.__transport.new_connection_available():
+            new_connection = self.__transport.get_new_connection()
 
-            if self.__listener.get_new_connection(rendezvous, address, connection):
-                self.__handle_connection(rendezvous, address, connection.p())
+            if not new_connection:
+                break
+
+            self.__handle_connection(*new_connection)
 
         return task.cont
 
     def __read_incoming(self, task):
         """
-        Polls for incoming data
+        Drains all available incoming data and handles as much
+        of it as the read budget allows for this tick
         """
 
-        if self.__reader.data_available():
+        while self.__transport.data_available():
             datagram = NetworkDatagram()
+            connection = self.__transport.get_data(datagram)
+
+            if connection is None:
+                break
+
+            self.__read_queue.push((datagram, connection))
+
+        self.__read_queue.begin()
+        item = self.__read_queue.pop()
 
-            if self.__reader.get_data(datagram):
-                self.__handle_data(datagram, datagram.get_connection())
+        while item is not None:
+            self.__handle_data(*item)
+            item = self.__read_queue.pop()
+
+        self.__read_queue.end()
+
+        if self.__read_queue.backlog:
+            self.__transport.keep_awake()
+
+        return task.cont
+
+    def __dispatch_handlers(self, task):
+        """
+        Services only the handlers that have pending data, each handler
+        handles at most the dispatch quota of datagrams per pass so that
+        one busy connection cannot starve the others, and all of them
+        together handle no more than the dispatch budget allows per tick...
+        """
+
+        ready_handlers = self.__ready_handlers
+        dispatch_budget = self.__dispatch_budget
+        dispatch_budget.begin()
+
+        for _ in xrange(len(ready_handlers)):
+            if dispatch_budget.exhausted:
+                break
+
+            handler = ready_handlers.popleft()
+
+            # the handler may have been removed after it was queued,
+            # in which case any of it's pending data is discarded...
+            if self.__handlers.get(handler.connection) is not handler:
+                handler.pending = False
+                continue
+
+            if handler.dispatch(self.__dispatch_quota, dispatch_budget):
+                ready_handlers.append(handler)
+
+        # the handlers that were not serviced keep their place in the queue,
+        # and are the first to be serviced on the next tick...
+        dispatch_budget.end(sum(handler.backlog for handler in ready_handlers) if \
+            ready_handlers else 0)
+
+        if ready_handlers:
+            self.__transport.keep_awake()
+
+        return task.cont
+
+    def __flush_outgoing(self, task):
+        """
+        Writes out everything that was sent to each connection this tick,
+        one write per connection regardless of how many datagrams it was sent
+        """
+
+        self.__transport.flush()
+
+        while self.__transport.pressure_event_available():
+            connection, event = self.__transport.get_pressure_event()
+            handler = self.__handlers.get(connection)
+
+            if not handler:
+                continue
+
+            if event == transport.PRESSURE_BLOCKED:
+                handler.handle_send_blocked()
+            elif event == transport.PRESSURE_UNBLOCKED:
+                handler.handle_send_unblocked()
+            else:
+                handler.handle_slow_consumer()
+
+        # evict the connections that have stayed above the
+        # high watermark for longer than they are allowed to...
+        if not self.__transport.capped:
+            return task.cont
+
+        now = time.time()
+
+        for connection, outbound in self.__transport.get_blocked_connections():
+            if now - outbound.blocked_time < self.__send_timeout:
+                continue
+
+            handler = self.__handlers.get(connection)
+
+            if handler:
+                handler.handle_slow_consumer()
 
         return task.cont
 
     def __listen_disconnect(self, task):
         """
-        Watches all connected socket objects and determines if the stream has ended...
+        Collects the connections reported as reset by the manager and
+        handles every queued disconnect, the cost of this scales with the
+        number of disconnects rather than the number of connections...
         """
 
-        for handler in self.__handlers.values():
-            if not self.__reader.is_connection_ok(handler.connection):
-                handler.handle_disconnected()
+        while self.__transport.reset_connection_available():
+            connection = self.__transport.get_reset_connection()
+
+            if connection is None:
+                break
+
+            self.__queue_disconnect(connection)
+
+        disconnects = self.__disconnects
+
+        while disconnects:
+            handler = self.__handlers.get(disconnects.popleft())
+
+            if not handler:
+                continue
+
+            handler.handle_disconnected()
 
         return task.cont
 
+    def __queue_disconnect(self, connection):
+        """
+        Places a connection that has ended in the disconnect queue
+        """
+
+        self.__disconnects.append(connection)
+
     def __has_handler(self, connection):
         """
         Returns True if the handler is queued else False
@@ -835,7 +1452,7 @@ class NetworkListener(NetworkManager):
 
         handler.setup()
         self.__handlers[handler.connection] = handler
-        self.__reader.add_connection(handler.connection)
+        self.__transport.add_connection(handler.connection)
 
     def __remove_handler(self, handler):
         """
@@ -846,7 +1463,7 @@ class NetworkListener(NetworkManager):
             return
 
         handler.shutdown()
-        self.__reader.remove_connection(handler.connection)
+        self.__transport.remove_connection(handler.connection)
         del self.__handlers[handler.connection]
 
     def __handle_connection(self, rendezvous, address, connection):
@@ -867,17 +1484,65 @@ class NetworkListener(NetworkManager):
 
         self.__handlers[connection].queue(datagram)
 
+    def add_ready_handler(self, handler):
+        """
+        Places a handler with pending data in the dispatch queue
+        """
+
+        self.__ready_handlers.append(handler)
+
+    def add_handler_channel(self, handler, channel):
+        """
+        Associates a channel with the handler that registered for it,
+        the first handler to register a channel keeps it until it unregisters
+        """
+
+        handlers = self.__channels.setdefault(channel, [])
+
+        if handler not in handlers:
+            handlers.append(handler)
+
+    def remove_handler_channel(self, handler, channel):
+        """
+        Removes a channel association of the handler, the channel is handed
+        on to the next handler that registered for it if there is one
+        """
+
+        handlers = self.__channels.get(channel)
+
+        if not handlers or handler not in handlers:
+            return
+
+        handlers.remove(handler)
+
+        if not handlers:
+            del self.__channels[channel]
+
     def get_handler_from_channel(self, channel):
         """
         Returns a handler instance if one is associated with that channel
         """
 
-        for connection, handler in self.__handlers.items():
+        handlers = self.__channels.get(channel)
 
-            if handler.channel == channel:
-                return handler
+        if not handlers:
+            return None
 
-        return None
+        return handlers[0]
+
+    def get_outbound(self, connection):
+        """
+        Returns the outbound buffer and write counters of a connection
+        """
+
+        return self.__transport.get_outbound(connection)
+
+    def clear_outbound(self, connection):
+        """
+        Discards the datagrams queued for a connection that were not yet written
+        """
+
+        self.__transport.clear_outbound(connection)
 
     def handle_send_datagram(self, datagram, connection):
         """
@@ -887,14 +1552,28 @@ class NetworkListener(NetworkManager):
         if not self.__has_handler(connection):
             return
 
-        self.__writer.send(datagram, connection)
+        if not self.__transport.send(datagram, connection):
+            self.__queue_disconnect(connection)
+
+    def handle_send_message(self, message, connection):
+        """
+        Sends a message that was already taken from it's datagram to a specific
+        connection, the same message can be sent to many connections this way
+        """
+
+        if not self.__has_handler(connection):
+            return
+
+        if not self.__transport.send_message(message, connection):
+            self.__queue_disconnect(connection)
 
     def handle_disconnect(self, handler):
         """
         Disconnects the handlers client socket instance
         """
 
-        self.__manager.close_connection(handler.connection)
+        self.__transport.close_connection(handler.connection)
+        self.__queue_disconnect(handler.connection)
 
     def handle_disconnected(self, handler):
         """
@@ -910,11 +1589,31 @@ class NetworkListener(NetworkManager):
         if self.__read_task:
             task_mgr.remove(self.__read_task)
 
+        if self.__dispatch_task:
+            task_mgr.remove(self.__dispatch_task)
+
+        if self.__flush_task:
+            task_mgr.remove(self.__flush_task)
+
         if self.__disconnect_task:
             task_mgr.remove(self.__disconnect_task)
 
         self.__listen_task = None
         self.__read_task = None
+        self.__dispatch_task = None
+        self.__flush_task = None
         self.__disconnect_task = None
 
-        self.__listener.remove_connection(self.__socket)
+        self.__transport.flush()
+        self.__read_queue.clear()
+        self.__ready_handlers.clear()
+        self.__disconnects.clear()
+
+        # the accepted connections would otherwise stay
+        # open until the process itself goes away...
+        for connection in self.__handlers.keys():
+            self.__transport.close_connection(connection)
+
+        self.__handlers.clear()
+        self.__channels.clear()
+        self.__transport.close_server(self.__socket)
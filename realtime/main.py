@@ -6,27 +6,53 @@
 
 import __builtin__
 import os
+import sys
+import atexit
+import signal
+import subprocess
 
-from panda3d.core import loadPrcFile
+from panda3d.core import loadPrcFile, loadPrcFileData
 
-if os.path.exists('config/general.prc'):
-    loadPrcFile('config/general.prc')
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIG_FILENAME = os.path.join(ROOT_DIRECTORY, 'config', 'general.prc')
+DC_FILENAME = os.path.join(ROOT_DIRECTORY, 'config', 'dclass', 'toon.dc')
+
+if os.path.exists(CONFIG_FILENAME):
+    loadPrcFile(CONFIG_FILENAME)
+
+# a state server shard process is started with the index
+# of the shard it runs, see: setup_state_server_shards...
+if len(sys.argv) > 2 and sys.argv[1] == '--stateserver-shard':
+    loadPrcFileData('', 'stateserver-shard-index %s' % sys.argv[2])
 
-from panda3d.direct import get_config_showbase
 from direct.directnotify.DirectNotifyGlobal import directNotify
 from direct.task.TaskManagerGlobal import taskMgr as task_mgr
 
-__builtin__.config = get_config_showbase()
+# newer panda builds no longer ship get_config_showbase...
+try:
+    from panda3d.direct import get_config_showbase
+    __builtin__.config = get_config_showbase()
+except ImportError:
+    from direct.showbase import DConfig
+    __builtin__.config = DConfig
 __builtin__.task_mgr = task_mgr
 __builtin__.task_chain = task_mgr.setupTaskChain('mainloop-taskchain',
     numThreads=4, frameSync=False)
 
+# nothing else ticks the clock without a ShowBase,
+# and the delayed tasks are scheduled against it...
+task_mgr.setupTaskChain('default', tickClock=True)
+
 from realtime import io, types, clientagent, messagedirector, \
     stateserver, database
 
 notify = directNotify.newCategory('Main')
 notify.setInfo(True)
 
+# the components that were started, in the order they were started...
+components = []
+
 def setup_component(cls, *args, **kwargs):
     notify.info('Starting component: %s...' % (
         cls.__name__))
@@ -34,17 +60,99 @@ def setup_component(cls, *args, **kwargs):
     component = cls(*args, **kwargs)
     component.setup()
 
+    components.append(component)
     return component
 
 def shutdown_component(cls):
     notify.info('Shutting down component: %s...' % (
-        cls.__name__))
+        cls.__class__.__name__))
 
     cls.shutdown()
 
+def shutdown_components():
+    """
+    Shuts down every component that was started in the reverse order, this
+    runs once however the process is stopped so the state server can
+    write out it's snapshot...
+    """
+
+    if not components:
+        return
+
+    # the network tasks must not run while their components are shut down...
+    task_mgr.stop()
+    task_mgr.mgr.stop_threads()
+
+    while components:
+        shutdown_component(components.pop())
+
+def handle_terminate(signum, frame):
+    notify.info('Received signal: %d, shutting down...' % (
+        signum))
+
+    task_mgr.stop()
+
+def setup_state_server_shards():
+    """
+    Starts a process for every state server shard after the first,
+    which is ran by this process along side the other components
+    """
+
+    processes = []
+
+    for shard_index in xrange(1, config.GetInt('stateserver-shards', 1)):
+        notify.info('Starting state server shard: %d...' % (
+            shard_index))
+
+        # the shard has to find the realtime package no matter
+        # where this process was started from...
+        processes.append(subprocess.Popen([sys.executable, '-m', 'realtime.main',
+            '--stateserver-shard', str(shard_index)], cwd=ROOT_DIRECTORY))
+
+    def shutdown_state_server_shards():
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+
+    def check_state_server_shards(task):
+        # the objects of a shard that has gone away have nobody to own
+        # them, so the cluster is stopped rather than left half working...
+        for shard_index, process in enumerate(processes, 1):
+            if process.poll() is None:
+                continue
+
+            notify.warning('State server shard: %d exited with code: %d, shutting down!' % (
+                shard_index, process.returncode))
+
+            task_mgr.stop()
+            return task.done
+
+        return task.again
+
+    atexit.register(shutdown_state_server_shards)
+
+    if processes:
+        task_mgr.doMethodLater(config.GetFloat('stateserver-shard-check-interval', 1.0),
+            check_state_server_shards, 'check-state-server-shards')
+
+    return processes
+
+def main_state_server_shard():
+    dc_loader = io.NetworkDCLoader()
+    dc_loader.read_dc_files([DC_FILENAME])
+
+    message_director_port = config.GetInt('messagedirector-port', 7100)
+
+    state_server_connect_address = config.GetString('stateserver-connect-address', '127.0.0.1')
+    state_server_connect_port = config.GetInt('stateserver-connect-port', message_director_port)
+    state_server_channel = config.GetInt('stateserver-channel', types.STATESERVER_CHANNEL)
+
+    setup_component(stateserver.StateServer, dc_loader, state_server_connect_address,
+        state_server_connect_port, state_server_channel)
+
 def main():
     dc_loader = io.NetworkDCLoader()
-    dc_loader.read_dc_files(['config/dclass/toon.dc'])
+    dc_loader.read_dc_files([DC_FILENAME])
 
     message_director_address = config.GetString('messagedirector-address', '0.0.0.0')
     message_director_port = config.GetInt('messagedirector-port', 7100)
@@ -76,6 +184,18 @@ def main():
     database_server = setup_component(database.DatabaseServer, dc_loader, database_connect_address,
         database_connect_port, database_channel)
 
+    setup_state_server_shards()
+
 if __name__ == '__main__':
-    main()
+    # the task manager stops itself on an interrupt, a terminate
+    # is how the state server shards are stopped by the first process...
+    signal.signal(signal.SIGTERM, handle_terminate)
+    atexit.register(shutdown_components)
+
+    if config.GetInt('stateserver-shard-index', 0):
+        main_state_server_shard()
+    else:
+        main()
+
     task_mgr.run()
+    shutdown_components()
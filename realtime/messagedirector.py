@@ -5,6 +5,8 @@
 """
 
 import time
+import bisect
+import collections
 
 from panda3d.core import Datagram
 from realtime import io, types
@@ -16,9 +18,28 @@ class Participant(io.NetworkHandler):
     def __init__(self, *args, **kwargs):
         io.NetworkHandler.__init__(self, *args, **kwargs)
 
+        self._downstream = False
+        self._post_remove_channels = set()
+
+    @property
+    def downstream(self):
+        """
+        True if this participant is the upstream link of another message director
+        """
+
+        return self._downstream
+
+    @property
+    def post_remove_channels(self):
+        return self._post_remove_channels
+
     def handle_datagram(self, di):
-        if di.get_uint8() == 1:
+        channel_count = di.get_uint8()
+
+        if channel_count == 1:
             self.handle_control_message(di)
+        elif channel_count > 1:
+            self.handle_multi_message(channel_count, di)
 
     def handle_control_message(self, di):
         channel = di.get_uint64()
@@ -34,13 +55,23 @@ class Participant(io.NetworkHandler):
                     self.channel = sender
 
                 self.network.interface.add_channel(self, sender)
+                self.network.message_interface.flush_pending(sender)
             elif message_type == types.CONTROL_REMOVE_CHANNEL:
-                self.network.interface.remove_channel(sender)
+                self.network.interface.remove_channel(self, sender)
 
                 # attempt to handle any pending post removes for the channel
                 # that we are removing here, this is because the client agent
                 # will send this message when a client disconnects...
                 self.handle_post_removes(sender)
+            elif message_type == types.CONTROL_ADD_RANGE:
+                # the low end of the range is sent in place of the
+                # sender channel, followed by the high end...
+                high = di.get_uint64()
+
+                self.network.interface.add_range(self, sender, high)
+                self.network.message_interface.flush_pending_range(sender, high)
+            elif message_type == types.CONTROL_REMOVE_RANGE:
+                self.network.interface.remove_range(self, sender, di.get_uint64())
             elif message_type == types.CONTROL_ADD_POST_REMOVE:
                 # check to see if the post remove message actually
                 # has post remove data...
@@ -50,95 +81,542 @@ class Participant(io.NetworkHandler):
 
                     return
 
-                self.network.interface.add_post_remove(sender, io.NetworkDatagram(
-                    Datagram(di.get_remaining_bytes())))
+                post_remove = di.get_remaining_bytes()
+                self.network.message_interface.add_copied_bytes(len(post_remove))
+
+                if self.network.interface.add_post_remove(sender, post_remove):
+                    self._post_remove_channels.add(sender)
             elif message_type == types.CONTROL_CLEAR_POST_REMOVE:
                 self.network.interface.remove_post_remove(sender)
+                self._post_remove_channels.discard(sender)
+            elif message_type == types.CONTROL_SET_DOWNSTREAM:
+                self._downstream = True
+                self.network.interface.add_downstream(self)
         else:
             self.network.message_interface.add_message(channel,
-                di.get_uint64(), di)
+                di.get_uint64(), di, source=self)
+
+    def handle_multi_message(self, channel_count, di):
+        channels = [di.get_uint64() for _ in xrange(channel_count)]
+
+        if types.CONTROL_MESSAGE in channels:
+            self.notify.warning('Cannot handle control message with %d channels!' % (
+                channel_count))
+
+            return
+
+        self.network.message_interface.add_multi_message(channels,
+            di.get_uint64(), di, source=self)
 
     def handle_post_removes(self, channel):
-        for datagram in self.network.interface.get_post_removes(channel):
-            self.handle_datagram(io.NetworkDatagramIterator(datagram))
+        self._post_remove_channels.discard(channel)
+
+        post_removes = self.network.interface.get_post_removes(channel)
+
+        if post_removes:
+            self.network.message_interface.add_post_remove_messages(post_removes, self)
 
         self.network.interface.remove_post_remove(channel)
 
     def handle_disconnected(self):
         self.handle_post_removes(self.channel)
-        self.network.interface.remove_channel(self)
+
+        # handle the post removes for every other channel we added them
+        # for, a downstream message director adds them for all of it's
+        # own participants in case it goes away without clearing them...
+        for channel in list(self._post_remove_channels):
+            self.handle_post_removes(channel)
+
+        self.network.interface.remove_participant(self)
         io.NetworkHandler.handle_disconnected(self)
 
+class ChannelRangeIndex(object):
+    """
+    A sorted boundary index of channel ranges, the boundaries split the
+    channel space into segments and each segment holds the participants
+    subscribed to every channel inside of it...
+    """
+
+    def __init__(self):
+        self._boundaries = []
+        self._segments = []
+
+    @property
+    def boundaries(self):
+        return self._boundaries
+
+    @property
+    def segments(self):
+        return self._segments
+
+    def add(self, participant, low, high):
+        start = self.__split(low)
+        end = self.__split(high + 1)
+
+        for index in xrange(start, end):
+            segment = self._segments[index]
+            segment[participant] = segment.get(participant, 0) + 1
+
+    def remove(self, participant, low, high):
+        start = self.__split(low)
+        end = self.__split(high + 1)
+
+        for index in xrange(start, end):
+            segment = self._segments[index]
+
+            if participant not in segment:
+                continue
+
+            segment[participant] -= 1
+
+            if segment[participant] <= 0:
+                del segment[participant]
+
+        # merge the segments that no longer differ from their neighbours,
+        # so that the index only grows with the number of live ranges...
+        for index in xrange(min(end, len(self._boundaries) - 1), max(start, 1) - 1, -1):
+            if self._segments[index] == self._segments[index - 1]:
+                del self._boundaries[index]
+                del self._segments[index]
+
+        if self._segments and not self._segments[0]:
+            del self._boundaries[0]
+            del self._segments[0]
+
+    def get(self, channel):
+        """
+        Returns the participants with a range containing the channel
+        """
+
+        index = bisect.bisect_right(self._boundaries, channel) - 1
+
+        if index < 0:
+            return {}
+
+        return self._segments[index]
+
+    def __split(self, channel):
+        """
+        Makes sure a segment starts at the channel and returns it's index
+        """
+
+        index = bisect.bisect_left(self._boundaries, channel)
+
+        if index < len(self._boundaries) and self._boundaries[index] == channel:
+            return index
+
+        # the new segment starts out with the same participants
+        # as the segment it was split off from...
+        segment = dict(self._segments[index - 1]) if index > 0 else {}
+
+        self._boundaries.insert(index, channel)
+        self._segments.insert(index, segment)
+
+        return index
+
 class ParticipantInterface(object):
+    """
+    Keeps track of the participants subscribed to each channel, a channel
+    may have any number of subscribers and each subscription is reference
+    counted, so it must be removed as many times as it was added...
+    """
+
     notify = directNotify.newCategory('ParticipantInterface')
 
-    def __init__(self):
+    def __init__(self, network):
+        self._network = network
+
         self._participants = {}
+        self._channels = {}
+        self._ranges = {}
+        self._range_index = ChannelRangeIndex()
+        self._downstreams = {}
         self._post_removes = {}
+        self._post_remove_sizes = {}
+
+        self._post_remove_limit = config.GetInt('messagedirector-post-remove-limit', 32)
+        self._post_remove_max_bytes = config.GetInt('messagedirector-post-remove-max-bytes', 16384)
+
+    @property
+    def network(self):
+        return self._network
 
     @property
     def participants(self):
         return self._participants
 
+    @property
+    def channels(self):
+        return self._channels
+
+    @property
+    def ranges(self):
+        return self._ranges
+
+    @property
+    def range_index(self):
+        return self._range_index
+
+    @property
+    def downstreams(self):
+        return self._downstreams
+
     @property
     def post_removes(self):
         return self._post_removes
 
+    @property
+    def post_remove_limit(self):
+        return self._post_remove_limit
+
+    @post_remove_limit.setter
+    def post_remove_limit(self, post_remove_limit):
+        self._post_remove_limit = post_remove_limit
+
+    @property
+    def post_remove_max_bytes(self):
+        return self._post_remove_max_bytes
+
+    @post_remove_max_bytes.setter
+    def post_remove_max_bytes(self, post_remove_max_bytes):
+        self._post_remove_max_bytes = post_remove_max_bytes
+
     def has_channel(self, channel):
         return channel in self._participants
 
     def add_channel(self, participant, channel):
-        if self.has_channel(channel):
-            self.notify.debug('Cannot add channel: %d, already exists!' % (
+        subscribers = self._participants.get(channel)
+
+        if subscribers is None:
+            self.notify.debug('Registered new channel: %d.' % (
                 channel))
 
+            subscribers = self._participants[channel] = {}
+
+            if self._network.upstream:
+                self._network.upstream.register_for_channel(channel)
+
+        if participant in subscribers:
+            subscribers[participant] += 1
             return
 
-        self.notify.debug('Registered new channel: %d.' % (
-            channel))
+        subscribers[participant] = 1
+        self._channels.setdefault(participant, set()).add(channel)
+        self.update_remote_channel(channel)
 
-        self._participants[channel] = participant
+    def remove_channel(self, participant, channel):
+        subscribers = self._participants.get(channel)
 
-    def remove_channel(self, channel):
-        participant = self.get_participant(channel)
+        if not subscribers or participant not in subscribers:
+            self.notify.debug('Cannot remove channel: %d, not subscribed!' % (
+                channel))
+
+            return
 
-        if not participant:
-            self.notify.debug('Cannot remove channel: %d, does not exist!' % (
+        subscribers[participant] -= 1
+
+        if subscribers[participant] > 0:
+            return
+
+        del subscribers[participant]
+        self.__discard_channel(participant, channel)
+
+        if not subscribers:
+            self.notify.debug('Unregistered an existing channel: %d.' % (
                 channel))
 
+            self.__remove_subscribers(channel)
+
+        self.update_remote_channel(channel)
+
+    def add_range(self, participant, low, high):
+        if low > high:
+            self.notify.warning('Cannot add range: %d-%d, invalid range!' % (
+                low, high))
+
             return
 
-        self.notify.debug('Unregistered an existing channel: %d.' % (
-            participant.channel))
+        self.notify.debug('Registered new range: %d-%d.' % (
+            low, high))
+
+        ranges = self._ranges.setdefault(participant, {})
+        ranges[(low, high)] = ranges.get((low, high), 0) + 1
+        self._range_index.add(participant, low, high)
+        self.__announce_range(participant, low, high, types.CONTROL_ADD_REMOTE_RANGE)
+
+        if self._network.upstream:
+            self._network.upstream.add_range(low, high)
+
+    def remove_range(self, participant, low, high):
+        ranges = self._ranges.get(participant)
 
+        if not ranges or (low, high) not in ranges:
+            self.notify.debug('Cannot remove range: %d-%d, not subscribed!' % (
+                low, high))
+
+            return
+
+        ranges[(low, high)] -= 1
+
+        if ranges[(low, high)] <= 0:
+            del ranges[(low, high)]
+
+        if not ranges:
+            del self._ranges[participant]
+
+        self._range_index.remove(participant, low, high)
+        self.__announce_range(participant, low, high, types.CONTROL_REMOVE_REMOTE_RANGE)
+
+        if self._network.upstream:
+            self._network.upstream.remove_range(low, high)
+
+    def remove_participant(self, participant):
+        """
+        Removes every subscription the participant holds, regardless
+        of how many times it has subscribed to each channel or range
+        """
+
+        self._downstreams.pop(participant, None)
+
+        for channel in self._channels.pop(participant, ()):
+            subscribers = self._participants.get(channel)
+
+            if not subscribers:
+                continue
+
+            subscribers.pop(participant, None)
+
+            if not subscribers:
+                self.__remove_subscribers(channel)
+
+            self.update_remote_channel(channel)
+
+        for (low, high), count in self._ranges.pop(participant, {}).items():
+            for _ in xrange(count):
+                self._range_index.remove(participant, low, high)
+                self.__announce_range(participant, low, high, types.CONTROL_REMOVE_REMOTE_RANGE)
+
+                if self._network.upstream:
+                    self._network.upstream.remove_range(low, high)
+
+    def add_downstream(self, participant):
+        """
+        Tells a downstream message director about every subscription held on
+        this side of it's link, it only sends us the messages for those...
+        """
+
+        if participant in self._downstreams:
+            return
+
+        self._downstreams[participant] = set()
+
+        channels = set(self._participants)
+        upstream = self._network.upstream
+
+        if upstream:
+            channels.update(upstream.remote_channels)
+
+        for channel in channels:
+            self.__update_remote_channel(participant, channel)
+
+        for source, ranges in self._ranges.items():
+            if source is participant:
+                continue
+
+            for (low, high), count in ranges.items():
+                for _ in xrange(count):
+                    self.__send_remote_range(participant, low, high, types.CONTROL_ADD_REMOTE_RANGE)
+
+        if not upstream:
+            return
+
+        for (low, high), count in upstream.remote_ranges.items():
+            for _ in xrange(count):
+                self.__send_remote_range(participant, low, high, types.CONTROL_ADD_REMOTE_RANGE)
+
+    def update_remote_channel(self, channel):
+        """
+        Tells each downstream message director whether the channel is now
+        subscribed to by anybody other than the director itself
+        """
+
+        for participant in self._downstreams:
+            self.__update_remote_channel(participant, channel)
+
+    def add_remote_range(self, low, high):
+        self.__announce_range(None, low, high, types.CONTROL_ADD_REMOTE_RANGE)
+
+    def remove_remote_range(self, low, high):
+        self.__announce_range(None, low, high, types.CONTROL_REMOVE_REMOTE_RANGE)
+
+    def __update_remote_channel(self, participant, channel):
+        subscribers = self._participants.get(channel, ())
+        upstream = self._network.upstream
+
+        remote = len(subscribers) > 1 or (subscribers and participant not in subscribers) or \
+            (upstream is not None and channel in upstream.remote_channels)
+
+        announced = self._downstreams[participant]
+
+        if bool(remote) == (channel in announced):
+            return
+
+        if remote:
+            announced.add(channel)
+            message_type = types.CONTROL_ADD_REMOTE_CHANNEL
+        else:
+            announced.discard(channel)
+            message_type = types.CONTROL_REMOVE_REMOTE_CHANNEL
+
+        datagram = io.NetworkDatagram()
+        datagram.add_control_header(channel, message_type)
+        participant.handle_send_datagram(datagram)
+
+    def __announce_range(self, source, low, high, message_type):
+        for participant in self._downstreams:
+            if participant is not source:
+                self.__send_remote_range(participant, low, high, message_type)
+
+    def __send_remote_range(self, participant, low, high, message_type):
+        datagram = io.NetworkDatagram()
+        datagram.add_control_header(low, message_type)
+        datagram.add_uint64(high)
+        participant.handle_send_datagram(datagram)
+
+    def __remove_subscribers(self, channel):
         del self._participants[channel]
 
-    def get_participant(self, channel):
-        return self._participants.get(channel)
+        if self._network.upstream:
+            self._network.upstream.unregister_for_channel(channel)
+
+    def __discard_channel(self, participant, channel):
+        channels = self._channels.get(participant)
+
+        if not channels:
+            return
+
+        channels.discard(channel)
+
+        if not channels:
+            del self._channels[participant]
+
+    def get_participants(self, channel):
+        return self._participants.get(channel, {})
+
+    def get_channels(self, participant):
+        return self._channels.get(participant, ())
+
+    def get_subscribers(self, channel):
+        """
+        Returns the participants subscribed to the channel either
+        directly or through one of their ranges
+        """
+
+        participants = self._participants.get(channel)
+        ranged = self._range_index.get(channel)
+
+        if not ranged:
+            return participants or {}
+
+        if not participants:
+            return ranged
+
+        subscribers = set(participants)
+        subscribers.update(ranged)
+        return subscribers
 
     def has_post_remove(self, channel):
         return channel in self._post_removes
 
-    def add_post_remove(self, channel, datagram):
+    def add_post_remove(self, channel, data):
+        """
+        Stores the raw bytes of a post remove message for the channel,
+        returns False if the message was not stored...
+        """
+
+        post_removes = self._post_removes.setdefault(channel, [])
+
+        # the same post remove is often added again every time a client
+        # sets up it's avatar, so there is no need to keep it twice...
+        if data in post_removes:
+            return True
+
+        if len(data) > self._post_remove_max_bytes:
+            self.notify.warning('Cannot add post remove for channel: %d, '
+                '%d bytes is larger than the limit of %d bytes!' % (
+                    channel, len(data), self._post_remove_max_bytes))
+
+            if not post_removes:
+                del self._post_removes[channel]
+
+            return False
+
+        size = self._post_remove_sizes.get(channel, 0) + len(data)
+        evicted = False
+
+        # the newest post remove describes the channel's current state
+        # best, so the oldest ones make room for it once we are full...
+        while post_removes and (len(post_removes) >= self._post_remove_limit or \
+            size > self._post_remove_max_bytes):
+
+            size -= len(post_removes.pop(0))
+            evicted = True
+
+        if evicted:
+            self.notify.warning('Evicted the oldest post removes for channel: %d, '
+                'limit of %d post removes or %d bytes reached!' % (
+                    channel, self._post_remove_limit, self._post_remove_max_bytes))
+
         self.notify.debug('Adding post remove data for channel: %d.' % (
             channel))
 
-        post_removes = self._post_removes.setdefault(channel, [])
-        post_removes.append(datagram)
+        post_removes.append(data)
+        self._post_remove_sizes[channel] = size
+
+        upstream = self._network.upstream
+
+        if not upstream:
+            return True
+
+        # our parent can only be told to clear all of a channel's
+        # post removes, so the ones we kept are sent to it again...
+        if evicted:
+            upstream.clear_post_remove(channel)
+
+            for post_remove in post_removes:
+                upstream.add_post_remove(channel, post_remove)
+        else:
+            upstream.add_post_remove(channel, data)
+
+        return True
 
     def remove_post_remove(self, channel):
         if not self.has_post_remove(channel):
             return
 
         del self._post_removes[channel]
+        self._post_remove_sizes.pop(channel, None)
+
+        if self._network.upstream:
+            self._network.upstream.clear_post_remove(channel)
 
     def get_post_removes(self, channel):
         if not self.has_post_remove(channel):
             return []
 
+        # the post removes are about to be handled here,
+        # so our parent must not handle them a second time...
+        if self._network.upstream:
+            self._network.upstream.clear_post_remove(channel)
+
+        self._post_remove_sizes.pop(channel, None)
         return self._post_removes.pop(channel)
 
 class Message(object):
+    """
+    A message waiting to be routed, the datagram is the one that was
+    received from the sender and is forwarded to it's channel unchanged...
+    """
 
     def __init__(self, timestamp, channel, sender, message_type, datagram):
         self._timestamp = timestamp
@@ -197,93 +675,607 @@ class Message(object):
         self._message_type = None
         self._datagram = None
 
+class MessageTimerWheel(object):
+    """
+    A hashed timer wheel of channels, every slot covers one resolution
+    worth of time and holds the channels with messages expiring in it...
+    """
+
+    def __init__(self, timeout, resolution):
+        self._resolution = resolution
+        self._slots = [set() for _ in xrange(int(timeout / resolution) + 2)]
+        self._tick = int(time.time() / resolution)
+
+    @property
+    def resolution(self):
+        return self._resolution
+
+    def add(self, channel, expire_time):
+        # a timer can never be placed in a slot the wheel has already
+        # passed, so expired timers land in the very next slot...
+        tick = max(int(expire_time / self._resolution), self._tick + 1)
+        self._slots[tick % len(self._slots)].add(channel)
+
+    def advance(self, now):
+        """
+        Moves the wheel forward to now and returns the channels
+        from every slot that was passed along the way
+        """
+
+        tick = int(now / self._resolution)
+        channels = set()
+
+        # the number of slots visited is bounded by the wheel size,
+        # no matter how long it has been since the last advance...
+        for current_tick in xrange(max(self._tick + 1, tick - len(self._slots) + 1), tick + 1):
+            slot = self._slots[current_tick % len(self._slots)]
+
+            if slot:
+                channels.update(slot)
+                slot.clear()
+
+        self._tick = max(self._tick, tick)
+        return channels
+
+    def clear(self):
+        for slot in self._slots:
+            slot.clear()
+
 class MessageInterface(object):
+    """
+    Routes messages to the participant of their channel, messages for
+    a channel no participant has registered yet are parked in a bounded
+    queue for that channel until it is registered or they expire...
+    """
+
+    notify = directNotify.newCategory('MessageInterface')
 
     def __init__(self, network):
         self._network = network
 
-        self._messages = []
+        self._pending = {}
         self._message_timeout = config.GetFloat('messagedirector-message-timeout', 5.0)
+        self._pending_limit = config.GetInt('messagedirector-pending-limit', 256)
+
+        self._timer_wheel = MessageTimerWheel(self._message_timeout,
+            config.GetFloat('messagedirector-pending-resolution', 0.1))
 
-        self.__send_task = None
+        self._routed_count = 0
+        self._routed_bytes = 0
+        self._copied_bytes = 0
+        self._expired_count = 0
+        self._dropped_count = 0
+
+        self.__expire_task = None
 
     @property
     def network(self):
         return self._network
 
     @property
-    def messages(self):
-        return self._messages
+    def pending(self):
+        return self._pending
 
     @property
     def message_timeout(self):
         return self._message_timeout
 
-    @message_timeout.setter
-    def message_timeout(self, message_timeout):
-        self._message_timeout = message_timeout
+    @property
+    def pending_limit(self):
+        return self._pending_limit
+
+    @pending_limit.setter
+    def pending_limit(self, pending_limit):
+        self._pending_limit = pending_limit
+
+    @property
+    def routed_count(self):
+        return self._routed_count
+
+    @property
+    def routed_bytes(self):
+        return self._routed_bytes
+
+    @property
+    def copied_bytes(self):
+        """
+        The number of payload bytes copied on the way through the director,
+        a routed message is copied once no matter how many participants it
+        is sent to, and once more by the transport for every write
+        """
+
+        return self._copied_bytes + self._network.copied_bytes
+
+    def add_copied_bytes(self, copied_bytes):
+        self._copied_bytes += copied_bytes
+
+    @property
+    def expired_count(self):
+        return self._expired_count
+
+    @property
+    def dropped_count(self):
+        return self._dropped_count
 
     def get_timestamp(self):
-        return round(time.time(), 2)
+        return time.time()
 
-    def has_message(self, message):
-        return message in self._messages
+    def has_pending(self, channel):
+        return channel in self._pending
+
+    def add_message(self, channel, sender, di, source=None):
+        # only the routing header has been read from the iterator,
+        # the datagram it was read from already holds the message
+        # exactly as it has to be sent to the channel...
+        participants = self._network.interface.get_subscribers(channel)
+
+        if participants:
+            self.route_message(participants, di.datagram, source)
+
+        # our parent only gets the messages somebody past it is listening for,
+        # or that nobody here is, since it's where those get parked...
+        upstream = self._network.upstream
+
+        if upstream:
+            if not participants or upstream.has_remote_subscriber(channel):
+                upstream.handle_send_connection_datagram(di.datagram)
+
+            return
+
+        if participants:
+            return
 
-    def add_message(self, channel, sender, di):
         message = Message(self.get_timestamp(), channel, sender, di.get_uint16(),
-            io.NetworkDatagram(Datagram(di.get_remaining_bytes())))
+            di.datagram)
 
         message.setup()
-        self._messages.append(message)
+        self.park_message(message)
+
+    def add_multi_message(self, channels, sender, di, source=None):
+        """
+        Routes a message with several channels in it's header, the message is
+        sent once to every participant subscribed to any of the channels...
+        """
+
+        interface = self._network.interface
+        upstream = self._network.upstream
+        participants = set()
+        message_type = di.get_uint16()
+        forward = False
+
+        for channel in channels:
+            subscribers = interface.get_subscribers(channel)
+
+            if subscribers:
+                participants.update(subscribers)
+                forward = forward or (upstream is not None and upstream.has_remote_subscriber(channel))
+                continue
 
-    def remove_message(self, message):
-        if not self.has_message(message):
-            return
+            if upstream:
+                forward = True
+                continue
 
-        self._messages.remove(message)
-        message.destroy()
+            message = Message(self.get_timestamp(), channel, sender, message_type,
+                di.datagram)
 
-    def setup(self):
-        self.__send_task = task_mgr.add(self.__send_messages, self._network.get_unique_name(
-            'send-messages'), taskChain=task_chain)
+            message.setup()
+            self.park_message(message)
+
+        if participants:
+            self.route_message(participants, di.datagram, source)
+
+        if forward:
+            upstream.handle_send_connection_datagram(di.datagram)
 
-    def __send_messages(self, task):
-        for message in self._messages:
+    def add_post_remove_messages(self, post_removes, source):
+        """
+        Routes the post remove messages of a channel in one pass,
+        reading only the routing header of each one of them...
+        """
 
-            if self.get_timestamp() - message.timestamp > self._message_timeout:
-                self.remove_message(message)
+        for data in post_removes:
+            datagram = io.NetworkDatagram(Datagram(data))
+            di = io.NetworkDatagramIterator(datagram)
+            channel_count = di.get_uint8()
+
+            if not channel_count:
                 continue
 
-            if not self._network.interface.has_channel(message.channel):
+            channels = [di.get_uint64() for _ in xrange(channel_count)]
+
+            # a post remove can also be a control message,
+            # which still has to go through the participant...
+            if types.CONTROL_MESSAGE in channels:
+                source.handle_datagram(io.NetworkDatagramIterator(datagram))
                 continue
 
-            participant = self._network.interface.get_participant(message.channel)
+            if channel_count == 1:
+                self.add_message(channels[0], di.get_uint64(), di, source=source)
+            else:
+                self.add_multi_message(channels, di.get_uint64(), di, source=source)
+
+    def add_upstream_message(self, channels, datagram):
+        """
+        Routes a message that came down from our parent, the parent only
+        sends us channels we subscribed to so nothing is ever parked...
+        """
+
+        interface = self._network.interface
+
+        if len(channels) == 1:
+            participants = interface.get_subscribers(channels[0])
+        else:
+            participants = set()
+
+            for channel in channels:
+                participants.update(interface.get_subscribers(channel))
 
-            if participant:
-                datagram = io.NetworkDatagram()
-                datagram.add_header(message.channel, message.sender, message.message_type)
-                datagram.append_data(message.datagram.get_message())
-                participant.handle_send_datagram(datagram)
+        if participants:
+            self.route_message(participants, datagram)
 
-            self.remove_message(message)
+    def route_message(self, participants, datagram, source=None):
+        """
+        Sends the datagram once to each of the participants, a participant
+        subscribed through more than one channel still receives it once
+        """
+
+        # a downstream message director has already delivered the message
+        # to it's own participants, it must never be sent back to it...
+        if source and source.downstream and source in participants:
+            participants = [participant for participant in participants if participant is not source]
+
+        if not participants:
+            return
+
+        # the message is taken from the datagram once, and the very same
+        # bytes are queued for every one of the participants...
+        message = datagram.get_message()
+        self._copied_bytes += len(message)
+
+        for participant in participants:
+            participant.handle_send_message(message)
+
+        self._routed_count += 1
+        self._routed_bytes += len(message) * len(participants)
+
+    def park_message(self, message):
+        """
+        Holds on to a message until it's channel is registered
+        """
+
+        pending = self._pending.get(message.channel)
+
+        if pending is None:
+            pending = self._pending[message.channel] = collections.deque()
+
+        if len(pending) >= self._pending_limit:
+            self.notify.warning('Dropping message for channel: %d, '
+                'pending limit of %d messages reached!' % (
+                    message.channel, self._pending_limit))
+
+            pending.popleft().destroy()
+            self._dropped_count += 1
+
+        pending.append(message)
+        self._timer_wheel.add(message.channel, message.timestamp + self._message_timeout)
+
+    def flush_pending(self, channel):
+        """
+        Delivers the messages that were parked for a channel
+        which has just been registered with the director
+        """
+
+        pending = self._pending.pop(channel, None)
+
+        if not pending:
+            return
+
+        participants = self._network.interface.get_subscribers(channel)
+
+        if not participants:
+            self._pending[channel] = pending
+            return
+
+        while pending:
+            message = pending.popleft()
+            self.route_message(participants, message.datagram)
+            message.destroy()
+
+    def flush_pending_range(self, low, high):
+        """
+        Delivers the messages that were parked for every channel
+        inside of a range which has just been registered
+        """
+
+        for channel in [channel for channel in self._pending if low <= channel <= high]:
+            self.flush_pending(channel)
+
+    def remove_pending(self, channel):
+        pending = self._pending.pop(channel, None)
+
+        if not pending:
+            return
+
+        for message in pending:
+            message.destroy()
+
+    def setup(self):
+        self.__expire_task = task_mgr.add(self.__expire_messages, self._network.get_unique_name(
+            'expire-messages'), taskChain=task_chain)
+
+    def __expire_messages(self, task):
+        """
+        Expires the parked messages of the channels whose
+        timer wheel slots were passed since the last tick
+        """
+
+        now = self.get_timestamp()
+
+        for channel in self._timer_wheel.advance(now):
+            pending = self._pending.get(channel)
+
+            if not pending:
+                continue
+
+            # messages are parked in the order they arrived in,
+            # so the expired ones are always at the front...
+            while pending and now - pending[0].timestamp >= self._message_timeout:
+                pending.popleft().destroy()
+                self._expired_count += 1
+
+            if not pending:
+                del self._pending[channel]
+            else:
+                self._timer_wheel.add(channel, pending[0].timestamp + self._message_timeout)
 
         return task.cont
 
     def shutdown(self):
-        if self.__send_task:
-            task_mgr.remove(self.__send_task)
+        if self.__expire_task:
+            task_mgr.remove(self.__expire_task)
+
+        self.__expire_task = None
+
+        for channel in list(self._pending):
+            self.remove_pending(channel)
+
+        self._timer_wheel.clear()
+
+class MessageDirectorUpstream(io.NetworkConnector):
+    """
+    The link from a message director to it's parent, every subscription made
+    by our participants is mirrored upstream so that the parent only sends
+    us the messages that somebody on this side is actually listening for,
+    and the parent tells us in turn which channels are subscribed past it...
+    """
+
+    notify = directNotify.newCategory('MessageDirectorUpstream')
+
+    def __init__(self, network, address, port):
+        io.NetworkConnector.__init__(self, None, address, port, None)
+
+        self._network = network
+        self._ranges = {}
+        self._remote_channels = set()
+        self._remote_ranges = {}
+        self._remote_range_index = ChannelRangeIndex()
+        self._reconnect_time = config.GetFloat('messagedirector-upstream-reconnect-time', 5.0)
+
+        self.__reconnect_task = None
+
+    @property
+    def network(self):
+        return self._network
+
+    @property
+    def ranges(self):
+        return self._ranges
+
+    @property
+    def remote_channels(self):
+        return self._remote_channels
+
+    @property
+    def remote_ranges(self):
+        return self._remote_ranges
+
+    @property
+    def reconnect_time(self):
+        return self._reconnect_time
+
+    @reconnect_time.setter
+    def reconnect_time(self, reconnect_time):
+        self._reconnect_time = reconnect_time
+
+    def setup(self):
+        try:
+            io.NetworkConnector.setup(self)
+        except io.NetworkError as e:
+            self.notify.warning('%s Routing locally until our parent is reachable.' % (
+                e))
+
+            self.handle_schedule_reconnect()
+            return
+
+        datagram = io.NetworkDatagram()
+        datagram.add_control_header(0, types.CONTROL_SET_DOWNSTREAM)
+        self.handle_send_connection_datagram(datagram)
+
+        # our parent knows nothing about a new connection, so every
+        # subscription is sent to it again from scratch...
+        self._ranges.clear()
+        self.clear_remote_subscriptions()
+        self.handle_replay_subscriptions()
+
+    def handle_schedule_reconnect(self):
+        if self.__reconnect_task:
+            return
+
+        self.__reconnect_task = task_mgr.doMethodLater(self._reconnect_time, self.__reconnect,
+            self.get_unique_name('reconnect'))
+
+    def __reconnect(self, task):
+        self.__reconnect_task = None
+
+        # the tasks of the old connection are still around...
+        io.NetworkConnector.shutdown(self)
+        self.setup()
+
+        if self.connected:
+            self.notify.info('Reconnected to our parent message director.')
+
+        return task.done
+
+    def handle_replay_subscriptions(self):
+        """
+        Sends our parent every subscription our participants currently hold
+        """
+
+        interface = self._network.interface
+
+        for channel in interface.participants:
+            self.register_for_channel(channel)
+
+        for ranges in interface.ranges.values():
+            for (low, high), count in ranges.items():
+                for _ in xrange(count):
+                    self.add_range(low, high)
+
+        for channel, post_removes in interface.post_removes.items():
+            for data in post_removes:
+                self.add_post_remove(channel, data)
+
+    def add_range(self, low, high):
+        # several of our participants may subscribe the same range,
+        # our parent only needs to know about it once...
+        self._ranges[(low, high)] = self._ranges.get((low, high), 0) + 1
+
+        if self._ranges[(low, high)] == 1:
+            self.register_for_range(low, high)
+
+    def remove_range(self, low, high):
+        if (low, high) not in self._ranges:
+            return
+
+        self._ranges[(low, high)] -= 1
+
+        if self._ranges[(low, high)] > 0:
+            return
+
+        del self._ranges[(low, high)]
+        self.unregister_for_range(low, high)
+
+    def has_remote_subscriber(self, channel):
+        """
+        Returns True if anybody past our parent is subscribed to the channel
+        """
+
+        return channel in self._remote_channels or bool(self._remote_range_index.get(channel))
+
+    def add_remote_range(self, low, high):
+        self._remote_ranges[(low, high)] = self._remote_ranges.get((low, high), 0) + 1
+        self._remote_range_index.add(self, low, high)
+        self._network.interface.add_remote_range(low, high)
+
+    def remove_remote_range(self, low, high):
+        if (low, high) not in self._remote_ranges:
+            return
+
+        self._remote_ranges[(low, high)] -= 1
+
+        if self._remote_ranges[(low, high)] <= 0:
+            del self._remote_ranges[(low, high)]
+
+        self._remote_range_index.remove(self, low, high)
+        self._network.interface.remove_remote_range(low, high)
+
+    def clear_remote_subscriptions(self):
+        """
+        Forgets everything our parent told us, it tells us again on connect
+        """
+
+        remote_channels = list(self._remote_channels)
+        self._remote_channels.clear()
+
+        for channel in remote_channels:
+            self._network.interface.update_remote_channel(channel)
+
+        for (low, high), count in self._remote_ranges.items():
+            for _ in xrange(count):
+                self.remove_remote_range(low, high)
+
+    def add_post_remove(self, channel, data):
+        datagram = io.NetworkDatagram()
+        datagram.add_control_header(channel, types.CONTROL_ADD_POST_REMOVE)
+        datagram.append_data(data)
+        self.handle_send_connection_datagram(datagram)
+
+    def clear_post_remove(self, channel):
+        datagram = io.NetworkDatagram()
+        datagram.add_control_header(channel, types.CONTROL_CLEAR_POST_REMOVE)
+        self.handle_send_connection_datagram(datagram)
+
+    def handle_connection_datagram(self, datagram):
+        di = io.NetworkDatagramIterator(datagram)
+        channels = [di.get_uint64() for _ in xrange(di.get_uint8())]
+
+        if not channels:
+            return
+
+        if channels == [types.CONTROL_MESSAGE]:
+            self.handle_control_message(di)
+            return
+
+        self._network.message_interface.add_upstream_message(channels, datagram)
+
+    def handle_control_message(self, di):
+        message_type = di.get_uint16()
+        channel = di.get_uint64()
+
+        if message_type == types.CONTROL_ADD_REMOTE_CHANNEL:
+            self._remote_channels.add(channel)
+            self._network.interface.update_remote_channel(channel)
+        elif message_type == types.CONTROL_REMOVE_REMOTE_CHANNEL:
+            self._remote_channels.discard(channel)
+            self._network.interface.update_remote_channel(channel)
+        elif message_type == types.CONTROL_ADD_REMOTE_RANGE:
+            # the low end of the range is sent in place of the
+            # channel, followed by the high end...
+            self.add_remote_range(channel, di.get_uint64())
+        elif message_type == types.CONTROL_REMOVE_REMOTE_RANGE:
+            self.remove_remote_range(channel, di.get_uint64())
+        else:
+            self.notify.warning('Received unknown control message: %d from our parent!' % (
+                message_type))
+
+    def handle_disconnected(self):
+        self.notify.warning('Lost connection to our parent message director, '
+            'routing locally until it is back!')
+
+        io.NetworkConnector.handle_disconnected(self)
+        self.clear_remote_subscriptions()
+        self.handle_schedule_reconnect()
+
+    def shutdown(self):
+        if self.__reconnect_task:
+            task_mgr.remove(self.__reconnect_task)
 
-        self.__send_task = None
+        self.__reconnect_task = None
+        io.NetworkConnector.shutdown(self)
 
 class MessageDirector(io.NetworkListener):
     notify = directNotify.newCategory('MessageDirector')
 
     def __init__(self, address, port):
-        io.NetworkListener.__init__(self, address, port, Participant)
+        io.NetworkListener.__init__(self, address, port, Participant, capped=False)
 
-        self._interface = ParticipantInterface()
+        self._interface = ParticipantInterface(self)
         self._message_interface = MessageInterface(self)
 
+        self._upstream = None
+        self._upstream_address = config.GetString('messagedirector-upstream-address', '')
+        self._upstream_port = config.GetInt('messagedirector-upstream-port', 7100)
+
     @property
     def interface(self):
         return self._interface
@@ -292,12 +1284,42 @@ class MessageDirector(io.NetworkListener):
     def message_interface(self):
         return self._message_interface
 
+    @property
+    def copied_bytes(self):
+        copied_bytes = io.NetworkListener.copied_bytes.fget(self)
+
+        if self._upstream:
+            copied_bytes += self._upstream.copied_bytes
+
+        return copied_bytes
+
+    @property
+    def upstream(self):
+        """
+        The link to our parent, or None while there is no parent to route
+        through, in which case every message is routed as if we were the root
+        """
+
+        if not self._upstream or not self._upstream.connected:
+            return None
+
+        return self._upstream
+
     def setup(self):
         self._message_interface.setup()
 
+        if self._upstream_address:
+            self._upstream = MessageDirectorUpstream(self, self._upstream_address,
+                self._upstream_port)
+
+            self._upstream.setup()
+
         io.NetworkListener.setup(self)
 
     def shutdown(self):
         self._message_interface.shutdown()
 
+        if self._upstream:
+            self._upstream.shutdown()
+
         io.NetworkListener.shutdown(self)
@@ -4,7 +4,11 @@
  * Licensing information can found in 'LICENSE', which is part of this source code package.
 """
 
+import os
+import time
+import Queue
 import random
+import threading
 
 from panda3d.direct import DCPacker
 from realtime import io, types
@@ -12,6 +16,7 @@ from game.OtpDoGlobals import *
 from direct.directnotify.DirectNotifyGlobal import directNotify
 
 class Shard(object):
+    __slots__ = ('channel', 'name', 'population')
 
     def __init__(self, channel, name, population):
         self.channel = channel
@@ -51,9 +56,63 @@ class ShardManager(object):
     def get_shards(self):
         return self._shards.values()
 
+class ShardRequest(object):
+    """
+    A request sent to every other state server shard, the objects
+    it holds wait for each one of the shards to answer it...
+    """
+
+    __slots__ = ('request_id', 'channels', 'location', 'do_ids', 'generates', 'timestamp')
+
+    def __init__(self, request_id, channels, location=None):
+        self.request_id = request_id
+        self.channels = set(channels)
+        self.location = location
+        self.do_ids = []
+        self.generates = []
+        self.timestamp = time.time()
+
+class StateObjectLayout(object):
+    """
+    The field layout shared by every object of a dclass, which
+    maps each stored field to it's slot in the object's field table
+    """
+
+    __slots__ = ('dc_class', 'field_numbers', 'field_slots', 'num_required', 'num_fields')
+
+    def __init__(self, dc_class):
+        self.dc_class = dc_class
+
+        required_numbers = []
+        other_numbers = []
+
+        # the slots are in inherited order, required fields first,
+        # so the field table can be packed in order as it is...
+        for field_index in xrange(dc_class.get_num_inherited_fields()):
+            field = dc_class.get_inherited_field(field_index)
+
+            if not field or field.as_molecular_field():
+                continue
+
+            if field.is_required():
+                required_numbers.append(field.get_number())
+            elif field.is_ram():
+                other_numbers.append(field.get_number())
+
+        self.field_numbers = tuple(required_numbers + other_numbers)
+        self.field_slots = dict((field_number, slot) for slot, field_number in enumerate(
+            self.field_numbers))
+
+        self.num_required = len(required_numbers)
+        self.num_fields = len(self.field_slots)
+
 class StateObject(object):
     notify = directNotify.newCategory('StateObject')
 
+    __slots__ = ('_network', '_do_id', '_old_owner_id', '_owner_id', '_parent_id', '_zone_id',
+        '_old_location', '_dc_class', '_has_other', '_layout', '_fields', '_required_data',
+        '_other_data', '_coalesced_updates')
+
     def __init__(self, network, do_id, parent_id, zone_id, dc_class, has_other, di):
         self._network = network
         self._do_id = do_id
@@ -61,20 +120,42 @@ class StateObject(object):
         self._old_owner_id = 0
         self._owner_id = 0
 
-        self._old_parent_id = 0
         self._parent_id = parent_id
-
-        self._old_zone_id = 0
         self._zone_id = zone_id
 
+        self._old_location = (0, 0)
+
         self._dc_class = dc_class
         self._has_other = has_other
 
-        self._required_fields = {}
-        self._other_fields = {}
+        # the fields are kept in their packed form, they are only
+        # ever unpacked when something asks for their values...
+        self._layout = self._network.get_field_layout(dc_class)
+        self._fields = [None] * self._layout.num_fields
 
+        # the packed form of the required and other fields, these are
+        # packed once and reused for every generate until a field changes...
+        self._required_data = None
+        self._other_data = None
+
+        # the latest value of each coalesced broadcast field that is
+        # waiting for the state server's next coalesce flush...
+        self._coalesced_updates = None
+
+        # objects restored from a snapshot have no required field data
+        # to read, their fields are set from the snapshot instead...
+        if di is not None:
+            self.read_required_fields(di)
+
+        # objects inside of the state server's range are already
+        # subscribed to, so they do not need a channel of their own...
+        if not self._network.has_range_channel(self._do_id):
+            self._network.register_for_channel(self._do_id)
+
+    def read_required_fields(self, di):
+        data = di.get_remaining_bytes()
         field_packer = DCPacker()
-        field_packer.set_unpack_data(di.get_remaining_bytes())
+        field_packer.set_unpack_data(data)
 
         for field_index in xrange(self._dc_class.get_num_inherited_fields()):
             field = self._dc_class.get_inherited_field(field_index)
@@ -86,13 +167,18 @@ class StateObject(object):
             if field.as_molecular_field() or not field.is_required():
                 continue
 
+            # skip over the field's data rather than unpacking it,
+            # this still validates the data against the field...
+            offset = field_packer.get_num_unpacked_bytes()
             field_packer.begin_unpack(field)
-            field_args = field.unpack_args(field_packer)
-            field_packer.end_unpack()
+            field_packer.unpack_skip()
 
-            self._required_fields[field.get_number()] = field_args
+            if not field_packer.end_unpack():
+                self.notify.error('Failed to unpack required field: %s dclass: %s, invalid data!' % (
+                    field.get_name(), self._dc_class.get_name()))
 
-        self._network.register_for_channel(self._do_id)
+            self._fields[self._layout.field_slots[field.get_number()]] = data[
+                offset:field_packer.get_num_unpacked_bytes()]
 
     @property
     def do_id(self):
@@ -111,9 +197,20 @@ class StateObject(object):
         self._old_owner_id = self._owner_id
         self._owner_id = owner_id
 
+        self._network.object_manager.handle_owner_changed(self, self._old_owner_id)
+        self._network.handle_shard_object_changed(self, self.location, self._old_owner_id)
+
+    def restore_owner_id(self, owner_id):
+        """
+        Sets the owner of an object restored from a snapshot before it's added,
+        without telling anybody about it
+        """
+
+        self._owner_id = owner_id
+
     @property
     def old_parent_id(self):
-        return self._old_parent_id
+        return self._old_location[0]
 
     @property
     def parent_id(self):
@@ -121,12 +218,15 @@ class StateObject(object):
 
     @parent_id.setter
     def parent_id(self, parent_id):
-        self._old_parent_id = self._parent_id
+        self._old_location = self.location
         self._parent_id = parent_id
 
+        self._network.object_manager.handle_location_changed(self, self._old_location)
+        self._network.handle_shard_object_changed(self, self._old_location, self._owner_id)
+
     @property
     def old_zone_id(self):
-        return self._old_zone_id
+        return self._old_location[1]
 
     @property
     def zone_id(self):
@@ -134,9 +234,25 @@ class StateObject(object):
 
     @zone_id.setter
     def zone_id(self, zone_id):
-        self._old_zone_id = self._zone_id
+        self._old_location = self.location
         self._zone_id = zone_id
 
+        self._network.object_manager.handle_location_changed(self, self._old_location)
+        self._network.handle_shard_object_changed(self, self._old_location, self._owner_id)
+
+    @property
+    def location(self):
+        return (self._parent_id, self._zone_id)
+
+    @property
+    def old_location(self):
+        """
+        The location the object was in before it's last move,
+        regardless of whether the parent or the zone changed
+        """
+
+        return self._old_location
+
     @property
     def dc_class(self):
         return self._dc_class
@@ -145,38 +261,116 @@ class StateObject(object):
     def has_other(self):
         return self._has_other
 
-    def append_required_data(self, datagram):
+    @property
+    def layout(self):
+        return self._layout
+
+    def pack_fields(self, fields):
+        # the fields are already packed and in the order they
+        # are inherited in, so they only need to be put together...
+        fields = [field_data for field_data in fields if field_data is not None]
+
+        self._network.pack_count += len(fields)
+        return ''.join(fields)
+
+    def get_field_data(self, field_number):
+        slot = self._layout.field_slots.get(field_number)
+
+        if slot is None:
+            return None
+
+        return self._fields[slot]
+
+    def set_field_data(self, field_number, data):
+        slot = self._layout.field_slots.get(field_number)
+
+        if slot is None:
+            return
+
+        self._fields[slot] = data
+
+        if slot < self._layout.num_required:
+            self._required_data = None
+        else:
+            self._other_data = None
+
+    def get_field_args(self, field_number):
+        """
+        Unpacks the stored value of a field, returns None if the field is not set
+        """
+
+        data = self.get_field_data(field_number)
+
+        if data is None:
+            return None
+
+        field = self._dc_class.get_field_by_index(field_number)
         field_packer = DCPacker()
-        for index in self._required_fields:
-            field = self._dc_class.get_field_by_index(index)
+        field_packer.set_unpack_data(data)
 
-            if not field:
-                self.notify.error('Failed to append required data for field: %s dclass: %s, unknown field!' % (
-                    field_name, self._dc_class.get_name()))
+        field_packer.begin_unpack(field)
+        field_args = field.unpack_args(field_packer)
+        field_packer.end_unpack()
 
-            field_packer.begin_pack(field)
-            field.pack_args(field_packer, self._required_fields[field.get_number()])
-            field_packer.end_pack()
+        return field_args
 
-        datagram.append_data(field_packer.get_string())
+    def skip_field_data(self, field, data):
+        """
+        Validates the packed data of a field without unpacking it, returns
+        the bytes of data that belong to the field or None if it is invalid
+        """
 
-    def append_other_data(self, datagram):
         field_packer = DCPacker()
-        for index in self._other_fields:
-            field = self._dc_class.get_field_by_index(index)
+        field_packer.set_unpack_data(data)
 
-            if not field:
-                self.notify.error('Failed to append other data for field: %s dclass: %s, unknown field!' % (
-                    field_name, self._dc_class.get_name()))
+        field_packer.begin_unpack(field)
+        field_packer.unpack_skip()
 
-            field_packer.begin_pack(field)
-            field.pack_args(field_packer, self._other_fields[field.get_number()])
-            field_packer.end_pack()
+        if not field_packer.end_unpack():
+            return None
 
-        datagram.append_data(field_packer.get_string())
+        return data[:field_packer.get_num_unpacked_bytes()]
 
-    def setup(self):
-        self.handle_send_generate_broadcast()
+    def append_required_data(self, datagram):
+        if self._required_data is None:
+            self._required_data = self.pack_fields(self._fields[:self._layout.num_required])
+        else:
+            self._network.packs_avoided += self._layout.num_required
+
+        datagram.append_data(self._required_data)
+
+    def append_other_data(self, datagram):
+        if self._other_data is None:
+            self._other_data = self.pack_fields(self._fields[self._layout.num_required:])
+        else:
+            self._network.packs_avoided += self._layout.num_fields - self._layout.num_required
+
+        datagram.append_data(self._other_data)
+
+    def append_snapshot_data(self, datagram):
+        datagram.add_uint32(self._do_id)
+        datagram.add_uint32(self._parent_id)
+        datagram.add_uint32(self._zone_id)
+        datagram.add_uint64(self._owner_id)
+        datagram.add_uint16(self._dc_class.get_number())
+        datagram.add_uint8(self._has_other)
+
+        fields = [(field_number, field_data) for field_number, field_data in zip(
+            self._layout.field_numbers, self._fields) if field_data is not None]
+
+        datagram.add_uint16(len(fields))
+
+        for field_number, field_data in fields:
+            datagram.add_uint16(field_number)
+            datagram.add_blob(field_data)
+
+    def setup(self, send_generate=True):
+        self._network.handle_shard_object_changed(self, None, 0)
+
+        # objects restored from a snapshot were already generated
+        # for everyone that can see them before the restart...
+        if send_generate:
+            self._network.run_object_action(self._do_id, self.handle_send_generate_broadcast)
 
     def handle_internal_datagram(self, sender, message_type, di):
         if message_type == types.STATESERVER_OBJECT_SET_OWNER:
@@ -185,6 +379,10 @@ class StateObject(object):
             self.handle_set_ai(sender, di)
         elif message_type == types.STATESERVER_OBJECT_SET_ZONE:
             self.handle_set_zone(sender, di)
+        elif message_type == types.STATESERVER_OBJECT_SEND_GENERATE:
+            self.handle_send_generate(di.get_uint64())
+        elif message_type == types.STATESERVER_OBJECT_SEND_DELETE:
+            self.handle_send_delete(di.get_uint64())
         else:
             self.notify.warning('Received unknown message type %d for state object %d!' % (
                 message_type, self._do_id))
@@ -211,9 +409,9 @@ class StateObject(object):
 
         # tell the object's old AI that they have left and are
         # moving to an new AI...
-        if self._old_parent_id:
+        if self.old_parent_id:
             datagram = io.NetworkDatagram()
-            datagram.add_header(self._old_parent_id, self._do_id,
+            datagram.add_header(self.old_parent_id, self._do_id,
                 types.STATESERVER_OBJECT_CHANGING_AI)
 
             datagram.add_uint64(self._do_id)
@@ -239,14 +437,34 @@ class StateObject(object):
         # will be located within that new interests...
         self.zone_id = di.get_uint32()
 
-        # delete any existing objects within our new interest set,
-        # exclude our own object since thats a local object...
-        self.handle_delete_objects(excludes=[self._do_id])
-        self.handle_send_delete_broadcast(excludes=[self._do_id])
+        # the objects on the other shards are generated and deleted for our owner
+        # by their own shard, we wait for all of them before going any further...
+        remote_generates = self._network.handle_send_shard_change_zone(self)
+        self._network.run_object_action(self._do_id, self.handle_change_zone, remote_generates)
+
+    def handle_change_zone(self, remote_generates):
+        # work out which objects came into or left our view, objects that
+        # are visible from both locations are left alone entirely...
+        old_visible = self.get_visible_objects(self._old_location)
+        new_visible = self.get_visible_objects(self.location)
+
+        deletes = old_visible - new_visible
+        generates = new_visible - old_visible
+
+        # the objects our owner can see some other way, through it's interest
+        # set or it's other objects, are left alone as well...
+        if self._owner_id:
+            deletes = self.get_unseen_objects(deletes)
+            generates = self.get_unseen_objects(generates)
+
+        # delete the objects that are no longer within our interest set,
+        # and delete our own object for the owners that can no longer see it...
+        self.handle_send_deletes(deletes)
+        self.handle_send_interest_delete_broadcast()
 
         # send generates for the quite zone objects before we change the avatar's
         # zone so that they always have interest in those objects...
-        self.handle_send_generates(quietZone=True, excludes=[self._do_id])
+        self.handle_send_generates(generates, quietZone=True)
 
         # tell our current AI channel that we're changing location
         # and that they need to update their instance of the object...
@@ -254,12 +472,20 @@ class StateObject(object):
 
         # if we have an owner, tell them that we've sent all of the initial zone
         # objects in the new interest set...
-        self.handle_send_set_zone(self._owner_id, self._zone_id, self._old_zone_id)
+        self.handle_send_set_zone(self._owner_id, self._zone_id, self.old_zone_id)
 
         # generate any new objects within our new interest set,
-        # exclude our own object since thats a local object...
-        self.handle_send_generates(excludes=[self._do_id])
-        self.handle_send_generate_broadcast(excludes=[self._do_id])
+        # and generate our own object for the owners that can now see it...
+        self.handle_send_generates(generates)
+        self._network.handle_send_remote_generates(self._owner_id, remote_generates)
+        self.handle_send_interest_generate_broadcast()
+
+        # a full teardown and rebuild would delete everything we could see
+        # and generate everything we can see now, count what was saved...
+        self._network.zone_change_count += 1
+        self._network.interest_messages_sent += len(deletes) + len(generates) + len(remote_generates)
+        self._network.interest_messages_avoided += (len(old_visible) + len(new_visible)) - (
+            len(deletes) + len(generates))
 
     def handle_update_field(self, sender, channel, di):
         field_id = di.get_uint16()
@@ -271,16 +497,24 @@ class StateObject(object):
 
             return
 
-        # copy the field update so we can unpack it and
+        # copy the field update so we can store it and
         # update any required fields here on the state server.
-        # we must do this after we allow the field to be updated
-        # because the checks to ensure the field is valid must be ran first...
-        datagram = io.NetworkDatagram()
-        datagram.append_data(di.get_remaining_bytes())
+        # the data is validated before the update is sent anywhere,
+        # and only the validated bytes of the field are ever sent...
+        data = di.get_remaining_bytes()
+        field_data = None
 
-        # create a new datagram iterator object that the field
-        # response update can unpack from...
-        di = io.NetworkDatagramIterator(datagram)
+        if data:
+            field_data = self.skip_field_data(field, data)
+
+            if field_data is None:
+                self.notify.warning('Failed to update field: %s dclass: %s, invalid data!' % (
+                    field.get_name(), self._dc_class.get_name()))
+
+                return
+
+        update_data = field_data or ''
+        coalesced = field.is_broadcast() and self._network.is_coalesced_field(self._dc_class, field)
 
         # ensure this field is not a bogus field...
         if field.is_bogus_field():
@@ -311,38 +545,36 @@ class StateObject(object):
 
                     return
 
+            # the coalesced updates held back for the object go out first,
+            # so that nothing sent after them can ever overtake them...
+            if not coalesced:
+                self.handle_flush_coalesced_updates()
+
             if not field.is_broadcast():
-                self.handle_send_update(field, sender, self._parent_id, di)
+                self.handle_send_update(field, sender, self._parent_id, update_data)
+            elif coalesced:
+                self.handle_coalesce_update(field, sender, update_data, excludes=[avatar_id])
             else:
-                self.handle_send_update_broadcast(field, sender, di, excludes=[avatar_id])
+                self.handle_send_update_broadcast(field, sender, update_data, excludes=[avatar_id])
         else:
+            if not coalesced:
+                self.handle_flush_coalesced_updates()
+
             if not field.is_broadcast():
-                self.handle_send_update(field, self._parent_id, channel, di)
+                self.handle_send_update(field, self._parent_id, channel, update_data)
+            elif coalesced:
+                self.handle_coalesce_update(field, self._parent_id, update_data, excludes=[self._do_id])
             else:
-                self.handle_send_update_broadcast(field, self._parent_id, di, excludes=[self._do_id])
-
-        # unpack the field arguments so that we can update our
-        # view of the object's required or other fields dictionaries...
-        di = io.NetworkDatagramIterator(datagram)
+                self.handle_send_update_broadcast(field, self._parent_id, update_data, excludes=[self._do_id])
 
-        # if the iterator is empty, this means that the field
+        # if there is no field data, this means that the field
         # has no arguents and that we should not attempt to update it...
-        if not di.get_remaining_size():
+        if not field_data:
             return
 
-        field_packer = DCPacker()
-        field_packer.set_unpack_data(di.get_remaining_bytes())
-
-        field_packer.begin_unpack(field)
-        field_args = field.unpack_args(field_packer)
-        field_packer.end_unpack()
-
-        # check to see if the field is a required or other field,
-        # and store the new arguments appropriately.
-        if field.is_required():
-            self._required_fields[field.get_number()] = field_args
-        elif field.is_ram():
-            self._other_fields[field.get_number()] = field_args
+        # store the new packed data in the field's slot, this
+        # will only store the field if it is a required or other field.
+        self.set_field_data(field.get_number(), field_data)
 
     def handle_send_changing_location(self):
         datagram = io.NetworkDatagram()
@@ -363,43 +595,86 @@ class StateObject(object):
         datagram.add_uint32(zone_id)
         self._network.handle_send_connection_datagram(datagram)
 
-    def handle_send_update(self, field, sender, channel, di):
-        datagram = io.NetworkDatagram()
-        datagram.add_header(channel, sender,
-            types.STATESERVER_OBJECT_UPDATE_FIELD)
+    def handle_send_update(self, field, sender, channel, data):
+        self.handle_send_update_multiple(field, sender, [channel], data)
 
+    def handle_send_update_multiple(self, field, sender, channels, data):
+        # the field data was already validated when it was received,
+        # so the update body is built once from it as is and only the
+        # routing header differs between the recipients...
+        datagram = io.NetworkDatagram()
         datagram.add_uint32(self._do_id)
         datagram.add_uint16(field.get_number())
+        datagram.append_data(data)
 
-        field_packer = DCPacker()
-        field_packer.begin_pack(field)
+        self._network.handle_send_connection_multi_datagram(channels, sender,
+            types.STATESERVER_OBJECT_UPDATE_FIELD, datagram)
 
-        if di.get_remaining_size():
-            field_packer.pack_literal_value(di.get_remaining_bytes())
+    def get_location_owners(self, location=None, excludes=[]):
+        """
+        Returns the owner channels of the objects in the location, which defaults
+        to our own, and the owners with interest in it. each owner channel is
+        returned once, however many ways it can see the location
+        """
 
-        field_packer.end_pack()
+        object_manager = self._network.object_manager
+        location = location or self.location
+        owners = object_manager.get_location_owners(location)
+        interests = object_manager.get_location_interests(location)
 
-        datagram.append_data(field_packer.get_string())
-        self._network.handle_send_connection_datagram(datagram)
+        # an owner is only left out if every one of it's
+        # objects in the location was excluded...
+        excluded = {}
 
-    def handle_send_update_broadcast(self, field, sender, di, excludes=[]):
-        for state_object in self._network.object_manager.state_objects.values():
+        for do_id in excludes:
+            state_object = object_manager.find_state_object(do_id)
 
-            if state_object.do_id in excludes:
+            if not state_object or not state_object.owner_id or state_object.location != location:
                 continue
 
-            if state_object.parent_id == self._parent_id and state_object.zone_id == self._zone_id:
+            excluded[state_object.owner_id] = excluded.get(state_object.owner_id, 0) + 1
 
-                if not state_object.owner_id:
-                    continue
+        channels = [owner_id for owner_id, count in owners.items() if count > excluded.get(owner_id, 0)]
+        channels.extend([owner_id for owner_id in interests if owner_id not in owners])
+
+        return channels
 
-                self.handle_send_update(field, sender, state_object.owner_id, di)
+    def handle_send_update_broadcast(self, field, sender, data, excludes=[]):
+        channels = self.get_location_owners(excludes=excludes)
 
-        if self._do_id in excludes:
+        if self._do_id not in excludes and not self._owner_id:
+            channels.append(self._parent_id)
+
+        if not channels:
             return
 
-        if not self._owner_id:
-            self.handle_send_update(field, sender, self._parent_id, di)
+        self.handle_send_update_multiple(field, sender, channels, data)
+
+    def handle_coalesce_update(self, field, sender, data, excludes=[]):
+        """
+        Holds onto a latest-wins broadcast update until the next
+        coalesce flush, replacing any value still waiting to be sent
+        """
+
+        if self._coalesced_updates is None:
+            self._coalesced_updates = {}
+
+        if field.get_number() in self._coalesced_updates:
+            self._network.coalesced_count += 1
+
+        self._coalesced_updates[field.get_number()] = (field, sender, data, excludes)
+        self._network.add_coalesced_object(self)
+
+    def handle_flush_coalesced_updates(self):
+        coalesced_updates, self._coalesced_updates = self._coalesced_updates, None
+
+        if not coalesced_updates:
+            return
+
+        self._network.remove_coalesced_object(self)
+
+        for field, sender, data, excludes in coalesced_updates.values():
+            self.handle_send_update_broadcast(field, sender, data, excludes=excludes)
 
     def handle_send_ai_generate(self):
         datagram = io.NetworkDatagram()
@@ -424,15 +699,10 @@ class StateObject(object):
         self._network.handle_send_connection_datagram(datagram)
 
     def handle_send_generate(self, channel):
-        datagram = io.NetworkDatagram()
-
-        if not self._has_other:
-            datagram.add_header(channel, self._network.channel,
-                types.STATESERVER_OBJECT_ENTER_LOCATION_WITH_REQUIRED)
-        else:
-            datagram.add_header(channel, self._network.channel,
-                types.STATESERVER_OBJECT_ENTER_LOCATION_WITH_REQUIRED_OTHER)
+        self.handle_send_generate_multiple([channel])
 
+    def handle_send_generate_multiple(self, channels):
+        datagram = io.NetworkDatagram()
         datagram.add_uint64(self._do_id)
         datagram.add_uint64(self._parent_id)
         datagram.add_uint32(self._zone_id)
@@ -440,207 +710,1296 @@ class StateObject(object):
 
         if not self._has_other:
             self.append_required_data(datagram)
+            message_type = types.STATESERVER_OBJECT_ENTER_LOCATION_WITH_REQUIRED
         else:
             self.append_other_data(datagram)
+            message_type = types.STATESERVER_OBJECT_ENTER_LOCATION_WITH_REQUIRED_OTHER
 
-        self._network.handle_send_connection_datagram(datagram)
+        self._network.handle_send_connection_multi_datagram(channels, self._network.channel,
+            message_type, datagram)
 
     def handle_send_generate_broadcast(self, excludes=[]):
-        for state_object in self._network.object_manager.state_objects.values():
+        channels = self.get_location_owners(excludes=excludes)
 
-            if state_object.do_id in excludes:
-                continue
+        if not channels:
+            return
 
-            if state_object.parent_id == self._parent_id and state_object.zone_id == self._zone_id:
+        self.handle_send_generate_multiple(channels)
 
-                if not state_object.owner_id:
-                    continue
+    def get_visible_objects(self, location):
+        """
+        Returns the do_ids of our shard's objects that our owner can see from the
+        location, which are the objects in the location and in it's parent's quiet zone
+        """
 
-                self.handle_send_generate(state_object.owner_id)
+        visible_objects = self._network.object_manager.get_visible_objects(location)
+        visible_objects.discard(self._do_id)
+        return visible_objects
 
-    def handle_send_generates(self, quietZone=False, excludes=[]):
-        for state_object in self._network.object_manager.state_objects.values():
+    def get_unseen_objects(self, do_ids):
+        """
+        Returns the do_ids our owner could not see if it were not for our object
+        """
 
-            if state_object.do_id in excludes:
-                continue
+        return self._network.object_manager.get_unseen_objects(self._owner_id, do_ids, exclude=self)
 
-            if state_object.zone_id == OTP_ZONE_ID_OLD_QUIET_ZONE and not quietZone:
-                continue
+    def handle_send_generates(self, do_ids, quietZone=False):
+        if not self._owner_id:
+            return
 
-            if state_object.parent_id == self._parent_id and state_object.zone_id == self._zone_id:
-                state_object.handle_send_generate(self._owner_id)
+        self._network.handle_send_generates(self._owner_id, do_ids, quietZone)
+
+    def handle_send_interest_generate_broadcast(self):
+        # our own owner always has our object, wherever it is...
+        old_owners = self.get_location_owners(self._old_location, [self._do_id])
+        channels = [owner_id for owner_id in self.get_location_owners(excludes=[self._do_id]) if \
+            owner_id not in old_owners and owner_id != self._owner_id]
+
+        if not channels:
+            return
+
+        self.handle_send_generate_multiple(channels)
 
     def handle_send_delete(self, channel):
-        datagram = io.NetworkDatagram()
-        datagram.add_header(channel, self._network.channel,
-            types.STATESERVER_OBJECT_DELETE_RAM)
+        self.handle_send_delete_multiple([channel])
 
-        datagram.add_uint64(self._do_id)
-        self._network.handle_send_connection_datagram(datagram)
+    def handle_send_delete_multiple(self, channels):
+        self._network.handle_send_delete_multiple(channels, [self._do_id])
+
+    def handle_send_delete_broadcast(self, location, excludes=[]):
+        channels = self.get_location_owners(location, excludes)
 
-    def handle_send_delete_broadcast(self, cleanup=False, excludes=[]):
-        for state_object in self._network.object_manager.state_objects.values():
+        if not channels:
+            return
+
+        self.handle_send_delete_multiple(channels)
+
+    def handle_send_deletes(self, do_ids):
+        if not self._owner_id:
+            return
+
+        for do_id in do_ids:
+            state_object = self._network.object_manager.get_state_object(do_id)
 
-            if state_object.do_id in excludes:
+            if not state_object:
                 continue
 
-            if (state_object.parent_id == self._old_parent_id or state_object.zone_id == self._old_zone_id) or (cleanup and \
-                state_object.parent_id == self._parent_id and state_object.zone_id == self._zone_id):
+            state_object.handle_send_delete(self._owner_id)
 
-                if not state_object.owner_id:
-                    continue
+    def handle_send_interest_delete_broadcast(self):
+        new_owners = self.get_location_owners(excludes=[self._do_id])
+        channels = [owner_id for owner_id in self.get_location_owners(self._old_location, [self._do_id]) if \
+            owner_id not in new_owners and owner_id != self._owner_id]
 
-                self.handle_send_delete(state_object.owner_id)
+        if not channels:
+            return
 
-    def handle_delete_objects(self, excludes=[]):
-        for state_object in self._network.object_manager.state_objects.values():
+        self.handle_send_delete_multiple(channels)
 
-            if state_object.do_id in excludes:
-                continue
+    def destroy(self, send_delete=True):
+        # the object is going away, any updates still waiting
+        # to be flushed have nobody left to be sent to...
+        self._coalesced_updates = None
+        self._network.remove_coalesced_object(self)
 
-            if state_object.zone_id == OTP_ZONE_ID_OLD_QUIET_ZONE:
-                continue
+        # objects removed in bulk have their deletes
+        # sent together by the state server instead...
+        if send_delete:
+            self.handle_send_delete_broadcast(self.location, excludes=[self._do_id])
+            self._network.handle_shard_objects_removed([self])
+
+        if not self._network.has_range_channel(self._do_id):
+            self._network.unregister_for_channel(self._do_id)
+
+class RemoteStateObject(object):
+    """
+    A record of an owned object that lives on another state server shard, only
+    kept while one of our own objects shares it's location so that our broadcasts
+    reach it's owner. only it's location and owner are known here
+    """
+
+    __slots__ = ('_network', '_do_id', '_parent_id', '_zone_id', '_owner_id')
+
+    def __init__(self, network, do_id, parent_id, zone_id, owner_id):
+        self._network = network
+        self._do_id = do_id
+        self._parent_id = parent_id
+        self._zone_id = zone_id
+        self._owner_id = owner_id
+
+    @property
+    def do_id(self):
+        return self._do_id
 
-            if state_object.parent_id == self._old_parent_id or state_object.zone_id == self._old_zone_id:
-                state_object.handle_send_delete(self._owner_id)
+    @property
+    def parent_id(self):
+        return self._parent_id
+
+    @property
+    def zone_id(self):
+        return self._zone_id
+
+    @property
+    def owner_id(self):
+        return self._owner_id
 
-    def destroy(self):
-        self.handle_send_delete_broadcast(cleanup=True, excludes=[self._do_id])
+    @property
+    def location(self):
+        return (self._parent_id, self._zone_id)
 
 class StateObjectManager(object):
     notify = directNotify.newCategory('StateObjectManager')
 
     def __init__(self):
         self._state_objects = {}
+        self._remote_objects = {}
+
+        self._locations = {}
+        self._location_owners = {}
+        self._owner_parents = {}
+        self._parents = {}
+
+        # the (parent, zone) locations each owner has interest in,
+        # and the owners with interest in each location...
+        self._interests = {}
+        self._location_interests = {}
 
     @property
     def state_objects(self):
         return self._state_objects
 
+    @property
+    def remote_objects(self):
+        return self._remote_objects
+
+    @property
+    def locations(self):
+        return self._locations
+
+    @property
+    def location_owners(self):
+        return self._location_owners
+
+    @property
+    def parents(self):
+        return self._parents
+
+    @property
+    def interests(self):
+        return self._interests
+
     def has_state_object(self, do_id):
         return do_id in self._state_objects
 
-    def add_state_object(self, state_object):
+    def add_state_object(self, state_object, send_generate=True):
         if self.has_state_object(state_object.do_id):
             return
 
         self._state_objects[state_object.do_id] = state_object
-        state_object.setup()
+        self.__add_location(state_object, state_object.location)
+        self.__add_parent(state_object, state_object.parent_id)
+        state_object.setup(send_generate)
 
-    def remove_state_object(self, state_object):
+    def remove_state_object(self, state_object, send_delete=True):
         if not self.has_state_object(state_object.do_id):
             return
 
-        state_object.destroy()
+        state_object.destroy(send_delete)
+        self.__remove_location(state_object, state_object.location)
+        self.__remove_parent(state_object, state_object.parent_id)
         del self._state_objects[state_object.do_id]
 
     def get_state_object(self, do_id):
         return self._state_objects.get(do_id)
 
-class StateServer(io.NetworkConnector):
-    notify = directNotify.newCategory('StateServer')
+    def add_remote_object(self, remote_object):
+        self.remove_remote_object(remote_object.do_id)
 
-    def __init__(self, *args, **kwargs):
-        io.NetworkConnector.__init__(self, *args, **kwargs)
+        self._remote_objects[remote_object.do_id] = remote_object
+        self.__add_location(remote_object, remote_object.location)
 
-        self._shard_manager = ShardManager()
-        self._object_manager = StateObjectManager()
+    def remove_remote_object(self, do_id):
+        remote_object = self._remote_objects.pop(do_id, None)
 
-    @property
-    def shard_manager(self):
-        return self._shard_manager
+        if not remote_object:
+            return
 
-    @property
-    def object_manager(self):
-        return self._object_manager
+        self.__remove_location(remote_object, remote_object.location)
 
-    def handle_datagram(self, channel, sender, message_type, di):
-        if message_type == types.STATESERVER_ADD_SHARD:
-            self.handle_add_shard(sender, di)
-        elif message_type == types.STATESERVER_REMOVE_SHARD:
-            self.handle_remove_shard(sender)
-        elif message_type == types.STATESERVER_GET_SHARD_ALL:
-            self.handle_get_shard_list(sender, di)
-        elif message_type == types.STATESERVER_OBJECT_GENERATE_WITH_REQUIRED:
-            self.handle_generate(sender, False, di)
-        elif message_type == types.STATESERVER_OBJECT_GENERATE_WITH_REQUIRED_OTHER:
-            self.handle_generate(sender, True, di)
-        elif message_type == types.STATESERVER_OBJECT_UPDATE_FIELD:
-            self.handle_object_update_field(sender, channel, di)
-        elif message_type == types.STATESERVER_SET_AVATAR:
-            self.handle_set_avatar(sender, di)
-        elif message_type == types.STATESERVER_OBJECT_DELETE_RAM:
-            self.handle_delete_object(sender, di)
-        else:
-            state_object = self._object_manager.get_state_object(channel)
+    def get_remote_object(self, do_id):
+        return self._remote_objects.get(do_id)
 
-            if not state_object:
-                self.notify.debug('Received an unknown message type: %d from channel: %d!' % (
-                    message_type, sender))
+    def find_state_object(self, do_id):
+        """
+        Returns the object with the do_id, or the record of it
+        if the object lives on another state server shard
+        """
 
-                return
+        return self._state_objects.get(do_id) or self._remote_objects.get(do_id)
 
-            state_object.handle_internal_datagram(sender, message_type, di)
+    def get_location_do_ids(self, location):
+        return self._locations.get(location, ())
 
-    def handle_add_shard(self, sender, di):
-        self._shard_manager.add_shard(sender, di.getString(), di.get_uint32())
+    def get_location_objects(self, location):
+        """
+        Returns the objects that are located in the (parent, zone) location
+        """
 
-    def handle_remove_shard(self, sender):
-        shard = self._shard_manager.get_shard(sender)
+        return [self._state_objects[do_id] for do_id in self._locations.get(location, ()) if \
+            do_id in self._state_objects]
 
-        if not shard:
-            self.notify.warning('Cannot remove shard: %d, does not exist!' % (
-                sender))
+    def get_visible_objects(self, location):
+        """
+        Returns the do_ids of our objects that can be seen from the location, which
+        are the objects in the location and in it's parent's quiet zone
+        """
 
-            return
+        parent_id, zone_id = location
+        visible_objects = set(state_object.do_id for state_object in self.get_location_objects(location))
 
-        for state_object in self._object_manager.state_objects.values():
+        if zone_id != OTP_ZONE_ID_OLD_QUIET_ZONE:
+            visible_objects.update(state_object.do_id for state_object in self.get_location_objects((
+                parent_id, OTP_ZONE_ID_OLD_QUIET_ZONE)))
 
-            if state_object.parent_id == shard.channel:
-                self._object_manager.remove_state_object(state_object)
+        return visible_objects
 
-        self._shard_manager.remove_shard(shard.channel)
+    def get_unseen_objects(self, owner_id, do_ids, exclude=None):
+        """
+        Returns the do_ids of our objects the owner could not see without the exclude object
+        """
 
-    def handle_get_shard_list(self, sender, di):
-        datagram = io.NetworkDatagram()
-        datagram.add_header(sender, self.channel,
-            types.STATESERVER_GET_SHARD_ALL_RESP)
+        unseen_objects = set()
 
-        datagram.add_uint16(len(self._shard_manager.shards))
+        for do_id in do_ids:
+            state_object = self._state_objects.get(do_id)
 
-        for shard in self._shard_manager.get_shards():
-            datagram.add_uint32(shard.channel)
-            datagram.add_string(shard.name)
-            datagram.add_uint32(shard.population)
+            if state_object and not self.can_owner_see(owner_id, state_object.location,
+                exclude=exclude):
 
-        self.handle_send_connection_datagram(datagram)
+                unseen_objects.add(do_id)
 
-    def handle_generate(self, sender, has_other, di):
-        do_id = di.get_uint32()
-        parent_id = di.get_uint32()
-        zone_id = di.get_uint32()
-        dc_id = di.get_uint16()
+        return unseen_objects
 
-        if self._object_manager.has_state_object(do_id):
-            self.notify.debug("Failed to generate an already existing object with do_id: %d!" % (
-                do_id))
+    def get_location_owners(self, location):
+        """
+        Returns the owner channels in the location, mapped to the number
+        of objects in the location which that channel owns
+        """
 
-            return
+        return self._location_owners.get(location, {})
 
-        dc_class = self.dc_loader.dclasses_by_number.get(dc_id)
+    def get_interest(self, owner_id):
+        return self._interests.get(owner_id, frozenset())
 
-        if not dc_class:
-            self.notify.warning("Failed to generate an object with do_id: %d, no dclass found for dc_id: %d!" % (
-                do_id, dc_id))
+    def set_interest(self, owner_id, locations):
+        """
+        Replaces the owner's interest set with the locations
+        """
 
-            return
+        for location in self._interests.pop(owner_id, ()):
+            owner_ids = self._location_interests[location]
+            owner_ids.discard(owner_id)
 
-        state_object = StateObject(self, do_id, parent_id, zone_id, dc_class, has_other, di)
-        self._object_manager.add_state_object(state_object)
+            if not owner_ids:
+                del self._location_interests[location]
+
+        if not locations:
+            return
+
+        self._interests[owner_id] = frozenset(locations)
+
+        for location in locations:
+            self._location_interests.setdefault(location, set()).add(owner_id)
+
+    def get_location_interests(self, location):
+        """
+        Returns the owner channels with interest in the location
+        """
+
+        return self._location_interests.get(location, ())
+
+    def can_owner_see(self, owner_id, location, exclude=None):
+        """
+        Returns whether the owner can see the location, through one of it's objects
+        being there, through the quiet zone of a parent one of it's objects is
+        under or through it's interest set. the exclude object of the owner
+        is left out, as if it were not there...
+        """
+
+        if location in self._interests.get(owner_id, ()):
+            return True
+
+        count = self._location_owners.get(location, {}).get(owner_id, 0)
+
+        if exclude and exclude.location == location:
+            count -= 1
+
+        if count > 0:
+            return True
+
+        parent_id, zone_id = location
+
+        if zone_id != OTP_ZONE_ID_OLD_QUIET_ZONE:
+            return False
+
+        count = self._owner_parents.get(owner_id, {}).get(parent_id, 0)
+
+        if exclude and exclude.parent_id == parent_id:
+            count -= 1
+
+        return count > 0
+
+    def get_parent_objects(self, parent_id):
+        """
+        Returns our objects that live under the parent, in any zone
+        """
+
+        return [self._state_objects[do_id] for do_id in self._parents.get(parent_id, ())]
+
+    def handle_location_changed(self, state_object, old_location):
+        if self._state_objects.get(state_object.do_id) is not state_object:
+            return
+
+        self.__remove_location(state_object, old_location)
+        self.__add_location(state_object, state_object.location)
+
+        if old_location[0] != state_object.parent_id:
+            self.__remove_parent(state_object, old_location[0])
+            self.__add_parent(state_object, state_object.parent_id)
+
+    def handle_owner_changed(self, state_object, old_owner_id):
+        if self._state_objects.get(state_object.do_id) is not state_object:
+            return
+
+        self.__remove_owner(state_object.location, old_owner_id)
+        self.__add_owner(state_object.location, state_object.owner_id)
+
+    def __add_location(self, state_object, location):
+        self._locations.setdefault(location, set()).add(state_object.do_id)
+        self.__add_owner(location, state_object.owner_id)
+
+    def __remove_location(self, state_object, location):
+        do_ids = self._locations.get(location)
+
+        if not do_ids or state_object.do_id not in do_ids:
+            return
+
+        do_ids.discard(state_object.do_id)
+
+        if not do_ids:
+            del self._locations[location]
+
+        self.__remove_owner(location, state_object.owner_id)
+
+    def __add_parent(self, state_object, parent_id):
+        self._parents.setdefault(parent_id, set()).add(state_object.do_id)
+
+    def __remove_parent(self, state_object, parent_id):
+        do_ids = self._parents.get(parent_id)
+
+        if not do_ids:
+            return
+
+        do_ids.discard(state_object.do_id)
+
+        if not do_ids:
+            del self._parents[parent_id]
+
+    def __add_owner(self, location, owner_id):
+        if not owner_id:
+            return
+
+        owners = self._location_owners.setdefault(location, {})
+        owners[owner_id] = owners.get(owner_id, 0) + 1
+
+        parents = self._owner_parents.setdefault(owner_id, {})
+        parents[location[0]] = parents.get(location[0], 0) + 1
+
+    def __remove_owner(self, location, owner_id):
+        owners = self._location_owners.get(location)
+
+        if not owner_id or not owners or owner_id not in owners:
+            return
+
+        owners[owner_id] -= 1
+
+        if owners[owner_id] <= 0:
+            del owners[owner_id]
+
+        if not owners:
+            del self._location_owners[location]
+
+        parents = self._owner_parents[owner_id]
+        parents[location[0]] -= 1
+
+        if parents[location[0]] <= 0:
+            del parents[location[0]]
+
+        if not parents:
+            del self._owner_parents[owner_id]
+
+class StateServerSnapshot(object):
+    """
+    Writes the state server's objects to a binary snapshot file a few
+    objects at a time, and restores them from it after a restart
+    """
+
+    notify = directNotify.newCategory('StateServerSnapshot')
+
+    SNAPSHOT_MAGIC = 'SSSNAP'
+    SNAPSHOT_VERSION = 2
+
+    def __init__(self, network, filename, batch_size, max_time=0):
+        self._network = network
+        self._filename = filename
+        self._batch_size = batch_size
+        self._max_time = max_time
+
+        # the objects are packed on the state server's thread, the packed
+        # batches are written out to the file by a writer thread of their own...
+        self._writer = None
+        self._batches = None
+        self._do_ids = None
+        self._write_index = 0
+        self._write_count = 0
+
+    @property
+    def filename(self):
+        return self._filename
+
+    @property
+    def batch_size(self):
+        return self._batch_size
+
+    @property
+    def max_time(self):
+        return self._max_time
+
+    @property
+    def active(self):
+        return self._do_ids is not None or (self._writer is not None and self._writer.is_alive())
+
+    @property
+    def temp_filename(self):
+        return '%s.tmp' % self._filename
+
+    def start(self):
+        """
+        Begins a new snapshot of every object the state server has right now
+        """
+
+        if self.active:
+            return False
+
+        directory = os.path.dirname(self._filename)
+
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self._do_ids = self._network.object_manager.state_objects.keys()
+        self._write_index = 0
+        self._write_count = 0
+
+        datagram = io.NetworkDatagram()
+        datagram.append_data(self.SNAPSHOT_MAGIC)
+        datagram.add_uint16(self.SNAPSHOT_VERSION)
+
+        shards = self._network.shard_manager.get_shards()
+        datagram.add_uint16(len(shards))
+
+        for shard in shards:
+            datagram.add_uint32(shard.channel)
+            datagram.add_string(shard.name)
+            datagram.add_uint32(shard.population)
+
+        interests = self._network.object_manager.interests
+        datagram.add_uint32(len(interests))
+
+        for owner_id, locations in interests.iteritems():
+            datagram.add_uint64(owner_id)
+            datagram.add_uint16(len(locations))
+
+            for parent_id, zone_id in locations:
+                datagram.add_uint32(parent_id)
+                datagram.add_uint32(zone_id)
+
+        self._batches = Queue.Queue()
+        self._batches.put(datagram.get_message())
+
+        self._writer = threading.Thread(target=self.__write_batches, args=(self._batches,),
+            name='%s-writer' % self.__class__.__name__)
+
+        self._writer.daemon = True
+        self._writer.start()
+        return True
+
+    def write(self):
+        """
+        Packs the next batch of objects, returns True once the snapshot is complete.
+        objects that changed since the snapshot started are written as they are now...
+        """
+
+        if self._do_ids is None:
+            return True
+
+        object_manager = self._network.object_manager
+        datagram = io.NetworkDatagram()
+
+        # stop early once the batch has taken up it's time, so that
+        # a large batch of objects never holds up the state server...
+        deadline = time.time() + self._max_time if self._max_time > 0 else None
+        end_index = min(self._write_index + self._batch_size, len(self._do_ids))
+
+        while self._write_index < end_index:
+            state_object = object_manager.get_state_object(self._do_ids[self._write_index])
+            self._write_index += 1
+
+            if not state_object:
+                continue
+
+            state_object.append_snapshot_data(datagram)
+            self._write_count += 1
+
+            if deadline is not None and time.time() >= deadline:
+                break
+
+        self._batches.put(datagram.get_message())
+
+        if self._write_index < len(self._do_ids):
+            return False
+
+        self.finish()
+        return True
+
+    def finish(self):
+        self._batches.put(True)
+        self._batches = None
+        self._do_ids = None
+
+    def cancel(self):
+        if self._do_ids is None:
+            return
+
+        self._batches.put(False)
+        self._batches = None
+        self._do_ids = None
+
+    def join(self):
+        """
+        Waits for the writer thread to write out everything it was given
+        """
+
+        if self._writer is not None:
+            self._writer.join()
+
+        self._writer = None
+
+    def __write_batches(self, batches):
+        snapshot_file = None
+
+        try:
+            snapshot_file = open(self.temp_filename, 'wb')
+
+            while True:
+                batch = batches.get()
+
+                if batch is True or batch is False:
+                    break
+
+                snapshot_file.write(batch)
+
+            snapshot_file.close()
+
+            if not batch:
+                os.remove(self.temp_filename)
+                return
+
+            # the finished snapshot replaces the old one all at once,
+            # so a crash never leaves a partially written snapshot behind...
+            if os.name == 'nt' and os.path.exists(self._filename):
+                os.remove(self._filename)
+
+            os.rename(self.temp_filename, self._filename)
+        except (IOError, OSError) as e:
+            self.notify.warning('Failed to write snapshot: %s, %s!' % (self._filename, e))
+
+            if snapshot_file:
+                snapshot_file.close()
+
+            return
+
+        self.notify.info('Wrote snapshot of %d objects to: %s.' % (
+            self._write_count, self._filename))
+
+    def write_all(self):
+        """
+        Writes a complete snapshot right away, such as on shutdown
+        """
+
+        self.cancel()
+        self.join()
+        self.start()
+
+        while not self.write():
+            pass
+
+        self.join()
+
+    def restore(self):
+        """
+        Restores the objects from the snapshot file, the packed fields are
+        stored as they are without being unpacked or validated again
+        """
+
+        if not os.path.exists(self._filename):
+            return 0
+
+        with open(self._filename, 'rb') as snapshot_file:
+            data = snapshot_file.read()
+
+        if not data.startswith(self.SNAPSHOT_MAGIC):
+            self.notify.warning('Failed to restore snapshot: %s, invalid file!' % (
+                self._filename))
+
+            return 0
+
+        datagram = io.NetworkDatagram()
+        datagram.append_data(data)
+        di = io.NetworkDatagramIterator(datagram, len(self.SNAPSHOT_MAGIC))
+        restore_count = 0
+
+        # a snapshot cut short by a crash or a full disk still restores
+        # every object that was written out whole before it...
+        try:
+            version = di.get_uint16()
+
+            if version not in (1, self.SNAPSHOT_VERSION):
+                self.notify.warning('Failed to restore snapshot: %s, unsupported version: %d!' % (
+                    self._filename, version))
+
+                return 0
+
+            for _ in xrange(di.get_uint16()):
+                self._network.shard_manager.add_shard(di.get_uint32(), di.get_string(), di.get_uint32())
+
+            if version > 1:
+                self.restore_interests(di)
+
+            while di.get_remaining_size():
+                if self.restore_object(di):
+                    restore_count += 1
+        except AssertionError:
+            self.notify.warning('Failed to restore snapshot: %s, truncated or corrupt file, '
+                'restored %d objects!' % (self._filename, restore_count))
+
+            return restore_count
+
+        self.notify.info('Restored %d objects from snapshot: %s.' % (
+            restore_count, self._filename))
+
+        return restore_count
+
+    def restore_interests(self, di):
+        interests = []
+
+        for _ in xrange(di.get_uint32()):
+            owner_id = di.get_uint64()
+            interests.append((owner_id, [(di.get_uint32(), di.get_uint32()) for _ in xrange(
+                di.get_uint16())]))
+
+        # the owners already have the objects within their interest
+        # from before the restart, so nothing is generated for them...
+        for owner_id, locations in interests:
+            self._network.object_manager.set_interest(owner_id, locations)
+
+    def restore_object(self, di):
+        do_id = di.get_uint32()
+        parent_id = di.get_uint32()
+        zone_id = di.get_uint32()
+        owner_id = di.get_uint64()
+        dc_id = di.get_uint16()
+        has_other = bool(di.get_uint8())
+
+        fields = [(di.get_uint16(), di.get_blob()) for _ in xrange(di.get_uint16())]
+        dc_class = self._network.dc_loader.dclasses_by_number.get(dc_id)
+
+        if not dc_class:
+            self.notify.warning('Failed to restore object: %d, no dclass found for dc_id: %d!' % (
+                do_id, dc_id))
+
+            return False
+
+        if self._network.object_manager.has_state_object(do_id):
+            return False
+
+        state_object = StateObject(self._network, do_id, parent_id, zone_id, dc_class,
+            has_other, None)
+
+        for field_number, field_data in fields:
+            state_object.set_field_data(field_number, field_data)
+
+        # the owner is set before the object is added, so it's indexed
+        # and published to the other shards along with everything else...
+        state_object.restore_owner_id(owner_id)
+
+        self._network.object_manager.add_state_object(state_object, send_generate=False)
+        return True
+
+class StateServer(io.NetworkConnector):
+    notify = directNotify.newCategory('StateServer')
+
+    def __init__(self, *args, **kwargs):
+        io.NetworkConnector.__init__(self, *args, **kwargs)
+
+        self._shard_manager = ShardManager()
+        self._object_manager = StateObjectManager()
+
+        self._range_min = config.GetInt('stateserver-range-min', 0)
+        self._range_max = config.GetInt('stateserver-range-max', 0)
+
+        # the objects are split between the state server shards by their do_id,
+        # every shard listens on the shared state server channel and on it's own...
+        self._shard_count = max(config.GetInt('stateserver-shards', 1), 1)
+        self._shard_index = config.GetInt('stateserver-shard-index', 0)
+        self._server_channel = self.channel
+        self._shard_channels = []
+
+        if self._shard_count > 1:
+            shard_channel = config.GetInt('stateserver-shard-channel', 1100)
+
+            self.channel = shard_channel + self._shard_index
+            self._shard_channels = [shard_channel + shard_index for shard_index in xrange(
+                self._shard_count) if shard_index != self._shard_index]
+
+            # a shard only owns some of the do_ids in a range,
+            # so each of it's objects subscribe to their own channel...
+            if self._range_max > 0:
+                self.notify.warning('Ignoring state server range: %d-%d, state server is sharded!' % (
+                    self._range_min, self._range_max))
+
+                self._range_min = self._range_max = 0
+
+        # the shards only tell each other about the owned objects in a location,
+        # on the location's channel, which a shard listens on while it has objects there...
+        self._location_channel = config.GetInt('stateserver-location-channel', 10000000)
+        self._location_channels = max(config.GetInt('stateserver-location-channels', 1000000), 1)
+        self._watched_locations = {}
+        self._location_syncs = {}
+
+        # our objects that are waiting for the other shards to answer a request,
+        # along with everything that happened to them while they were waiting...
+        self._shard_requests = {}
+        self._shard_request_id = 0
+        self._shard_request_timeout = config.GetFloat('stateserver-shard-request-timeout', 5.0)
+        self._held_objects = {}
+
+        self.__shard_request_task = None
+
+        # the most do_ids sent together in a single delete message...
+        self._delete_batch_size = max(config.GetInt('stateserver-delete-batch', 1024), 1)
+
+        # the snapshot is disabled unless it has a filename, each
+        # state server shard keeps a snapshot of it's own objects...
+        self._snapshot = None
+        snapshot_filename = config.GetString('stateserver-snapshot-filename', '')
+
+        if snapshot_filename:
+            if self._shard_count > 1:
+                snapshot_filename = '%s.%d' % (snapshot_filename, self._shard_index)
+
+            self._snapshot = StateServerSnapshot(self, snapshot_filename,
+                max(config.GetInt('stateserver-snapshot-batch', 1000), 1),
+                config.GetFloat('stateserver-snapshot-max-time', 0.005))
+
+        self._snapshot_interval = config.GetFloat('stateserver-snapshot-interval', 300.0)
+        self._snapshot_restore = config.GetBool('stateserver-snapshot-restore', True)
+
+        self.__snapshot_task = None
+        self.__snapshot_write_task = None
+
+        self._pack_count = 0
+        self._packs_avoided = 0
+
+        self._field_layouts = {}
+
+        self._zone_change_count = 0
+        self._interest_messages_sent = 0
+        self._interest_messages_avoided = 0
+
+        # the latest-wins broadcast fields, given as dclass.field names.
+        # a field named on a dclass is coalesced for every dclass inheriting it...
+        self._coalesce_fields = set()
+
+        for name in config.GetString('stateserver-coalesce-fields', '').split():
+            dc_name, _, field_name = name.rpartition('.')
+
+            if not dc_name or not field_name:
+                self.notify.warning('Ignoring invalid coalesce field: %s, expected dclass.field!' % (
+                    name))
+
+                continue
+
+            self._coalesce_fields.add((dc_name, field_name))
+
+        self._coalesce_interval = config.GetFloat('stateserver-coalesce-interval', 0.1)
+        self._coalesced_fields = {}
+        self._coalesced_objects = set()
+        self._coalesced_count = 0
+
+        self.__coalesce_task = None
+
+    @property
+    def shard_manager(self):
+        return self._shard_manager
+
+    @property
+    def object_manager(self):
+        return self._object_manager
+
+    @property
+    def pack_count(self):
+        """
+        The number of fields put together for object generates
+        """
+
+        return self._pack_count
+
+    @pack_count.setter
+    def pack_count(self, pack_count):
+        self._pack_count = pack_count
+
+    @property
+    def packs_avoided(self):
+        """
+        The number of field packs saved by reusing an object's packed fields
+        """
+
+        return self._packs_avoided
+
+    @packs_avoided.setter
+    def packs_avoided(self, packs_avoided):
+        self._packs_avoided = packs_avoided
+
+    @property
+    def zone_change_count(self):
+        return self._zone_change_count
+
+    @zone_change_count.setter
+    def zone_change_count(self, zone_change_count):
+        self._zone_change_count = zone_change_count
+
+    @property
+    def interest_messages_sent(self):
+        """
+        The number of generates and deletes sent to owners changing zone
+        """
+
+        return self._interest_messages_sent
+
+    @interest_messages_sent.setter
+    def interest_messages_sent(self, interest_messages_sent):
+        self._interest_messages_sent = interest_messages_sent
+
+    @property
+    def interest_messages_avoided(self):
+        """
+        The number of generates and deletes a full teardown and rebuild
+        of the owner's interest would have sent on top of those
+        """
+
+        return self._interest_messages_avoided
+
+    @interest_messages_avoided.setter
+    def interest_messages_avoided(self, interest_messages_avoided):
+        self._interest_messages_avoided = interest_messages_avoided
+
+    def get_field_layout(self, dc_class):
+        """
+        Returns the field layout shared by the objects
+        of the dclass, built once per dclass
+        """
+
+        field_layout = self._field_layouts.get(dc_class.get_number())
+
+        if field_layout is None:
+            field_layout = StateObjectLayout(dc_class)
+            self._field_layouts[dc_class.get_number()] = field_layout
+
+        return field_layout
+
+    @property
+    def snapshot(self):
+        return self._snapshot
+
+    @property
+    def coalesce_interval(self):
+        return self._coalesce_interval
+
+    @property
+    def coalesced_objects(self):
+        return self._coalesced_objects
+
+    @property
+    def coalesced_count(self):
+        """
+        The number of broadcast updates replaced by a newer value
+        before they were flushed, and so never sent
+        """
+
+        return self._coalesced_count
+
+    @coalesced_count.setter
+    def coalesced_count(self, coalesced_count):
+        self._coalesced_count = coalesced_count
+
+    def get_coalesced_fields(self, dc_class):
+        """
+        Returns the field numbers of the dclass that are coalesced,
+        looked up through the dclass's parents once per dclass
+        """
+
+        coalesced_fields = self._coalesced_fields.get(dc_class.get_number())
+
+        if coalesced_fields is None:
+            coalesced_fields = set()
+            dc_names = set()
+            dc_classes = [dc_class]
+
+            while dc_classes:
+                parent_class = dc_classes.pop()
+                dc_names.add(parent_class.get_name())
+
+                for parent_index in xrange(parent_class.get_num_parents()):
+                    dc_classes.append(parent_class.get_parent(parent_index))
+
+            for dc_name, field_name in self._coalesce_fields:
+                if dc_name not in dc_names:
+                    continue
+
+                field = dc_class.get_field_by_name(field_name)
+
+                if not field:
+                    self.notify.warning('Cannot coalesce field: %s dclass: %s, unknown field!' % (
+                        field_name, dc_name))
+
+                    continue
+
+                coalesced_fields.add(field.get_number())
+
+            self._coalesced_fields[dc_class.get_number()] = coalesced_fields
+
+        return coalesced_fields
+
+    def is_coalesced_field(self, dc_class, field):
+        if not self._coalesce_fields:
+            return False
+
+        return field.get_number() in self.get_coalesced_fields(dc_class)
+
+    def add_coalesced_object(self, state_object):
+        self._coalesced_objects.add(state_object.do_id)
+
+    def remove_coalesced_object(self, state_object):
+        self._coalesced_objects.discard(state_object.do_id)
+
+    @property
+    def shard_count(self):
+        return self._shard_count
+
+    @property
+    def shard_index(self):
+        return self._shard_index
+
+    @property
+    def server_channel(self):
+        return self._server_channel
+
+    @property
+    def shard_channels(self):
+        """
+        The channels of every other state server shard
+        """
+
+        return self._shard_channels
+
+    @property
+    def watched_locations(self):
+        return self._watched_locations
+
+    @property
+    def shard_requests(self):
+        return self._shard_requests
+
+    @property
+    def held_objects(self):
+        return self._held_objects
+
+    def get_location_channel(self, location):
+        parent_id, zone_id = location
+        return self._location_channel + ((parent_id << 32) | zone_id) % self._location_channels
+
+    def has_local_object(self, do_id):
+        """
+        Returns whether the do_id belongs to this state server shard
+        """
+
+        return self._shard_count <= 1 or do_id % self._shard_count == self._shard_index
+
+    @property
+    def range_min(self):
+        return self._range_min
+
+    @property
+    def range_max(self):
+        return self._range_max
+
+    def has_range_channel(self, channel):
+        return self._range_min <= channel <= self._range_max and self._range_max > 0
+
+    def setup(self):
+        io.NetworkConnector.setup(self)
+
+        if self._server_channel != self.channel:
+            self.register_for_channel(self._server_channel)
+
+        if self._range_max > 0:
+            self.register_for_range(self._range_min, self._range_max)
+
+        if self._snapshot:
+            if self._snapshot_restore:
+                self._snapshot.restore()
+
+            if self._snapshot_interval > 0:
+                self.__snapshot_task = task_mgr.doMethodLater(self._snapshot_interval, self.__start_snapshot,
+                    self.get_unique_name('start-snapshot'), taskChain=task_chain)
+
+        if self._coalesce_fields:
+            self.__coalesce_task = task_mgr.doMethodLater(self._coalesce_interval, self.__flush_coalesced,
+                self.get_unique_name('flush-coalesced'), taskChain=task_chain)
+
+        if self._shard_count > 1:
+            self.__shard_request_task = task_mgr.doMethodLater(self._shard_request_timeout,
+                self.__expire_shard_requests, self.get_unique_name('expire-shard-requests'),
+                taskChain=task_chain)
+
+    def handle_snapshot(self):
+        """
+        Starts writing a snapshot in the background, unless one is being written already
+        """
+
+        if not self._snapshot or not self._snapshot.start():
+            return
+
+        self.__snapshot_write_task = task_mgr.add(self.__write_snapshot, self.get_unique_name(
+            'write-snapshot'), taskChain=task_chain)
+
+    def __start_snapshot(self, task):
+        self.handle_snapshot()
+        return task.again
+
+    def __write_snapshot(self, task):
+        if not self._snapshot.write():
+            return task.cont
+
+        self.__snapshot_write_task = None
+        return task.done
+
+    def __flush_coalesced(self, task):
+        """
+        Sends the latest value of every coalesced field
+        that was updated since the last flush
+        """
+
+        coalesced_objects, self._coalesced_objects = self._coalesced_objects, set()
+
+        for do_id in coalesced_objects:
+            state_object = self._object_manager.get_state_object(do_id)
+
+            if not state_object:
+                continue
+
+            # a waiting object keeps it's updates until the next flush...
+            if do_id in self._held_objects:
+                self._coalesced_objects.add(do_id)
+                continue
+
+            state_object.handle_flush_coalesced_updates()
+
+        return task.again
+
+    def handle_datagram(self, channel, sender, message_type, di):
+        if message_type == types.STATESERVER_ADD_SHARD:
+            self.handle_add_shard(sender, di)
+        elif message_type == types.STATESERVER_REMOVE_SHARD:
+            self.handle_remove_shard(sender)
+        elif message_type == types.STATESERVER_GET_SHARD_ALL:
+            self.handle_get_shard_list(sender, di)
+        elif message_type == types.STATESERVER_OBJECT_GENERATE_WITH_REQUIRED:
+            self.handle_generate(sender, False, di)
+        elif message_type == types.STATESERVER_OBJECT_GENERATE_WITH_REQUIRED_OTHER:
+            self.handle_generate(sender, True, di)
+        elif message_type == types.STATESERVER_OBJECT_UPDATE_FIELD:
+            self.handle_object_update_field(sender, channel, di)
+        elif message_type == types.STATESERVER_SET_AVATAR:
+            self.handle_set_avatar(sender, di)
+        elif message_type == types.STATESERVER_OBJECT_DELETE_RAM:
+            self.handle_delete_object(sender, di)
+        elif message_type == types.STATESERVER_ADD_INTEREST:
+            self.handle_add_interest(sender, di)
+        elif message_type == types.STATESERVER_REMOVE_INTEREST:
+            self.handle_remove_interest(sender, di)
+        elif message_type == types.STATESERVER_SET_INTEREST:
+            self.handle_set_interest(sender, di)
+        elif message_type == types.STATESERVER_SHARD_OBJECT_LOCATION:
+            self.handle_shard_object_location(sender, di)
+        elif message_type == types.STATESERVER_SHARD_OBJECT_REMOVE:
+            self.handle_shard_object_remove(sender, di)
+        elif message_type == types.STATESERVER_SHARD_QUERY_LOCATION:
+            self.handle_shard_query_location(sender, di)
+        elif message_type == types.STATESERVER_SHARD_CHANGE_ZONE:
+            self.handle_shard_change_zone(sender, di)
+        elif message_type == types.STATESERVER_SHARD_QUERY_RESP:
+            self.handle_shard_query_resp(sender, di)
+        else:
+            state_object = self._object_manager.get_state_object(channel)
+
+            if not state_object:
+                self.notify.debug('Received an unknown message type: %d from channel: %d!' % (
+                    message_type, sender))
+
+                return
+
+            if channel in self._held_objects:
+                self.hold_datagram(channel, state_object.handle_internal_datagram,
+                    (sender, message_type), di)
+
+                return
+
+            state_object.handle_internal_datagram(sender, message_type, di)
+
+    def handle_add_shard(self, sender, di):
+        self._shard_manager.add_shard(sender, di.getString(), di.get_uint32())
+
+    def handle_remove_shard(self, sender):
+        shard = self._shard_manager.get_shard(sender)
+
+        if not shard:
+            self.notify.warning('Cannot remove shard: %d, does not exist!' % (
+                sender))
+
+            return
+
+        self.handle_delete_objects(self._object_manager.get_parent_objects(shard.channel))
+        self._shard_manager.remove_shard(shard.channel)
+
+    def handle_delete_objects(self, state_objects):
+        """
+        Removes many objects at once, the deletes are grouped by location
+        so each owner is sent them in as few datagrams as possible
+        """
+
+        locations = {}
+
+        for state_object in state_objects:
+            locations.setdefault(state_object.location, []).append(state_object)
+
+        # work out who needs to be told before anything is removed,
+        # while the owners of the removed objects are still indexed...
+        deletes = []
+
+        for location, location_objects in locations.items():
+            channels = location_objects[0].get_location_owners(location)
+
+            if not channels:
+                continue
+
+            # the objects nobody owns are deleted for every owner in the location
+            # at once, an owned object is never deleted for it's own owner...
+            do_ids = [state_object.do_id for state_object in location_objects if \
+                not state_object.owner_id]
+
+            if do_ids:
+                deletes.append((channels, do_ids))
+
+            owned_objects = [state_object for state_object in location_objects if \
+                state_object.owner_id]
+
+            for channel in channels:
+                do_ids = [state_object.do_id for state_object in owned_objects if \
+                    state_object.owner_id != channel]
+
+                if do_ids:
+                    deletes.append(([channel], do_ids))
+
+        for state_object in state_objects:
+            self._object_manager.remove_state_object(state_object, send_delete=False)
+
+        for channels, do_ids in deletes:
+            self.handle_send_delete_multiple(channels, do_ids)
+
+        self.handle_shard_objects_removed(state_objects)
+
+    def handle_send_delete_multiple(self, channels, do_ids):
+        for index in xrange(0, len(do_ids), self._delete_batch_size):
+            datagram = io.NetworkDatagram()
+
+            for do_id in do_ids[index:index + self._delete_batch_size]:
+                datagram.add_uint64(do_id)
+
+            self.handle_send_connection_multi_datagram(channels, self.channel,
+                types.STATESERVER_OBJECT_DELETE_RAM, datagram)
+
+    def handle_get_shard_list(self, sender, di):
+        # every state server shard knows of all the AI shards,
+        # but only the first one answers for them...
+        if self._shard_index:
+            return
+
+        datagram = io.NetworkDatagram()
+        datagram.add_header(sender, self.channel,
+            types.STATESERVER_GET_SHARD_ALL_RESP)
+
+        datagram.add_uint16(len(self._shard_manager.shards))
+
+        for shard in self._shard_manager.get_shards():
+            datagram.add_uint32(shard.channel)
+            datagram.add_string(shard.name)
+            datagram.add_uint32(shard.population)
+
+        self.handle_send_connection_datagram(datagram)
+
+    def handle_generate(self, sender, has_other, di):
+        do_id = di.get_uint32()
+        parent_id = di.get_uint32()
+        zone_id = di.get_uint32()
+        dc_id = di.get_uint16()
+
+        if not self.has_local_object(do_id):
+            return
+
+        if self._object_manager.has_state_object(do_id):
+            self.notify.debug("Failed to generate an already existing object with do_id: %d!" % (
+                do_id))
+
+            return
+
+        dc_class = self.dc_loader.dclasses_by_number.get(dc_id)
+
+        if not dc_class:
+            self.notify.warning("Failed to generate an object with do_id: %d, no dclass found for dc_id: %d!" % (
+                do_id, dc_id))
+
+            return
+
+        state_object = StateObject(self, do_id, parent_id, zone_id, dc_class, has_other, di)
+        self._object_manager.add_state_object(state_object)
 
     def handle_object_update_field(self, sender, channel, di):
         do_id = di.get_uint32()
 
+        if not self.has_local_object(do_id):
+            return
+
         if not di.get_remaining_size():
             self.notify.warning('Cannot handle an field update for object: %d, truncated datagram!' % (
                 do_id))
@@ -655,6 +2014,10 @@ class StateServer(io.NetworkConnector):
 
             return
 
+        if do_id in self._held_objects:
+            self.hold_datagram(do_id, state_object.handle_update_field, (sender, channel), di)
+            return
+
         state_object.handle_update_field(sender, channel, di)
 
     def handle_set_avatar(self, sender, di):
@@ -680,6 +2043,9 @@ class StateServer(io.NetworkConnector):
 
         avatar_object = self._object_manager.get_state_object(avatar_id)
 
+        if not avatar_object:
+            return
+
         datagram = io.NetworkDatagram()
         datagram.add_header(sender, self.channel,
             types.STATESERVER_SET_AVATAR_RESP)
@@ -691,6 +2057,10 @@ class StateServer(io.NetworkConnector):
 
     def handle_delete_object(self, sender, di):
         do_id = di.get_uint64()
+
+        if not self.has_local_object(do_id):
+            return
+
         state_object = self._object_manager.get_state_object(do_id)
 
         if not state_object:
@@ -699,4 +2069,478 @@ class StateServer(io.NetworkConnector):
 
             return
 
-        self._object_manager.remove_state_object(state_object)
+        self.run_object_action(do_id, self._object_manager.remove_state_object, state_object)
+
+    def read_interest(self, di):
+        owner_id = di.get_uint64()
+        locations = set()
+
+        for _ in xrange(di.get_uint16()):
+            parent_id = di.get_uint32()
+            zone_id = di.get_uint32()
+            locations.add((parent_id, zone_id))
+
+        return owner_id, locations
+
+    def can_change_interest(self, sender, owner_id):
+        """
+        Returns True if the sender may change the owner's interest set, only the
+        owner's own client agent connection and the AI shards are allowed to
+        """
+
+        if sender == owner_id or self._shard_manager.has_shard(sender):
+            return True
+
+        self.notify.warning('Cannot change interest for owner: %d, sender: %d is not allowed to!' % (
+            owner_id, sender))
+
+        return False
+
+    def handle_add_interest(self, sender, di):
+        owner_id, locations = self.read_interest(di)
+
+        if not self.can_change_interest(sender, owner_id):
+            return
+
+        self.handle_change_interest(owner_id, self._object_manager.get_interest(owner_id) | locations)
+
+    def handle_remove_interest(self, sender, di):
+        owner_id, locations = self.read_interest(di)
+
+        if not self.can_change_interest(sender, owner_id):
+            return
+
+        self.handle_change_interest(owner_id, self._object_manager.get_interest(owner_id) - locations)
+
+    def handle_set_interest(self, sender, di):
+        owner_id, locations = self.read_interest(di)
+
+        if not self.can_change_interest(sender, owner_id):
+            return
+
+        self.handle_change_interest(owner_id, locations)
+
+    def handle_change_interest(self, owner_id, locations):
+        """
+        Replaces the owner's interest set, generating and deleting only the objects
+        in the locations the owner could not see before or can no longer see
+        """
+
+        old_locations = self._object_manager.get_interest(owner_id)
+        locations = frozenset(locations)
+
+        if not owner_id or locations == old_locations:
+            return
+
+        # the owner may already see a location through it's own objects,
+        # in which case gaining or losing interest in it changes nothing...
+        generates = []
+
+        for location in locations - old_locations:
+            if self._object_manager.can_owner_see(owner_id, location):
+                continue
+
+            for state_object in self._object_manager.get_location_objects(location):
+                if state_object.owner_id != owner_id:
+                    generates.append(state_object)
+
+        self._object_manager.set_interest(owner_id, locations)
+
+        deletes = []
+
+        for location in old_locations - locations:
+            if self._object_manager.can_owner_see(owner_id, location):
+                continue
+
+            for state_object in self._object_manager.get_location_objects(location):
+                if state_object.owner_id != owner_id:
+                    deletes.append(state_object.do_id)
+
+        if deletes:
+            self.handle_send_delete_multiple([owner_id], deletes)
+
+        for state_object in generates:
+            state_object.handle_send_generate(owner_id)
+
+        self._interest_messages_sent += len(deletes) + len(generates)
+
+    def run_object_action(self, do_id, function, *args):
+        """
+        Calls the function right away, or once the object is done waiting
+        on the other shards if it is waiting on them right now
+        """
+
+        held = self._held_objects.get(do_id)
+
+        if held is None:
+            function(*args)
+            return
+
+        held[1].append((function, args))
+
+    def hold_datagram(self, do_id, handler, args, di):
+        """
+        Keeps the rest of a message for a waiting object,
+        it is handed to the handler once the object is released
+        """
+
+        datagram = io.NetworkDatagram()
+        datagram.append_data(di.get_remaining_bytes())
+        self.run_object_action(do_id, self.__handle_held_datagram, handler, args, datagram)
+
+    def __handle_held_datagram(self, handler, args, datagram):
+        handler(*(args + (io.NetworkDatagramIterator(datagram),)))
+
+    def __hold_object(self, do_id, request):
+        held = self._held_objects.get(do_id)
+
+        if held is None:
+            held = self._held_objects[do_id] = [0, []]
+
+        held[0] += 1
+        request.do_ids.append(do_id)
+
+    def __release_object(self, do_id):
+        held = self._held_objects.get(do_id)
+
+        if held is None:
+            return
+
+        held[0] -= 1
+
+        # an action may make the object wait again, or delete it,
+        # in which case the actions after it are left where they are...
+        while held[0] <= 0 and held[1] and self._held_objects.get(do_id) is held:
+            function, args = held[1].pop(0)
+            function(*args)
+
+        if held[0] <= 0 and not held[1] and self._held_objects.get(do_id) is held:
+            del self._held_objects[do_id]
+
+    def __add_shard_request(self, location=None):
+        self._shard_request_id = (self._shard_request_id + 1) & 0xffffffff
+
+        request = ShardRequest(self._shard_request_id, self._shard_channels, location)
+        self._shard_requests[request.request_id] = request
+
+        return request
+
+    def __complete_shard_request(self, request):
+        del self._shard_requests[request.request_id]
+
+        if request.location and self._location_syncs.get(request.location) is request:
+            del self._location_syncs[request.location]
+
+        for do_id in request.do_ids:
+            self.__release_object(do_id)
+
+    def __expire_shard_requests(self, task):
+        now = time.time()
+
+        for request in self._shard_requests.values():
+            if now - request.timestamp < self._shard_request_timeout:
+                continue
+
+            self.notify.warning('Shard request: %d timed out, no answer from shards: %s!' % (
+                request.request_id, ', '.join(str(channel) for channel in sorted(request.channels))))
+
+            self.__complete_shard_request(request)
+
+        return task.again
+
+    def __watch_location(self, location, state_object):
+        """
+        Listens for the owned objects of the other shards in the location,
+        the first time one of our objects is there we ask them what they have
+        """
+
+        count = self._watched_locations.get(location, 0)
+        self._watched_locations[location] = count + 1
+
+        if not count:
+            self.register_for_channel(self.get_location_channel(location))
+
+            request = self._location_syncs[location] = self.__add_shard_request(location)
+
+            datagram = io.NetworkDatagram()
+            datagram.add_uint32(request.request_id)
+            datagram.add_uint32(location[0])
+            datagram.add_uint32(location[1])
+
+            self.handle_send_connection_multi_datagram(self._shard_channels, self.channel,
+                types.STATESERVER_SHARD_QUERY_LOCATION, datagram)
+
+        # the object's broadcasts have to wait until we know
+        # who owns the objects around it...
+        request = self._location_syncs.get(location)
+
+        if request:
+            self.__hold_object(state_object.do_id, request)
+
+    def __unwatch_location(self, location):
+        count = self._watched_locations.get(location, 0)
+
+        if count > 1:
+            self._watched_locations[location] = count - 1
+            return
+
+        self._watched_locations.pop(location, None)
+        self.unregister_for_channel(self.get_location_channel(location))
+
+        for do_id in list(self._object_manager.get_location_do_ids(location)):
+            self._object_manager.remove_remote_object(do_id)
+
+    def handle_shard_object_changed(self, state_object, old_location, old_owner_id):
+        """
+        Tells the other shards with objects in our object's old and new location
+        where it is and who owns it now, if it is or was owned by anybody
+        """
+
+        if self._shard_count <= 1:
+            return
+
+        location = state_object.location
+        channels = [self.get_location_channel(location)]
+
+        if old_location and old_location != location:
+            channels.append(self.get_location_channel(old_location))
+
+        if state_object.owner_id or old_owner_id:
+            datagram = io.NetworkDatagram()
+            datagram.add_uint32(state_object.do_id)
+            datagram.add_uint32(state_object.parent_id)
+            datagram.add_uint32(state_object.zone_id)
+            datagram.add_uint64(state_object.owner_id)
+
+            self.handle_send_connection_multi_datagram(list(set(channels)), self.channel,
+                types.STATESERVER_SHARD_OBJECT_LOCATION, datagram)
+
+        if old_location == location:
+            return
+
+        if old_location:
+            self.__unwatch_location(old_location)
+
+        self.__watch_location(location, state_object)
+
+    def handle_shard_objects_removed(self, state_objects):
+        if self._shard_count <= 1:
+            return
+
+        channels = {}
+
+        for state_object in state_objects:
+            self._held_objects.pop(state_object.do_id, None)
+            self.__unwatch_location(state_object.location)
+
+            if state_object.owner_id:
+                channels.setdefault(self.get_location_channel(state_object.location), []).append(
+                    state_object.do_id)
+
+        for channel, do_ids in channels.items():
+            for index in xrange(0, len(do_ids), self._delete_batch_size):
+                datagram = io.NetworkDatagram()
+
+                for do_id in do_ids[index:index + self._delete_batch_size]:
+                    datagram.add_uint32(do_id)
+
+                self.handle_send_connection_multi_datagram([channel], self.channel,
+                    types.STATESERVER_SHARD_OBJECT_REMOVE, datagram)
+
+    def handle_send_shard_change_zone(self, state_object):
+        """
+        Asks the other shards to delete and generate their objects for the owner of our
+        object that changed zone, returns the do_ids they want generated after our response
+        """
+
+        if self._shard_count <= 1 or not state_object.owner_id:
+            return []
+
+        request = self.__add_shard_request()
+        self.__hold_object(state_object.do_id, request)
+
+        old_parent_id, old_zone_id = state_object.old_location
+
+        datagram = io.NetworkDatagram()
+        datagram.add_uint32(request.request_id)
+        datagram.add_uint32(state_object.do_id)
+        datagram.add_uint64(state_object.owner_id)
+        datagram.add_uint32(old_parent_id)
+        datagram.add_uint32(old_zone_id)
+        datagram.add_uint32(state_object.parent_id)
+        datagram.add_uint32(state_object.zone_id)
+
+        self.handle_send_connection_multi_datagram(self._shard_channels, self.channel,
+            types.STATESERVER_SHARD_CHANGE_ZONE, datagram)
+
+        return request.generates
+
+    def handle_send_generates(self, channel, do_ids, quietZone=False):
+        for do_id in do_ids:
+            state_object = self._object_manager.get_state_object(do_id)
+
+            if not state_object:
+                continue
+
+            if (state_object.zone_id == OTP_ZONE_ID_OLD_QUIET_ZONE) != quietZone:
+                continue
+
+            state_object.handle_send_generate(channel)
+
+    def handle_send_remote_generates(self, channel, do_ids):
+        # only the shard that owns an object has it's fields,
+        # so ask each object to generate itself for the channel...
+        for do_id in do_ids:
+            datagram = io.NetworkDatagram()
+            datagram.add_header(do_id, self.channel,
+                types.STATESERVER_OBJECT_SEND_GENERATE)
+
+            datagram.add_uint64(channel)
+            self.handle_send_connection_datagram(datagram)
+
+    def handle_shard_object_location(self, sender, di):
+        do_id = di.get_uint32()
+
+        # a location channel also delivers our own messages back to us...
+        if sender == self.channel or self.has_local_object(do_id):
+            return
+
+        parent_id = di.get_uint32()
+        zone_id = di.get_uint32()
+        owner_id = di.get_uint64()
+
+        # several locations may share a channel, and the object may have left
+        # for a location we have no objects in or may no longer be owned...
+        if not owner_id or (parent_id, zone_id) not in self._watched_locations:
+            self._object_manager.remove_remote_object(do_id)
+            return
+
+        self._object_manager.add_remote_object(RemoteStateObject(self, do_id, parent_id,
+            zone_id, owner_id))
+
+    def handle_shard_object_remove(self, sender, di):
+        if sender == self.channel:
+            return
+
+        while di.get_remaining_size():
+            self._object_manager.remove_remote_object(di.get_uint32())
+
+    def handle_shard_query_location(self, sender, di):
+        request_id = di.get_uint32()
+        location = (di.get_uint32(), di.get_uint32())
+
+        state_objects = [state_object for state_object in self._object_manager.get_location_objects(
+            location) if state_object.owner_id]
+
+        datagram = io.NetworkDatagram()
+        datagram.add_header(sender, self.channel,
+            types.STATESERVER_SHARD_QUERY_RESP)
+
+        datagram.add_uint32(request_id)
+        datagram.add_uint16(len(state_objects))
+
+        for state_object in state_objects:
+            datagram.add_uint32(state_object.do_id)
+            datagram.add_uint64(state_object.owner_id)
+
+        datagram.add_uint16(0)
+        self.handle_send_connection_datagram(datagram)
+
+    def handle_shard_change_zone(self, sender, di):
+        request_id = di.get_uint32()
+        do_id = di.get_uint32()
+        owner_id = di.get_uint64()
+        old_location = (di.get_uint32(), di.get_uint32())
+        location = (di.get_uint32(), di.get_uint32())
+
+        # our record of the object, if we have one, was moved before this
+        # request was sent. the owner sees through it no longer, as on it's own shard...
+        remote_object = self._object_manager.get_remote_object(do_id)
+
+        old_visible = self._object_manager.get_visible_objects(old_location)
+        new_visible = self._object_manager.get_visible_objects(location)
+
+        deletes = self._object_manager.get_unseen_objects(owner_id, old_visible - new_visible,
+            exclude=remote_object)
+
+        generates = self._object_manager.get_unseen_objects(owner_id, new_visible - old_visible,
+            exclude=remote_object)
+
+        if deletes:
+            self.handle_send_delete_multiple([owner_id], list(deletes))
+
+        self.handle_send_generates(owner_id, generates, quietZone=True)
+
+        # the rest are generated once the owner has been told about
+        # the zone change, by the shard that sent the request...
+        generates = [do_id for do_id in generates if self._object_manager.get_state_object(
+            do_id).zone_id != OTP_ZONE_ID_OLD_QUIET_ZONE]
+
+        datagram = io.NetworkDatagram()
+        datagram.add_header(sender, self.channel,
+            types.STATESERVER_SHARD_QUERY_RESP)
+
+        datagram.add_uint32(request_id)
+        datagram.add_uint16(0)
+        datagram.add_uint16(len(generates))
+
+        for do_id in generates:
+            datagram.add_uint32(do_id)
+
+        self.handle_send_connection_datagram(datagram)
+
+    def handle_shard_query_resp(self, sender, di):
+        request = self._shard_requests.get(di.get_uint32())
+
+        if not request or sender not in request.channels:
+            self.notify.debug('Received an unexpected shard response from channel: %d!' % (
+                sender))
+
+            return
+
+        # records from an older request for a location we since left
+        # and came back to may be stale, the newest request has them all...
+        location = request.location
+        current = location in self._watched_locations and self._location_syncs.get(location) is request
+
+        for _ in xrange(di.get_uint16()):
+            do_id = di.get_uint32()
+            owner_id = di.get_uint64()
+
+            if current:
+                self._object_manager.add_remote_object(RemoteStateObject(self, do_id,
+                    location[0], location[1], owner_id))
+
+        request.generates.extend(di.get_uint32() for _ in xrange(di.get_uint16()))
+        request.channels.discard(sender)
+
+        if not request.channels:
+            self.__complete_shard_request(request)
+
+    def shutdown(self):
+        if self.__coalesce_task:
+            task_mgr.remove(self.__coalesce_task)
+
+        self.__coalesce_task = None
+        self._coalesced_objects = set()
+
+        if self.__shard_request_task:
+            task_mgr.remove(self.__shard_request_task)
+
+        self.__shard_request_task = None
+
+        if self.__snapshot_task:
+            task_mgr.remove(self.__snapshot_task)
+
+        if self.__snapshot_write_task:
+            task_mgr.remove(self.__snapshot_write_task)
+
+        self.__snapshot_task = None
+        self.__snapshot_write_task = None
+
+        # write out everything we have so that we can be
+        # warm restarted with the same objects...
+        if self._snapshot:
+            self._snapshot.write_all()
+
+        io.NetworkConnector.shutdown(self)
@@ -0,0 +1,1095 @@
+"""
+ * Copyright (C) Caleb Marshall - All Rights Reserved
+ * Written by Caleb Marshall <anythingtechpro@gmail.com>, August 17th, 2017
+ * Licensing information can found in 'LICENSE', which is part of this source code package.
+"""
+
+import time
+import errno
+import select
+import socket
+import struct
+import threading
+import collections
+
+from panda3d.core import QueuedConnectionManager, QueuedConnectionListener, QueuedConnectionReader, \
+    ConnectionWriter, PointerToConnection, NetAddress, Datagram
+
+from direct.directnotify.DirectNotifyGlobal import directNotify
+
+notify = directNotify.newCategory('NetworkTransport')
+
+WOULD_BLOCK_ERRORS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+PRESSURE_BLOCKED = 1
+PRESSURE_UNBLOCKED = 2
+PRESSURE_OVERFLOWED = 3
+
+class NetworkOutbound(object):
+    """
+    The outbound buffer of a connection, datagrams accumulate here
+    until the transport flushes all of them in a single write...
+    """
+
+    def __init__(self):
+        self._messages = []
+        self._size = 0
+        self._pending = 0
+
+        self._datagram_count = 0
+        self._write_count = 0
+        self._byte_count = 0
+        self._dropped_count = 0
+
+        self._blocked = False
+        self._blocked_time = 0
+        self._overflowed = False
+
+    @property
+    def messages(self):
+        return self._messages
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def pending(self):
+        """
+        The number of bytes already written that the socket has not yet accepted
+        """
+
+        return self._pending
+
+    @pending.setter
+    def pending(self, pending):
+        self._pending = pending
+
+    @property
+    def queued_bytes(self):
+        return self._size + self._pending
+
+    @property
+    def queued_messages(self):
+        return len(self._messages)
+
+    @property
+    def dropped_count(self):
+        return self._dropped_count
+
+    @dropped_count.setter
+    def dropped_count(self, dropped_count):
+        self._dropped_count = dropped_count
+
+    @property
+    def blocked(self):
+        return self._blocked
+
+    @blocked.setter
+    def blocked(self, blocked):
+        self._blocked = blocked
+        self._blocked_time = time.time() if blocked else 0
+
+    @property
+    def blocked_time(self):
+        return self._blocked_time
+
+    @property
+    def overflowed(self):
+        return self._overflowed
+
+    @overflowed.setter
+    def overflowed(self, overflowed):
+        self._overflowed = overflowed
+
+    @property
+    def datagram_count(self):
+        return self._datagram_count
+
+    @property
+    def write_count(self):
+        return self._write_count
+
+    @property
+    def byte_count(self):
+        return self._byte_count
+
+    @property
+    def batching_ratio(self):
+        """
+        The average number of datagrams sent per write
+        """
+
+        if not self._write_count:
+            return 0.0
+
+        return float(self._datagram_count) / self._write_count
+
+    def append(self, message):
+        self._messages.append(message)
+        self._size += len(message)
+
+    def take(self):
+        """
+        Removes all of the queued messages and counts them as one write
+        """
+
+        messages = self._messages
+
+        self._datagram_count += len(messages)
+        self._write_count += 1
+        self._byte_count += self._size
+
+        self._messages = []
+        self._size = 0
+
+        return messages
+
+    def clear(self):
+        """
+        Discards all of the queued messages that were not yet written
+        """
+
+        self._dropped_count += len(self._messages)
+        self._messages = []
+        self._size = 0
+        self._overflowed = False
+
+class NetworkTransport(object):
+    """
+    The outbound buffering, back-pressure and reset reporting shared by the
+    transports underneath the network listener and connector. the transports
+    themselves open the sockets and read and write the framed datagrams...
+    """
+
+    notify = directNotify.newCategory('NetworkTransport')
+
+    def __init__(self, capped=True):
+        self._capped = capped
+        self._header_size = config.GetInt('tcp-header-size', 2)
+
+        if self._header_size == 2:
+            self._header = struct.Struct('<H')
+        elif self._header_size == 4:
+            self._header = struct.Struct('<I')
+        else:
+            self.notify.error('Unsupported tcp-header-size: %d, expected 2 or 4!' % (
+                self._header_size))
+
+        self._max_length = (1 << (self._header_size * 8)) - 1
+        self._flush_size = config.GetInt('network-outbound-flush-size', 65536)
+
+        self._max_bytes = config.GetInt('network-send-max-bytes', 4194304)
+        self._max_messages = config.GetInt('network-send-max-messages', 16384)
+        self._high_watermark = config.GetInt('network-send-high-watermark', 1048576)
+        self._low_watermark = config.GetInt('network-send-low-watermark', 262144)
+
+        self._outbounds = {}
+        self._dirty = set()
+        self._blocked = {}
+        self._resets = collections.deque()
+        self._pressure_events = collections.deque()
+
+        self._copied_bytes = 0
+
+        # the network tasks run on the task chain's threads, so a send can
+        # race the flush task or the poller writing out the same buffer...
+        self._lock = threading.RLock()
+
+    def add_connection(self, connection):
+        """
+        Starts reading datagrams from the connection
+        """
+
+        with self._lock:
+            self._outbounds.setdefault(connection, NetworkOutbound())
+
+    def remove_connection(self, connection):
+        """
+        Stops reading datagrams from the connection
+        """
+
+        with self._lock:
+            self._outbounds.pop(connection, None)
+            self._dirty.discard(connection)
+            self._blocked.pop(connection, None)
+
+    def close_connection(self, connection):
+        """
+        Flushes anything still queued for the connection and closes it
+        """
+
+        self.flush_connection(connection)
+
+    def reset_connection_available(self):
+        return bool(self._resets)
+
+    def get_reset_connection(self):
+        """
+        Returns the next connection that was reset or None
+        """
+
+        if not self._resets:
+            return None
+
+        return self._resets.popleft()
+
+    @property
+    def capped(self):
+        """
+        Whether the connections of this transport are evicted once their
+        send queue reaches it's cap, rather than being written through
+        """
+
+        return self._capped
+
+    @property
+    def copied_bytes(self):
+        """
+        The number of bytes copied on the way out, when a message is taken
+        from it's datagram and when it is framed into a connection's write
+        """
+
+        return self._copied_bytes
+
+    def get_outbound(self, connection):
+        return self._outbounds.get(connection)
+
+    def get_blocked_connections(self):
+        """
+        Returns (connection, outbound) pairs for every connection
+        that is currently above the high watermark
+        """
+
+        with self._lock:
+            return self._blocked.items()
+
+    def pressure_event_available(self):
+        return bool(self._pressure_events)
+
+    def get_pressure_event(self):
+        """
+        Returns the next (connection, event) back-pressure change or None
+        """
+
+        if not self._pressure_events:
+            return None
+
+        return self._pressure_events.popleft()
+
+    def clear_outbound(self, connection):
+        """
+        Discards the datagrams queued for the connection that were not yet written
+        """
+
+        with self._lock:
+            outbound = self._outbounds.get(connection)
+
+            if not outbound:
+                return
+
+            outbound.clear()
+            self.update_pressure(connection)
+
+    def update_pressure(self, connection):
+        """
+        Moves the connection between the blocked and unblocked states
+        as it's queued data crosses the high and low watermarks
+        """
+
+        with self._lock:
+            outbound = self._outbounds.get(connection)
+
+            if not outbound:
+                return
+
+            queued_bytes = outbound.queued_bytes
+
+            if not outbound.blocked and queued_bytes >= self._high_watermark:
+                outbound.blocked = True
+                self._blocked[connection] = outbound
+                self._pressure_events.append((connection, PRESSURE_BLOCKED))
+            elif outbound.blocked and queued_bytes <= self._low_watermark:
+                outbound.blocked = False
+                self._blocked.pop(connection, None)
+                self._pressure_events.append((connection, PRESSURE_UNBLOCKED))
+
+    def send(self, datagram, connection):
+        """
+        Queues a datagram in the connection's outbound buffer, the buffer is
+        written once it reaches the flush size or when the transport is
+        flushed, returns False on failure
+        """
+
+        return self.send_message(datagram.get_message(), connection, True)
+
+    def send_message(self, message, connection, copied=False):
+        """
+        Queues a message that was already taken from it's datagram, so that
+        one message can be queued for many connections without copying it
+        again. copied tells if the message was taken for this send alone
+        """
+
+        if len(message) > self._max_length:
+            self.notify.warning('Cannot send datagram of %d bytes, exceeds the tcp-header-size limit!' % (
+                len(message)))
+
+            return False
+
+        with self._lock:
+            if copied:
+                self._copied_bytes += len(message)
+
+            outbound = self._outbounds.get(connection)
+
+            if not outbound:
+                return False
+
+            overflowed = outbound.queued_bytes + len(message) > self._max_bytes or \
+                outbound.queued_messages >= self._max_messages
+
+            # a capped connection whose queue is at it's cap is reported so
+            # that it can be evicted, nothing more is queued toward it until
+            # it's outbound is cleared for the disconnect...
+            if self._capped and (overflowed or outbound.overflowed):
+                outbound.dropped_count += 1
+
+                if not outbound.overflowed:
+                    outbound.overflowed = True
+                    self._pressure_events.append((connection, PRESSURE_OVERFLOWED))
+
+                return True
+
+            outbound.append(message)
+
+            # the internal links never lose a datagram, past the cap the
+            # queue is written straight through and the socket's own
+            # buffering holds it until the other end catches up...
+            if overflowed or outbound.size >= self._flush_size:
+                return self.flush_connection(connection)
+
+            self._dirty.add(connection)
+            return True
+
+    def flush(self):
+        """
+        Writes out the outbound buffer of every connection with queued data
+        """
+
+        with self._lock:
+            dirty = self._dirty
+            self._dirty = set()
+
+            for connection in dirty:
+                self.flush_connection(connection)
+
+    def flush_connection(self, connection):
+        """
+        Writes out the outbound buffer of a single connection, a failed
+        write is reported the same way as a reset connection
+        """
+
+        with self._lock:
+            outbound = self._outbounds.get(connection)
+
+            if not outbound or not outbound.messages:
+                return True
+
+            self._copied_bytes += outbound.size
+
+            if self.write(connection, outbound.take()):
+                self.update_pressure(connection)
+                return True
+
+            # the write may have already reported the connection as reset...
+            if connection in self._outbounds:
+                self.remove_connection(connection)
+                self._resets.append(connection)
+
+            return False
+
+    def keep_awake(self):
+        """
+        Tells the transport that work is still pending, so that
+        it must not block waiting for socket readiness this tick
+        """
+
+class NetworkPandaTransport(NetworkTransport):
+    """
+    A transport built on panda's QueuedConnectionManager, the sockets
+    are polled once per tick whether or not they are ready...
+    """
+
+    def __init__(self, capped=True):
+        NetworkTransport.__init__(self, capped)
+
+        self._manager = QueuedConnectionManager()
+        self._listener = QueuedConnectionListener(self._manager, 0)
+        self._reader = QueuedConnectionReader(self._manager, 0)
+        self._writer = ConnectionWriter(self._manager, 0)
+
+        # we frame the datagrams ourselves so that a whole
+        # outbound buffer can be handed to the writer at once...
+        self._writer.set_raw_mode(True)
+
+    def open_server(self, address, port, backlog):
+        rendezvous = self._manager.open_TCP_server_rendezvous(address, port, backlog)
+
+        if rendezvous:
+            self._listener.add_connection(rendezvous)
+
+        return rendezvous
+
+    def close_server(self, rendezvous):
+        self._listener.remove_connection(rendezvous)
+        self._manager.close_connection(rendezvous)
+
+    def open_client(self, address, port, timeout):
+        return self._manager.open_TCP_client_connection(address, port, timeout)
+
+    def add_connection(self, connection):
+        NetworkTransport.add_connection(self, connection)
+        self._reader.add_connection(connection)
+
+    def remove_connection(self, connection):
+        NetworkTransport.remove_connection(self, connection)
+        self._reader.remove_connection(connection)
+
+    def close_connection(self, connection):
+        NetworkTransport.close_connection(self, connection)
+        self._manager.close_connection(connection)
+
+    def new_connection_available(self):
+        return self._listener.new_connection_available()
+
+    def get_new_connection(self):
+        rendezvous = PointerToConnection()
+        address = NetAddress()
+        connection = PointerToConnection()
+
+        if not self._listener.get_new_connection(rendezvous, address, connection):
+            return None
+
+        return rendezvous, address, connection.p()
+
+    def data_available(self):
+        return self._reader.data_available()
+
+    def get_data(self, datagram):
+        if not self._reader.get_data(datagram):
+            return None
+
+        return datagram.get_connection()
+
+    def reset_connection_available(self):
+        return NetworkTransport.reset_connection_available(self) or \
+            self._manager.reset_connection_available()
+
+    def get_reset_connection(self):
+        if NetworkTransport.reset_connection_available(self):
+            return NetworkTransport.get_reset_connection(self)
+
+        connection = PointerToConnection()
+
+        if not self._manager.get_reset_connection(connection):
+            return None
+
+        return connection.p()
+
+    def write(self, connection, messages):
+        datagram = Datagram()
+
+        for message in messages:
+            datagram.append_data(self._header.pack(len(message)))
+            datagram.append_data(message)
+
+        return self._writer.send(datagram, connection)
+
+class NetworkSelectPoller(object):
+    """
+    Waits on the sockets of every select transport in the process at once,
+    the poll task blocks until a socket is ready or the poll timeout expires...
+    """
+
+    notify = directNotify.newCategory('NetworkSelectPoller')
+
+    def __init__(self):
+        self._timeout = config.GetInt('network-poll-timeout', 10) / 1000.0
+
+        self._callbacks = {}
+        self._writable = set()
+        self._awake = False
+
+        if hasattr(select, 'epoll'):
+            self._epoll = select.epoll()
+        else:
+            self._epoll = None
+
+        self.__poll_task = None
+
+    @property
+    def timeout(self):
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, timeout):
+        self._timeout = timeout
+
+    def setup(self):
+        if self.__poll_task:
+            return
+
+        self.__poll_task = task_mgr.add(self.__poll, 'NetworkSelectPoller-poll',
+            sort=-10, taskChain=task_chain)
+
+    def register(self, fileno, callback):
+        """
+        Calls callback(readable, writable) whenever the socket is ready
+        """
+
+        self._callbacks[fileno] = callback
+
+        if self._epoll:
+            self._epoll.register(fileno, select.EPOLLIN)
+
+        self.setup()
+
+    def unregister(self, fileno):
+        if fileno not in self._callbacks:
+            return
+
+        del self._callbacks[fileno]
+        self._writable.discard(fileno)
+
+        if self._epoll:
+            try:
+                self._epoll.unregister(fileno)
+            except (IOError, OSError, ValueError):
+                pass
+
+    def set_writable(self, fileno, writable):
+        """
+        Enables or disables waiting for the socket to become writable
+        """
+
+        if fileno not in self._callbacks or writable == (fileno in self._writable):
+            return
+
+        if writable:
+            self._writable.add(fileno)
+        else:
+            self._writable.discard(fileno)
+
+        if self._epoll:
+            self._epoll.modify(fileno, select.EPOLLIN | (select.EPOLLOUT if writable else 0))
+
+    def keep_awake(self):
+        self._awake = True
+
+    def poll(self, timeout):
+        """
+        Waits up to timeout seconds for socket readiness and runs
+        the callbacks of the ready sockets
+        """
+
+        if self._epoll:
+            try:
+                events = self._epoll.poll(timeout)
+            except (IOError, OSError) as e:
+                if e.errno == errno.EINTR:
+                    return
+
+                raise
+
+            for fileno, event in events:
+                callback = self._callbacks.get(fileno)
+
+                if not callback:
+                    continue
+
+                callback(bool(event & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR)),
+                    bool(event & select.EPOLLOUT))
+
+            return
+
+        if not self._callbacks:
+            time.sleep(timeout)
+            return
+
+        try:
+            readable, writable, _ = select.select(self._callbacks.keys(), list(self._writable),
+                [], timeout)
+        except (select.error, IOError, OSError) as e:
+            if e.args[0] == errno.EINTR:
+                return
+
+            raise
+
+        readable = set(readable)
+        writable = set(writable)
+
+        for fileno in readable | writable:
+            callback = self._callbacks.get(fileno)
+
+            if not callback:
+                continue
+
+            callback(fileno in readable, fileno in writable)
+
+    def __poll(self, task):
+        timeout = 0 if self._awake else self._timeout
+        self._awake = False
+
+        self.poll(timeout)
+        return task.cont
+
+    def shutdown(self):
+        if self.__poll_task:
+            task_mgr.remove(self.__poll_task)
+
+        self.__poll_task = None
+
+_select_poller = None
+
+def get_select_poller():
+    """
+    Returns the process wide select poller
+    """
+
+    global _select_poller
+
+    if not _select_poller:
+        _select_poller = NetworkSelectPoller()
+
+    return _select_poller
+
+class NetworkSocketConnection(object):
+    """
+    A nonblocking TCP socket connection owned by a select transport
+    """
+
+    def __init__(self, client, address):
+        self._socket = client
+        self._address = address
+        self._fileno = client.fileno()
+
+        self._read_buffer = bytearray()
+        self._write_buffer = bytearray()
+
+        # where the first whole frame starts in the write buffer,
+        # anything before it is what is left of a partly written frame...
+        self._frame_offset = 0
+
+        self._closed = False
+
+    @property
+    def socket(self):
+        return self._socket
+
+    @property
+    def address(self):
+        return self._address
+
+    @property
+    def fileno(self):
+        return self._fileno
+
+    @property
+    def read_buffer(self):
+        return self._read_buffer
+
+    @property
+    def write_buffer(self):
+        return self._write_buffer
+
+    @property
+    def frame_offset(self):
+        return self._frame_offset
+
+    @frame_offset.setter
+    def frame_offset(self, frame_offset):
+        self._frame_offset = frame_offset
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        if self._closed:
+            return
+
+        self._closed = True
+
+        try:
+            self._socket.close()
+        except socket.error:
+            pass
+
+class NetworkSelectTransport(NetworkTransport):
+    """
+    A transport built on nonblocking sockets that only does work when
+    the shared select poller reports them as ready, it speaks the same
+    length prefixed framing as panda's connection reader and writer...
+    """
+
+    notify = directNotify.newCategory('NetworkSelectTransport')
+
+    def __init__(self, capped=True):
+        NetworkTransport.__init__(self, capped)
+
+        self._poller = get_select_poller()
+        self._read_size = config.GetInt('network-read-size', 65536)
+        self._linger_time = config.GetFloat('network-close-linger-time', 2.0)
+
+        self._rendezvous = None
+        self._connections = set()
+        self._lingering = {}
+
+        self._new_connections = collections.deque()
+        self._incoming = collections.deque()
+
+    def open_server(self, address, port, backlog):
+        rendezvous = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        rendezvous.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        try:
+            rendezvous.bind((address, port))
+            rendezvous.listen(backlog)
+        except socket.error as e:
+            self.notify.warning('Failed to open TCP server rendezvous on address: <%s:%d>, %s!' % (
+                address, port, e))
+
+            rendezvous.close()
+            return None
+
+        rendezvous.setblocking(0)
+
+        self._rendezvous = rendezvous
+        self._poller.register(rendezvous.fileno(), self.__handle_rendezvous_events)
+        return rendezvous
+
+    def close_server(self, rendezvous):
+        self._poller.unregister(rendezvous.fileno())
+        rendezvous.close()
+
+        if rendezvous is self._rendezvous:
+            self._rendezvous = None
+
+    def open_client(self, address, port, timeout):
+        try:
+            client = socket.create_connection((address, port), timeout / 1000.0)
+        except socket.error as e:
+            self.notify.warning('Failed to open TCP client connection to address: <%s:%d>, %s!' % (
+                address, port, e))
+
+            return None
+
+        return self.__make_connection(client, client.getpeername())
+
+    def add_connection(self, connection):
+        with self._lock:
+            if connection in self._connections:
+                return
+
+            NetworkTransport.add_connection(self, connection)
+            self._connections.add(connection)
+            self._poller.register(connection.fileno, lambda readable, writable: \
+                self.__handle_connection_events(connection, readable, writable))
+
+            # the socket may still need to flush data that was
+            # written to it before it was added...
+            self._poller.set_writable(connection.fileno, bool(connection.write_buffer))
+
+    def remove_connection(self, connection):
+        with self._lock:
+            NetworkTransport.remove_connection(self, connection)
+
+            if connection not in self._connections:
+                return
+
+            self._poller.unregister(connection.fileno)
+            self._connections.discard(connection)
+
+    def close_connection(self, connection):
+        with self._lock:
+            NetworkTransport.close_connection(self, connection)
+            self.remove_connection(connection)
+
+            # whatever was sent last, usually the reason for the disconnect,
+            # is given a moment to be written before the socket goes away...
+            if connection.write_buffer and not connection.closed and self._linger_time > 0:
+                self.__linger_connection(connection)
+            else:
+                connection.close()
+
+    def clear_outbound(self, connection):
+        """
+        Discards the datagrams queued for the connection that were not yet written,
+        including those already waiting in the socket's write buffer
+        """
+
+        with self._lock:
+            NetworkTransport.clear_outbound(self, connection)
+
+            if connection not in self._connections or connection.closed:
+                return
+
+            # the rest of a partly written frame has to go out,
+            # or the other end will never find the next frame...
+            del connection.write_buffer[connection.frame_offset:]
+
+            outbound = self.get_outbound(connection)
+
+            if outbound:
+                outbound.pending = len(connection.write_buffer)
+                self.update_pressure(connection)
+
+    def flush(self):
+        NetworkTransport.flush(self)
+
+        if not self._lingering:
+            return
+
+        now = time.time()
+
+        with self._lock:
+            for connection, deadline in self._lingering.items():
+                if now >= deadline:
+                    self.__close_lingering_connection(connection)
+
+    def new_connection_available(self):
+        return bool(self._new_connections)
+
+    def get_new_connection(self):
+        if not self._new_connections:
+            return None
+
+        return self._new_connections.popleft()
+
+    def data_available(self):
+        return bool(self._incoming)
+
+    def get_data(self, datagram):
+        if not self._incoming:
+            return None
+
+        data, connection = self._incoming.popleft()
+        datagram.append_data(data)
+        return connection
+
+    def write(self, connection, messages):
+        if connection.closed:
+            return False
+
+        write_buffer = connection.write_buffer
+        flush = not write_buffer
+
+        for message in messages:
+            write_buffer.extend(self._header.pack(len(message)))
+            write_buffer.extend(message)
+
+        # if the socket already had data waiting on it, the poller will
+        # tell us once the socket can be written to again...
+        if flush:
+            self.__write_connection(connection)
+        else:
+            outbound = self.get_outbound(connection)
+
+            if outbound:
+                outbound.pending = len(write_buffer)
+
+        return not connection.closed
+
+    def keep_awake(self):
+        self._poller.keep_awake()
+
+    def __make_connection(self, client, address):
+        client.setblocking(0)
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        return NetworkSocketConnection(client, address)
+
+    def __handle_rendezvous_events(self, readable, writable):
+        while self._rendezvous:
+            try:
+                client, address = self._rendezvous.accept()
+            except socket.error as e:
+                if e.args[0] not in WOULD_BLOCK_ERRORS:
+                    self.notify.warning('Failed to accept new connection, %s!' % (
+                        e))
+
+                break
+
+            self._new_connections.append((self._rendezvous, address,
+                self.__make_connection(client, address)))
+
+    def __handle_connection_events(self, connection, readable, writable):
+        if readable:
+            self.__read_connection(connection)
+
+        # the poller may run on a different task chain thread than
+        # the flush task that fills the socket's write buffer...
+        if writable:
+            with self._lock:
+                if not connection.closed:
+                    self.__write_connection(connection)
+
+    def __read_connection(self, connection):
+        while True:
+            try:
+                data = connection.socket.recv(self._read_size)
+            except socket.error as e:
+                if e.args[0] in WOULD_BLOCK_ERRORS:
+                    break
+
+                self.__reset_connection(connection)
+                return
+
+            # an empty read means the remote end has closed the stream...
+            if not data:
+                self.__read_frames(connection)
+                self.__reset_connection(connection)
+                return
+
+            connection.read_buffer.extend(data)
+
+            if len(data) < self._read_size:
+                break
+
+        self.__read_frames(connection)
+
+    def __read_frames(self, connection):
+        read_buffer = connection.read_buffer
+        length = len(read_buffer)
+        offset = 0
+
+        while length - offset >= self._header_size:
+            size = self._header.unpack_from(read_buffer, offset)[0]
+            start = offset + self._header_size
+
+            if length - start < size:
+                break
+
+            self._incoming.append((bytes(read_buffer[start:start + size]), connection))
+            offset = start + size
+
+        if offset:
+            del read_buffer[:offset]
+
+    def __send_buffer(self, connection):
+        """
+        Writes as much of the connection's write buffer as the socket
+        accepts, returns False if the socket failed
+        """
+
+        write_buffer = connection.write_buffer
+
+        while write_buffer:
+            try:
+                sent = connection.socket.send(write_buffer)
+            except socket.error as e:
+                if e.args[0] in WOULD_BLOCK_ERRORS:
+                    break
+
+                return False
+
+            # step over the frames that were written, so that we know where
+            # the first frame that is still whole starts...
+            frame_offset = connection.frame_offset
+
+            while frame_offset < sent:
+                frame_offset += self._header_size + self._header.unpack_from(
+                    write_buffer, frame_offset)[0]
+
+            connection.frame_offset = frame_offset - sent
+            del write_buffer[:sent]
+
+        return True
+
+    def __write_connection(self, connection):
+        write_buffer = connection.write_buffer
+
+        if not self.__send_buffer(connection):
+            self.__reset_connection(connection)
+            return
+
+        self._poller.set_writable(connection.fileno, bool(write_buffer))
+
+        outbound = self.get_outbound(connection)
+
+        if outbound:
+            outbound.pending = len(write_buffer)
+            self.update_pressure(connection)
+
+    def __linger_connection(self, connection):
+        self._lingering[connection] = time.time() + self._linger_time
+
+        self._poller.register(connection.fileno, lambda readable, writable: \
+            self.__handle_lingering_events(connection, readable, writable))
+
+        self._poller.set_writable(connection.fileno, True)
+
+    def __handle_lingering_events(self, connection, readable, writable):
+        with self._lock:
+            if connection not in self._lingering:
+                return
+
+            # nothing the other end sends is wanted anymore...
+            if readable:
+                try:
+                    if not connection.socket.recv(self._read_size):
+                        self.__close_lingering_connection(connection)
+                        return
+                except socket.error as e:
+                    if e.args[0] not in WOULD_BLOCK_ERRORS:
+                        self.__close_lingering_connection(connection)
+                        return
+
+            if writable and (not self.__send_buffer(connection) or not connection.write_buffer):
+                self.__close_lingering_connection(connection)
+
+    def __close_lingering_connection(self, connection):
+        del self._lingering[connection]
+
+        self._poller.unregister(connection.fileno)
+        connection.close()
+
+    def __reset_connection(self, connection):
+        with self._lock:
+            if connection.closed:
+                return
+
+            self.remove_connection(connection)
+            connection.close()
+
+            self._resets.append(connection)
+
+TRANSPORTS = {
+    'panda': NetworkPandaTransport,
+    'select': NetworkSelectTransport
+}
+
+def create_transport(name=None, capped=True):
+    """
+    Creates the transport selected by the network-transport config variable,
+    connections of an uncapped transport are never evicted for falling behind
+    """
+
+    if name is None:
+        name = config.GetString('network-transport', 'select')
+
+    transport_class = TRANSPORTS.get(name)
+
+    if not transport_class:
+        notify.error('Unknown network transport: %s, expected one of: %s!' % (
+            name, ', '.join(sorted(TRANSPORTS))))
+
+    # panda's connection writer never tells us how much of a connection's data
+    # it has yet to write, so the send watermarks can not see a stalled client...
+    if capped and transport_class is NetworkPandaTransport and \
+            config.GetInt('network-send-high-watermark', 1048576):
+
+        notify.warning('The panda transport does not track queued bytes, '
+            'slow consumers will not be evicted! use network-transport select.')
+
+    return transport_class(capped)
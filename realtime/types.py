@@ -17,6 +17,11 @@ CONTROL_ADD_RANGE = 2006
 CONTROL_REMOVE_RANGE = 2007
 CONTROL_ADD_POST_REMOVE = 2008
 CONTROL_CLEAR_POST_REMOVE = 2009
+CONTROL_SET_DOWNSTREAM = 2010
+CONTROL_ADD_REMOTE_CHANNEL = 2011
+CONTROL_REMOVE_REMOTE_CHANNEL = 2012
+CONTROL_ADD_REMOTE_RANGE = 2013
+CONTROL_REMOVE_REMOTE_RANGE = 2014
 
 CLIENT_GO_GET_LOST = 4
 CLIENT_OBJECT_UPDATE_FIELD = 24
@@ -72,6 +77,7 @@ CLIENT_LOGIN_2_BLUE = 3
 CLIENT_DISCONNECT_INVALID_MSGTYPE = 108
 CLIENT_DISCONNECT_NO_HEARTBEAT = 345
 CLIENT_DISCONNECT_ALREADY_LOGGED_IN = 346
+CLIENT_DISCONNECT_SLOW_CONSUMER = 347
 CLIENT_DISCONNECT_BAD_VERSION = 124
 CLIENT_DISCONNECT_INVALID_PLAY_TOKEN_TYPE = 284
 CLIENT_DISCONNECT_TRUNCATED_DATAGRAM = 109
@@ -88,6 +94,12 @@ STATESERVER_OBJECT_SET_OWNER = 2043
 STATESERVER_OBJECT_CHANGING_OWNER = 2044
 STATESERVER_OBJECT_UPDATE_FIELD = 2020
 STATESERVER_OBJECT_UPDATE_FIELD_MULTIPLE = 2021
+STATESERVER_ADD_INTEREST = 2022
+STATESERVER_REMOVE_INTEREST = 2023
+STATESERVER_SET_INTEREST = 2024
+STATESERVER_SHARD_QUERY_LOCATION = 2025
+STATESERVER_SHARD_CHANGE_ZONE = 2026
+STATESERVER_SHARD_QUERY_RESP = 2027
 STATESERVER_OBJECT_CHANGING_LOCATION = 2040
 STATESERVER_OBJECT_SET_AI = 2050
 STATESERVER_OBJECT_SET_AI_RESP = 2054
@@ -101,6 +113,10 @@ STATESERVER_GET_SHARD_ALL = 2012
 STATESERVER_GET_SHARD_ALL_RESP = 2013
 STATESERVER_SET_AVATAR = 2014
 STATESERVER_SET_AVATAR_RESP = 2015
+STATESERVER_SHARD_OBJECT_LOCATION = 2016
+STATESERVER_SHARD_OBJECT_REMOVE = 2017
+STATESERVER_OBJECT_SEND_GENERATE = 2018
+STATESERVER_OBJECT_SEND_DELETE = 2019
 
 DBSERVER_CREATE_OBJECT = 3000
 DBSERVER_CREATE_OBJECT_RESP = 3001
@@ -0,0 +1,72 @@
+"""
+ * Copyright (C) Caleb Marshall - All Rights Reserved
+ * Written by Caleb Marshall <anythingtechpro@gmail.com>, August 17th, 2017
+ * Licensing information can found in 'LICENSE', which is part of this source code package.
+"""
+
+import __builtin__
+import os
+
+from panda3d.core import loadPrcFile, loadPrcFileData
+
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIG_FILENAME = os.path.join(ROOT_DIRECTORY, 'config', 'general.prc')
+
+if os.path.exists(CONFIG_FILENAME):
+    loadPrcFile(CONFIG_FILENAME)
+
+# keep the tests quiet and off of the ports a running cluster would use...
+loadPrcFileData('tests', 'notify-level-NetworkTransport warning')
+loadPrcFileData('tests', 'notify-level-NetworkReadQueue error\nnotify-level-NetworkBudget error')
+
+# the same builtins that realtime.main sets up, newer panda builds
+# no longer ship get_config_showbase so fall back to DConfig...
+try:
+    from panda3d.direct import get_config_showbase
+    config = get_config_showbase()
+except ImportError:
+    from direct.showbase import DConfig as config
+
+from direct.task.TaskManagerGlobal import taskMgr as task_mgr
+
+if not hasattr(__builtin__, 'config'):
+    __builtin__.config = config
+    __builtin__.task_mgr = task_mgr
+    __builtin__.task_chain = None
+
+    task_mgr.setupTaskChain('default', tickClock=True)
+
+def get_free_port():
+    """
+    Returns a loopback port that nothing is listening on right now
+    """
+
+    import socket
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    return port
+
+def run_tasks(seconds=0.0, until=None, step=0.001):
+    """
+    Steps the task manager until the condition holds or the time runs out,
+    returns whether the condition was met
+    """
+
+    import time
+
+    deadline = time.time() + seconds
+
+    while True:
+        task_mgr.step()
+
+        if until is not None and until():
+            return True
+
+        if time.time() >= deadline:
+            return until is None
+
+        time.sleep(step)
@@ -0,0 +1,97 @@
+"""
+ * Copyright (C) Caleb Marshall - All Rights Reserved
+ * Written by Caleb Marshall <anythingtechpro@gmail.com>, August 17th, 2017
+ * Licensing information can found in 'LICENSE', which is part of this source code package.
+
+Reports the memory held per state object for a toon and a prop, along with the size of
+the object's instance alone, run from the repository's root directory with:
+python -m tests.bench_memory [count] [stateserver.py]
+
+Passing the stateserver.py of another revision measures that revision's objects instead,
+for example: git show <revision>:realtime/stateserver.py > /tmp/stateserver.py
+"""
+
+import gc
+import os
+import sys
+import imp
+
+from realtime import io, stateserver
+from tests.test_stateserver import AI_CHANNEL, get_dc_loader
+from tests.bench_snapshot import pack_required_defaults
+
+OBJECT_COUNT = 100000
+PARENT_ID = 200000000
+DCLASS_NAMES = ['DistributedToon', 'DistributedAnimatedProp']
+
+def get_resident_size():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def create_state_server(module):
+    class BenchStateServer(module.StateServer):
+
+        def handle_send_connection_datagram(self, datagram):
+            pass
+
+    state_server = BenchStateServer(get_dc_loader(), '127.0.0.1', 0, 1001)
+    state_server.shard_manager.add_shard(AI_CHANNEL, 'bench-shard', 0)
+    return state_server
+
+def measure(module, dclass_name, count):
+    """
+    Returns the bytes held per object after generating count objects of the dclass
+    """
+
+    state_server = create_state_server(module)
+    dc_class = get_dc_loader().dclasses_by_name[dclass_name]
+    required_data = pack_required_defaults(dc_class)
+
+    # build the datagrams up front so they are not counted...
+    datagrams = []
+
+    for index in xrange(count):
+        datagram = io.NetworkDatagram()
+        datagram.add_uint32(100000000 + index)
+        datagram.add_uint32(PARENT_ID)
+        datagram.add_uint32(2000 + index % 100)
+        datagram.add_uint16(dc_class.get_number())
+        datagram.append_data(required_data)
+        datagrams.append(datagram)
+
+    gc.collect()
+    start = get_resident_size()
+
+    for datagram in datagrams:
+        state_server.handle_generate(AI_CHANNEL, False, io.NetworkDatagramIterator(datagram))
+
+    gc.collect()
+    size = get_resident_size() - start
+
+    state_objects = state_server.object_manager.state_objects
+    assert len(state_objects) == count
+
+    # the instance itself, without the field data and shared layout it points to...
+    instance_size = sys.getsizeof(state_objects.itervalues().next())
+    return state_server, size / float(count), instance_size
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else OBJECT_COUNT
+    module = stateserver
+
+    if len(sys.argv) > 2:
+        module = imp.load_source('bench_stateserver', sys.argv[2])
+
+    print '%d objects from: %s' % (count, module.__file__)
+
+    # the servers are kept alive so each measurement starts from the last...
+    state_servers = []
+
+    for dclass_name in DCLASS_NAMES:
+        state_server, size, instance_size = measure(module, dclass_name, count)
+        state_servers.append(state_server)
+
+        print '%s: %.0f bytes/object, %d bytes/instance' % (dclass_name, size, instance_size)
+
+if __name__ == '__main__':
+    main()
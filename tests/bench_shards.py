@@ -0,0 +1,190 @@
+"""
+ * Copyright (C) Caleb Marshall - All Rights Reserved
+ * Written by Caleb Marshall <anythingtechpro@gmail.com>, August 17th, 2017
+ * Licensing information can found in 'LICENSE', which is part of this source code package.
+
+Times generates and broadcast updates against state server clusters of one or
+more shard processes, run from the repository's root directory with:
+python -m tests.bench_shards [objects] [updates] [shard counts...]
+
+Along with the wall clock rate, the rate of the busiest shard is reported from the
+CPU time the shard processes spent, which is what the cluster sustains once each
+shard has a core of it's own rather than sharing them with the benchmark...
+"""
+
+import os
+import sys
+import time
+import subprocess
+
+from tests import ROOT_DIRECTORY, get_free_port, run_tasks, task_mgr
+from panda3d.core import loadPrcFileData
+
+# the participants fall behind on purpose while we send...
+loadPrcFileData('bench-shards', 'notify-level-NetworkReadQueue error')
+
+from tests.test_stateserver import ShardParticipant, AI_CHANNEL, OWNER_CHANNEL, get_dc_loader
+from realtime import io, types, stateserver, messagedirector
+
+OBJECT_COUNT = 20000
+UPDATE_COUNT = 100000
+SHARD_COUNTS = [1, 2, 4]
+PARENT_ID = 200000000
+ZONE_COUNT = 100
+
+def run_shard(port, shard_count, shard_index):
+    loadPrcFileData('bench-shard', 'stateserver-shards %d\nstateserver-shard-index %d' % (
+        shard_count, shard_index))
+
+    shard = stateserver.StateServer(get_dc_loader(), '127.0.0.1', port,
+        types.STATESERVER_CHANNEL)
+
+    shard.setup()
+    task_mgr.run()
+
+class BenchParticipant(ShardParticipant):
+
+    def __init__(self, port, channel):
+        ShardParticipant.__init__(self, port, channel)
+
+        self.counts = {}
+
+    def handle_datagram(self, channel, sender, message_type, di):
+        self.counts[message_type] = self.counts.get(message_type, 0) + 1
+
+    def get_count(self, message_type):
+        return self.counts.get(message_type, 0)
+
+def send_all(participant, messages):
+    for index, (channel, message_type, datagram) in enumerate(messages):
+        participant.send_message(channel, message_type, datagram)
+
+        # keep reading while we send, nobody can write to us otherwise...
+        if index % 256 == 0:
+            task_mgr.step()
+
+def get_cpu_time(process):
+    with open('/proc/%d/stat' % process.pid) as stat:
+        fields = stat.read().rsplit(')', 1)[1].split()
+
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+def get_busiest_time(processes, cpu_times):
+    return max(get_cpu_time(process) - cpu_time for process, cpu_time in zip(processes, cpu_times))
+
+def wait_for(participant, message_type, count):
+    if not run_tasks(120.0, lambda: participant.get_count(message_type) >= count, step=0):
+        raise RuntimeError('Timed out waiting for message: %d, %d of %d received!' % (
+            message_type, participant.get_count(message_type), count))
+
+def bench(shard_count, object_count, update_count):
+    port = get_free_port()
+
+    message_director = messagedirector.MessageDirector('127.0.0.1', port)
+    message_director.setup()
+
+    processes = [subprocess.Popen([sys.executable, '-m', 'tests.bench_shards', '--shard', str(port),
+        str(shard_count), str(shard_index)], cwd=ROOT_DIRECTORY) for shard_index in xrange(shard_count)]
+
+    ai = BenchParticipant(port, AI_CHANNEL)
+    owner = BenchParticipant(port, OWNER_CHANNEL)
+
+    try:
+        ai.setup()
+
+        # the broadcasts are sent to the AI as well, somebody has to read them...
+        ai.register_for_channel(PARENT_ID)
+        owner.setup()
+
+        # the shard processes take a moment to start up and connect...
+        if not run_tasks(30.0, lambda: len(message_director.interface.participants.get(
+                types.STATESERVER_CHANNEL, ())) == shard_count):
+            raise RuntimeError('Timed out waiting for the shards to connect!')
+
+        datagram = io.NetworkDatagram()
+        datagram.add_string('bench-shard')
+        datagram.add_uint32(0)
+        ai.send_message(types.STATESERVER_CHANNEL, types.STATESERVER_ADD_SHARD, datagram)
+
+        # the owner sees every zone, so every generate and broadcast reaches it.
+        # it's sent along with everything else so the shards have it first...
+        datagram = io.NetworkDatagram()
+        datagram.add_uint64(OWNER_CHANNEL)
+        datagram.add_uint16(ZONE_COUNT)
+
+        for zone_id in xrange(2000, 2000 + ZONE_COUNT):
+            datagram.add_uint32(PARENT_ID)
+            datagram.add_uint32(zone_id)
+
+        ai.send_message(types.STATESERVER_CHANNEL, types.STATESERVER_SET_INTEREST, datagram)
+
+        dc_class = get_dc_loader().dclasses_by_name['DistributedNode']
+        generates = []
+
+        for index in xrange(object_count):
+            datagram = io.NetworkDatagram()
+            datagram.add_uint32(100000000 + index)
+            datagram.add_uint32(PARENT_ID)
+            datagram.add_uint32(2000 + index % ZONE_COUNT)
+            datagram.add_uint16(dc_class.get_number())
+            generates.append((types.STATESERVER_CHANNEL, types.STATESERVER_OBJECT_GENERATE_WITH_REQUIRED,
+                datagram))
+
+        start = time.time()
+        cpu_times = map(get_cpu_time, processes)
+        send_all(ai, generates)
+        wait_for(owner, types.STATESERVER_OBJECT_ENTER_LOCATION_WITH_REQUIRED, object_count)
+        generate_time = time.time() - start
+        generate_cpu_time = get_busiest_time(processes, cpu_times)
+
+        field = dc_class.get_field_by_name('setX')
+        updates = []
+
+        for index in xrange(update_count):
+            do_id = 100000000 + index % object_count
+
+            datagram = io.NetworkDatagram()
+            datagram.add_uint32(do_id)
+            datagram.add_uint16(field.get_number())
+            datagram.add_int16(index % 1000)
+            updates.append((do_id, types.STATESERVER_OBJECT_UPDATE_FIELD, datagram))
+
+        start = time.time()
+        cpu_times = map(get_cpu_time, processes)
+        send_all(ai, updates)
+        wait_for(owner, types.STATESERVER_OBJECT_UPDATE_FIELD, update_count)
+        update_time = time.time() - start
+        update_cpu_time = get_busiest_time(processes, cpu_times)
+
+        return generate_time, update_time, generate_cpu_time, update_cpu_time
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+        owner.shutdown()
+        ai.shutdown()
+        message_director.shutdown()
+        run_tasks(0.05)
+
+def main():
+    if len(sys.argv) > 4 and sys.argv[1] == '--shard':
+        run_shard(*map(int, sys.argv[2:5]))
+        return
+
+    object_count = int(sys.argv[1]) if len(sys.argv) > 1 else OBJECT_COUNT
+    update_count = int(sys.argv[2]) if len(sys.argv) > 2 else UPDATE_COUNT
+    shard_counts = map(int, sys.argv[3:]) or SHARD_COUNTS
+
+    print '%d objects, %d broadcast updates' % (object_count, update_count)
+
+    for shard_count in shard_counts:
+        generate_time, update_time, generate_cpu_time, update_cpu_time = bench(shard_count,
+            object_count, update_count)
+
+        print '%d shard(s): generates %.0f/s, updates %.0f/s, busiest shard: generates %.0f/s, updates %.0f/s' % (
+            shard_count, object_count / generate_time, update_count / update_time,
+            object_count / generate_cpu_time, update_count / update_cpu_time)
+
+if __name__ == '__main__':
+    main()
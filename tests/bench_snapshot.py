@@ -0,0 +1,89 @@
+"""
+ * Copyright (C) Caleb Marshall - All Rights Reserved
+ * Written by Caleb Marshall <anythingtechpro@gmail.com>, August 17th, 2017
+ * Licensing information can found in 'LICENSE', which is part of this source code package.
+
+Times writing and restoring a state server snapshot of toons, run from the
+repository's root directory with: python -m tests.bench_snapshot [count]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from panda3d.direct import DCPacker
+from realtime import io, stateserver
+from tests.test_stateserver import TestStateServer, AI_CHANNEL, get_dc_loader
+
+OBJECT_COUNT = 100000
+PARENT_ID = 200000000
+
+def pack_required_defaults(dc_class):
+    """
+    Returns the required fields of the dclass packed with their default values
+    """
+
+    packer = DCPacker()
+
+    for field_index in xrange(dc_class.get_num_inherited_fields()):
+        field = dc_class.get_inherited_field(field_index)
+
+        if field.as_molecular_field() or not field.is_required():
+            continue
+
+        packer.begin_pack(field)
+        packer.pack_default_value()
+        packer.end_pack()
+
+    return packer.get_string()
+
+def populate(state_server, count):
+    dc_class = get_dc_loader().dclasses_by_name['DistributedToon']
+    required_data = pack_required_defaults(dc_class)
+
+    for index in xrange(count):
+        datagram = io.NetworkDatagram()
+        datagram.add_uint32(100000000 + index)
+        datagram.add_uint32(PARENT_ID)
+        datagram.add_uint32(2000 + index % 100)
+        datagram.add_uint16(dc_class.get_number())
+        datagram.append_data(required_data)
+
+        state_server.handle_generate(AI_CHANNEL, False, io.NetworkDatagramIterator(datagram))
+
+    del state_server.sent[:]
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else OBJECT_COUNT
+    directory = tempfile.mkdtemp()
+    filename = os.path.join(directory, 'stateserver.snapshot')
+
+    try:
+        state_server = TestStateServer()
+        state_server.shard_manager.add_shard(AI_CHANNEL, 'bench-shard', 0)
+        populate(state_server, count)
+
+        snapshot = stateserver.StateServerSnapshot(state_server, filename, 1000)
+
+        start = time.time()
+        snapshot.write_all()
+        write_time = time.time() - start
+
+        restored_server = TestStateServer()
+        snapshot = stateserver.StateServerSnapshot(restored_server, filename, 1000)
+
+        start = time.time()
+        restore_count = snapshot.restore()
+        restore_time = time.time() - start
+
+        print 'snapshot of %d toons: %.1f MB' % (count, os.path.getsize(filename) / 1048576.0)
+        print 'write:   %.2fs, %.0f objects/s' % (write_time, count / write_time)
+        print 'restore: %.2fs, %.0f objects/s, %d objects restored' % (
+            restore_time, restore_count / restore_time, restore_count)
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+ * Copyright (C) Caleb Marshall - All Rights Reserved
+ * Written by Caleb Marshall <anythingtechpro@gmail.com>, August 17th, 2017
+ * Licensing information can found in 'LICENSE', which is part of this source code package.
+
+Compares the panda and select transports over loopback, run from the
+repository's root directory with: python -m tests.bench_transport
+"""
+
+import os
+import sys
+import time
+
+from tests import get_free_port, task_mgr
+from panda3d.core import loadPrcFileData
+from realtime import io, transport
+
+DATAGRAM_COUNT = 200000
+DATAGRAM_SIZE = 64
+IDLE_SECONDS = 3.0
+
+def pump(transport_object):
+    transport.get_select_poller().poll(0)
+
+def connect(name):
+    server = transport.create_transport(name)
+    client = transport.create_transport(name)
+
+    port = get_free_port()
+    rendezvous = server.open_server('127.0.0.1', port, 10)
+    connection = client.open_client('127.0.0.1', port, 5000)
+    client.add_connection(connection)
+
+    accepted = None
+    deadline = time.time() + 5.0
+
+    while accepted is None and time.time() < deadline:
+        pump(server)
+
+        if server.new_connection_available():
+            accepted = server.get_new_connection()
+
+    if accepted is None:
+        raise RuntimeError('Failed to accept the benchmark connection!')
+
+    server.add_connection(accepted[2])
+    return server, client, connection, rendezvous
+
+def measure_throughput(name):
+    server, client, connection, rendezvous = connect(name)
+
+    datagram = io.NetworkDatagram()
+    datagram.append_data('x' * DATAGRAM_SIZE)
+
+    def receive():
+        count = 0
+
+        pump(server)
+
+        while server.data_available():
+            if server.get_data(io.NetworkDatagram()) is None:
+                break
+
+            count += 1
+
+        return count
+
+    received = 0
+    start = time.time()
+
+    # the datagrams are flushed and read a tick's worth at a time,
+    # the same way the listener and connector tasks would...
+    for index in xrange(DATAGRAM_COUNT):
+        client.send(datagram, connection)
+
+        if index % 256 == 255:
+            client.flush()
+            received += receive()
+
+    client.flush()
+
+    while received < DATAGRAM_COUNT and time.time() - start < 60.0:
+        pump(client)
+        received += receive()
+
+    elapsed = time.time() - start
+
+    client.close_connection(connection)
+    server.close_server(rendezvous)
+
+    return received, elapsed
+
+def measure_idle_cpu(name):
+    """
+    Runs an idle listener on the same four thread task chain realtime.main uses
+    and returns the process cpu time used per second of wall time
+    """
+
+    loadPrcFileData('bench', 'network-transport %s' % name)
+
+    import __builtin__
+    __builtin__.task_chain = task_mgr.setupTaskChain('bench-taskchain-%s' % name,
+        numThreads=4, frameSync=False)
+
+    listener = io.NetworkListener('127.0.0.1', get_free_port(), io.NetworkHandler)
+    listener.setup()
+
+    start_times = os.times()
+    start = time.time()
+
+    while time.time() - start < IDLE_SECONDS:
+        task_mgr.step()
+
+    end_times = os.times()
+    elapsed = time.time() - start
+
+    listener.shutdown()
+    __builtin__.task_chain = None
+
+    cpu = (end_times[0] - start_times[0]) + (end_times[1] - start_times[1])
+    return cpu / elapsed
+
+def main():
+    names = sys.argv[1:] or sorted(transport.TRANSPORTS)
+
+    for name in names:
+        received, elapsed = measure_throughput(name)
+
+        print '%-6s throughput: %d datagrams of %d bytes in %.3fs, %.0f datagrams/s, %.2f MB/s' % (
+            name, received, DATAGRAM_SIZE, elapsed, received / elapsed,
+            received * DATAGRAM_SIZE / elapsed / 1048576.0)
+
+    for name in names:
+        print '%-6s idle cpu: %.1f%% of one core over %.1fs' % (
+            name, measure_idle_cpu(name) * 100.0, IDLE_SECONDS)
+
+if __name__ == '__main__':
+    main()
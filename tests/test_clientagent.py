@@ -0,0 +1,138 @@
+"""
+ * Copyright (C) Caleb Marshall - All Rights Reserved
+ * Written by Caleb Marshall <anythingtechpro@gmail.com>, August 17th, 2017
+ * Licensing information can found in 'LICENSE', which is part of this source code package.
+"""
+
+import os
+import time
+import errno
+import shutil
+import socket
+import struct
+import tempfile
+import unittest
+
+from tests import get_free_port, run_tasks
+from tests.test_stateserver import get_dc_loader
+from panda3d.core import loadPrcFileData, unloadPrcFile
+from realtime import io, types, clientagent, messagedirector
+
+class ClientAgentTestCase(unittest.TestCase):
+    TRANSPORT = 'select'
+
+    def setUp(self):
+        port = get_free_port()
+        self.port = get_free_port()
+
+        self.message_director = messagedirector.MessageDirector('127.0.0.1', port)
+        self.message_director.setup()
+        self.addCleanup(self.message_director.shutdown)
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        # small send queues, so that a client falls behind quickly...
+        page = loadPrcFileData('tests-clientagent', '\n'.join([
+            'clientagent-dbm-filename %s' % os.path.join(directory, 'database.dbm'),
+            'network-transport %s' % self.TRANSPORT,
+            'network-send-max-bytes 262144',
+            'network-send-high-watermark 131072',
+            'network-send-low-watermark 32768']))
+
+        try:
+            self.client_agent = clientagent.ClientAgent(get_dc_loader(), '127.0.0.1', self.port,
+                '127.0.0.1', port, types.CLIENTAGENT_CHANNEL)
+        finally:
+            unloadPrcFile(page)
+
+        self.client_agent.setup()
+        self.addCleanup(self.client_agent.shutdown)
+
+    def connect(self):
+        """
+        Connects a client that reads nothing until it is told to
+        """
+
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        client.connect(('127.0.0.1', self.port))
+        self.addCleanup(client.close)
+
+        channel = config.GetInt('clientagent-min-channels', 1000000000)
+        self.assertTrue(run_tasks(2.0, lambda: self.client_agent.get_handler_from_channel(channel)))
+
+        return client, self.client_agent.get_handler_from_channel(channel)
+
+    def read_frames(self, client):
+        """
+        Reads everything the client agent sent until it closed the connection
+        """
+
+        # the client agent runs on this thread too, so it is given
+        # a tick whenever the client has read everything it can...
+        client.setblocking(0)
+        data = bytearray()
+        deadline = time.time() + 10.0
+
+        while time.time() < deadline:
+            try:
+                chunk = client.recv(65536)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    run_tasks()
+                    continue
+
+                if e.args[0] == errno.ECONNRESET:
+                    break
+
+                raise
+
+            if not chunk:
+                break
+
+            data.extend(chunk)
+
+        frames = []
+        offset = 0
+
+        while offset < len(data):
+            self.assertGreaterEqual(len(data) - offset, 2)
+            size = struct.unpack_from('<H', data, offset)[0]
+            offset += 2
+
+            self.assertLessEqual(offset + size, len(data))
+            frames.append(bytes(data[offset:offset + size]))
+            offset += size
+
+        return frames
+
+class TestSlowConsumer(ClientAgentTestCase):
+
+    def test_slow_consumer_receives_reason(self):
+        client, handler = self.connect()
+        channel = handler.channel
+
+        # keep sending until the client agent gives up on the client...
+        deadline = time.time() + 10.0
+
+        while self.client_agent.get_handler_from_channel(channel) and time.time() < deadline:
+            for _ in xrange(64):
+                datagram = io.NetworkDatagram()
+                datagram.add_uint16(types.CLIENT_HEARTBEAT)
+                datagram.append_data('x' * 1024)
+                handler.handle_send_datagram(datagram)
+
+            run_tasks()
+
+        self.assertIsNone(self.client_agent.get_handler_from_channel(channel))
+
+        # every frame the client gets must be whole, and the last one is the reason...
+        frames = self.read_frames(client)
+        message_type, code = struct.unpack_from('<HH', frames[-1])
+
+        self.assertEqual(message_type, types.CLIENT_GO_GET_LOST)
+        self.assertEqual(code, types.CLIENT_DISCONNECT_SLOW_CONSUMER)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+"""
+ * Copyright (C) Caleb Marshall - All Rights Reserved
+ * Written by Caleb Marshall <anythingtechpro@gmail.com>, August 17th, 2017
+ * Licensing information can found in 'LICENSE', which is part of this source code package.
+"""
+
+import time
+import unittest
+
+from tests import get_free_port, task_mgr
+from realtime import io, transport
+
+FLOOD_COUNT = 100
+BUDGET_COUNT = 10
+
+class FloodHandler(io.NetworkHandler):
+    handlers = []
+
+    def __init__(self, *args, **kwargs):
+        io.NetworkHandler.__init__(self, *args, **kwargs)
+
+        self.received = []
+        FloodHandler.handlers.append(self)
+
+    def handle_datagram(self, di):
+        self.received.append(di.get_uint32())
+
+class TestHandlerChannels(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = io.NetworkListener('127.0.0.1', get_free_port(), io.NetworkHandler)
+
+    def test_first_handler_keeps_channel(self):
+        first, second = object(), object()
+
+        self.listener.add_handler_channel(first, 1000)
+        self.listener.add_handler_channel(second, 1000)
+
+        self.assertIs(self.listener.get_handler_from_channel(1000), first)
+
+    def test_shared_channel_survives_unregister(self):
+        first, second = object(), object()
+
+        self.listener.add_handler_channel(first, 1000)
+        self.listener.add_handler_channel(second, 1000)
+        self.listener.remove_handler_channel(first, 1000)
+
+        self.assertIs(self.listener.get_handler_from_channel(1000), second)
+
+        self.listener.remove_handler_channel(second, 1000)
+        self.assertIsNone(self.listener.get_handler_from_channel(1000))
+
+    def test_remove_unknown_handler(self):
+        first, second = object(), object()
+
+        self.listener.add_handler_channel(first, 1000)
+        self.listener.remove_handler_channel(second, 1000)
+
+        self.assertIs(self.listener.get_handler_from_channel(1000), first)
+
+class FloodTestCase(unittest.TestCase):
+    """
+    Floods a listener from a number of clients and records how many
+    datagrams it handles on each tick of the task manager...
+    """
+
+    def setUp(self):
+        del FloodHandler.handlers[:]
+
+        port = get_free_port()
+
+        self.listener = io.NetworkListener('127.0.0.1', port, FloodHandler)
+        self.listener.setup()
+        self.addCleanup(self.listener.shutdown)
+
+        self.client = transport.create_transport()
+        self.connections = []
+
+    def connect(self, count):
+        for _ in xrange(count):
+            connection = self.client.open_client('127.0.0.1', self.listener_port, 5000)
+            self.client.add_connection(connection)
+            self.addCleanup(self.client.close_connection, connection)
+            self.connections.append(connection)
+
+        self.assertTrue(self.step_until(lambda: len(FloodHandler.handlers) == count))
+
+    @property
+    def listener_port(self):
+        return self.listener._NetworkListener__port
+
+    def step_until(self, until, seconds=5.0):
+        deadline = time.time() + seconds
+
+        while time.time() < deadline:
+            task_mgr.step()
+
+            if until():
+                return True
+
+        return False
+
+    def get_received_count(self):
+        return sum(len(handler.received) for handler in FloodHandler.handlers)
+
+    def flood(self, count):
+        for connection in self.connections:
+            for sequence in xrange(count):
+                datagram = io.NetworkDatagram()
+                datagram.add_uint32(sequence)
+                self.client.send(datagram, connection)
+
+        self.client.flush()
+
+    def run_flood(self, budget, count):
+        """
+        Returns the datagrams handled per tick until all of them were handled,
+        and whether or not the budget reported a backlog along the way
+        """
+
+        total = count * len(self.connections)
+        handled = []
+        saturated = False
+
+        deadline = time.time() + 10.0
+
+        while self.get_received_count() < total and time.time() < deadline:
+            received_count = self.get_received_count()
+            task_mgr.step()
+
+            handled.append(self.get_received_count() - received_count)
+            saturated = saturated or budget.saturated
+
+        self.assertEqual(self.get_received_count(), total)
+
+        for handler in FloodHandler.handlers:
+            self.assertEqual(handler.received, range(count))
+
+        return handled, saturated
+
+class TestReadBudget(FloodTestCase):
+
+    def test_flood_spread_across_ticks(self):
+        self.connect(1)
+        self.listener.read_queue.max_count = BUDGET_COUNT
+        self.listener.read_queue.max_time = 0
+
+        self.flood(FLOOD_COUNT)
+        handled, saturated = self.run_flood(self.listener.read_queue, FLOOD_COUNT)
+
+        self.assertLessEqual(max(handled), BUDGET_COUNT)
+        self.assertGreaterEqual(len([count for count in handled if count]), FLOOD_COUNT // BUDGET_COUNT)
+        self.assertTrue(saturated)
+        self.assertFalse(self.listener.read_queue.saturated)
+
+class TestDispatchBudget(FloodTestCase):
+
+    def test_flood_spread_across_ticks(self):
+        self.connect(4)
+        self.listener.read_queue.max_count = 0
+        self.listener.read_queue.max_time = 0
+        self.listener.dispatch_budget.max_count = BUDGET_COUNT
+        self.listener.dispatch_budget.max_time = 0
+
+        # the read queue now hands everything to the handlers at once,
+        # it is the dispatch budget alone that spreads the flood out...
+        self.flood(FLOOD_COUNT)
+        handled, saturated = self.run_flood(self.listener.dispatch_budget, FLOOD_COUNT)
+
+        self.assertLessEqual(max(handled), BUDGET_COUNT)
+        self.assertGreaterEqual(len([count for count in handled if count]),
+            FLOOD_COUNT * len(self.connections) // BUDGET_COUNT)
+
+        self.assertTrue(saturated)
+        self.assertFalse(self.listener.dispatch_budget.saturated)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,493 @@
+"""
+ * Copyright (C) Caleb Marshall - All Rights Reserved
+ * Written by Caleb Marshall <anythingtechpro@gmail.com>, August 17th, 2017
+ * Licensing information can found in 'LICENSE', which is part of this source code package.
+"""
+
+import time
+import unittest
+
+from tests import get_free_port, run_tasks
+from panda3d.core import loadPrcFileData, unloadPrcFile
+from realtime import io, messagedirector
+
+TEST_MESSAGE = 1234
+
+class TestParticipant(io.NetworkConnector):
+
+    def __init__(self, port, channel=None):
+        io.NetworkConnector.__init__(self, None, '127.0.0.1', port, channel)
+
+        self.received = []
+
+    def send_message(self, channel, value):
+        datagram = io.NetworkDatagram()
+        datagram.add_header(channel, 0, TEST_MESSAGE)
+        datagram.add_uint32(value)
+        self.handle_send_connection_datagram(datagram)
+
+    def send_multi_message(self, channels, value):
+        datagram = io.NetworkDatagram()
+        datagram.add_multi_header(channels, 0, TEST_MESSAGE)
+        datagram.add_uint32(value)
+        self.handle_send_connection_datagram(datagram)
+        return datagram
+
+    def handle_datagram(self, channel, sender, message_type, di):
+        self.received.append((channel, di.get_uint32()))
+
+class TestMessageDirectorUpstream(unittest.TestCase):
+
+    def start_director(self, port, upstream_port=None):
+        director = messagedirector.MessageDirector('127.0.0.1', port)
+
+        if upstream_port:
+            director._upstream_address = '127.0.0.1'
+            director._upstream_port = upstream_port
+
+        director.setup()
+
+        if director._upstream:
+            director._upstream.reconnect_time = 0.05
+
+        return director
+
+    def connect(self, port, channel=None):
+        participant = TestParticipant(port, channel)
+        participant.setup()
+
+        self.addCleanup(participant.shutdown)
+        return participant
+
+    def setUp(self):
+        self.parent_port = get_free_port()
+        self.child_port = get_free_port()
+
+        self.parent = self.start_director(self.parent_port)
+        self.child = self.start_director(self.child_port, self.parent_port)
+
+        run_tasks(2.0, lambda: self.child.upstream is not None and
+            self.parent.interface.participants)
+
+    def tearDown(self):
+        self.child.shutdown()
+
+        if self.parent:
+            self.parent.shutdown()
+
+        run_tasks(0.05)
+
+    def test_routes_through_parent(self):
+        listener = self.connect(self.child_port, 1000)
+        sender = self.connect(self.parent_port)
+
+        # the child's subscription has to reach the parent first...
+        self.assertTrue(run_tasks(2.0, lambda: self.parent.interface.has_channel(1000)))
+
+        sender.send_message(1000, 1)
+        self.assertTrue(run_tasks(2.0, lambda: listener.received == [(1000, 1)]))
+
+    def test_routes_locally_while_disconnected(self):
+        self.parent.shutdown()
+        self.parent = None
+
+        self.assertTrue(run_tasks(2.0, lambda: self.child.upstream is None))
+
+        # with no parent to park it, the message is parked by the child
+        # and handed out as soon as somebody subscribes to the channel...
+        sender = self.connect(self.child_port)
+        sender.send_message(2000, 2)
+        run_tasks(0.1)
+
+        listener = self.connect(self.child_port, 2000)
+        self.assertTrue(run_tasks(2.0, lambda: listener.received == [(2000, 2)]))
+
+    def test_reconnect_replays_subscriptions(self):
+        listener = self.connect(self.child_port, 3000)
+        self.assertTrue(run_tasks(2.0, lambda: self.parent.interface.has_channel(3000)))
+
+        self.parent.shutdown()
+        self.assertTrue(run_tasks(2.0, lambda: self.child.upstream is None))
+
+        self.parent = self.start_director(self.parent_port)
+        self.assertTrue(run_tasks(5.0, lambda: self.child.upstream is not None and
+            self.parent.interface.has_channel(3000)))
+
+        sender = self.connect(self.parent_port)
+        sender.send_message(3000, 3)
+        self.assertTrue(run_tasks(2.0, lambda: listener.received == [(3000, 3)]))
+
+    def watch_parent(self):
+        """
+        Returns the channels of every message the parent is handed
+        """
+
+        channels = []
+        add_message = self.parent.message_interface.add_message
+
+        def watch_message(channel, *args, **kwargs):
+            channels.append(channel)
+            return add_message(channel, *args, **kwargs)
+
+        self.parent.message_interface.add_message = watch_message
+        return channels
+
+    def test_local_message_stays_local(self):
+        listener = self.connect(self.child_port, 4000)
+        sender = self.connect(self.child_port)
+
+        self.assertTrue(run_tasks(2.0, lambda: self.parent.interface.has_channel(4000)))
+
+        channels = self.watch_parent()
+        sender.send_message(4000, 4)
+
+        self.assertTrue(run_tasks(2.0, lambda: listener.received == [(4000, 4)]))
+        run_tasks(0.1)
+
+        # nobody past the child listens, so the parent never sees it...
+        self.assertEqual(channels, [])
+
+    def test_remote_message_crosses(self):
+        listener = self.connect(self.child_port, 5000)
+        remote_listener = self.connect(self.parent_port, 5000)
+        sender = self.connect(self.child_port)
+
+        self.assertTrue(run_tasks(2.0, lambda: self.child.upstream.has_remote_subscriber(5000)))
+
+        sender.send_message(5000, 5)
+        self.assertTrue(run_tasks(2.0, lambda: listener.received == [(5000, 5)] and
+            remote_listener.received == [(5000, 5)]))
+
+        # once the remote listener unsubscribes the channel is local again...
+        remote_listener.unregister_for_channel(5000)
+        self.assertTrue(run_tasks(2.0, lambda: not self.child.upstream.has_remote_subscriber(5000)))
+
+        channels = self.watch_parent()
+        sender.send_message(5000, 6)
+
+        self.assertTrue(run_tasks(2.0, lambda: listener.received[-1:] == [(5000, 6)]))
+        run_tasks(0.1)
+
+        self.assertEqual(channels, [])
+
+    def test_remote_range_crosses(self):
+        listener = self.connect(self.child_port, 6000)
+        remote_listener = self.connect(self.parent_port)
+        remote_listener.register_for_range(6000, 6999)
+        sender = self.connect(self.child_port)
+
+        self.assertTrue(run_tasks(2.0, lambda: self.child.upstream.has_remote_subscriber(6000)))
+
+        sender.send_message(6000, 7)
+        self.assertTrue(run_tasks(2.0, lambda: remote_listener.received == [(6000, 7)]))
+
+class TestRouting(unittest.TestCase):
+
+    def setUp(self):
+        self.port = get_free_port()
+
+        self.director = messagedirector.MessageDirector('127.0.0.1', self.port)
+        self.director.setup()
+        self.addCleanup(self.director.shutdown)
+
+    def connect(self, channel=None):
+        participant = TestParticipant(self.port, channel)
+        participant.setup()
+
+        self.addCleanup(participant.shutdown)
+        return participant
+
+    def test_fan_out_copies_once(self):
+        listeners = [self.connect(1000) for _ in xrange(3)]
+        sender = self.connect()
+
+        self.assertTrue(run_tasks(2.0, lambda: len(self.director.interface.get_subscribers(1000)) == 3))
+
+        message_interface = self.director.message_interface
+        copied_bytes = message_interface.copied_bytes
+        routed_bytes = message_interface.routed_bytes
+
+        sender.send_message(1000, 1)
+        self.assertTrue(run_tasks(2.0, lambda: all(listener.received == [(1000, 1)] for \
+            listener in listeners)))
+
+        # the message is taken from it's datagram once for all three of
+        # the listeners, then framed once into each listener's write...
+        size = (message_interface.routed_bytes - routed_bytes) // len(listeners)
+        self.assertEqual(message_interface.copied_bytes - copied_bytes, size * 4)
+
+    def test_shared_channel_unsubscribe(self):
+        first, second = self.connect(1000), self.connect(1000)
+        sender = self.connect()
+
+        self.assertTrue(run_tasks(2.0, lambda: len(self.director.interface.get_subscribers(1000)) == 2))
+
+        # the channel stays subscribed for everybody else...
+        first.unregister_for_channel(1000)
+        self.assertTrue(run_tasks(2.0, lambda: len(self.director.interface.get_subscribers(1000)) == 1))
+
+        sender.send_message(1000, 1)
+        self.assertTrue(run_tasks(2.0, lambda: second.received == [(1000, 1)]))
+        run_tasks(0.1)
+
+        self.assertEqual(first.received, [])
+
+    def test_refcounted_unsubscribe(self):
+        listener = self.connect(1000)
+        listener.register_for_channel(1000)
+        sender = self.connect()
+
+        self.assertTrue(run_tasks(2.0, lambda: self.director.interface.get_participants(1000).values() == [2]))
+
+        # one of the two subscriptions is still held...
+        listener.unregister_for_channel(1000)
+        self.assertTrue(run_tasks(2.0, lambda: self.director.interface.get_participants(1000).values() == [1]))
+
+        sender.send_message(1000, 1)
+        self.assertTrue(run_tasks(2.0, lambda: listener.received == [(1000, 1)]))
+
+        listener.unregister_for_channel(1000)
+        self.assertTrue(run_tasks(2.0, lambda: not self.director.interface.has_channel(1000)))
+
+        sender.send_message(1000, 2)
+        self.assertTrue(run_tasks(2.0, lambda: self.director.message_interface.has_pending(1000)))
+        self.assertEqual(listener.received, [(1000, 1)])
+
+    def test_channel_and_range_once(self):
+        listener = self.connect(1000)
+        listener.register_for_range(900, 1100)
+        sender = self.connect()
+
+        self.assertTrue(run_tasks(2.0, lambda: self.director.interface.range_index.get(1000)))
+
+        sender.send_message(1000, 1)
+        self.assertTrue(run_tasks(2.0, lambda: listener.received == [(1000, 1)]))
+        run_tasks(0.1)
+
+        self.assertEqual(listener.received, [(1000, 1)])
+
+    def test_range_routing(self):
+        listener = self.connect()
+        listener.register_for_range(5000, 5999)
+        sender = self.connect()
+
+        self.assertTrue(run_tasks(2.0, lambda: self.director.interface.range_index.get(5000)))
+
+        for channel in (4999, 5000, 5999, 6000):
+            sender.send_message(channel, channel)
+
+        self.assertTrue(run_tasks(2.0, lambda: listener.received == [(5000, 5000), (5999, 5999)]))
+        self.assertTrue(run_tasks(2.0, lambda: self.director.message_interface.has_pending(6000)))
+        self.assertTrue(self.director.message_interface.has_pending(4999))
+
+        # nothing is left in the index once the range is gone...
+        listener.unregister_for_range(5000, 5999)
+        self.assertTrue(run_tasks(2.0, lambda: not self.director.interface.range_index.boundaries))
+
+        sender.send_message(5500, 5500)
+        self.assertTrue(run_tasks(2.0, lambda: self.director.message_interface.has_pending(5500)))
+        self.assertEqual(listener.received, [(5000, 5000), (5999, 5999)])
+
+    def test_range_flushes_pending(self):
+        sender = self.connect()
+        sender.send_message(5500, 1)
+
+        self.assertTrue(run_tasks(2.0, lambda: self.director.message_interface.has_pending(5500)))
+
+        listener = self.connect()
+        listener.register_for_range(5000, 5999)
+
+        self.assertTrue(run_tasks(2.0, lambda: listener.received == [(5500, 1)]))
+        self.assertFalse(self.director.message_interface.has_pending(5500))
+
+    def test_multi_channel_delivery(self):
+        first, second = self.connect(1000), self.connect(2000)
+        both = self.connect(1000)
+        both.register_for_channel(2000)
+        sender = self.connect()
+
+        self.assertTrue(run_tasks(2.0, lambda: len(self.director.interface.get_subscribers(1000)) == 2 and
+            len(self.director.interface.get_subscribers(2000)) == 2))
+
+        message_interface = self.director.message_interface
+        routed_count = message_interface.routed_count
+        routed_bytes = message_interface.routed_bytes
+
+        datagram = sender.send_multi_message([1000, 2000, 3000], 1)
+        self.assertTrue(run_tasks(2.0, lambda: first.received and second.received and both.received))
+        run_tasks(0.1)
+
+        self.assertEqual(first.received, [(1000, 1)])
+        self.assertEqual(second.received, [(2000, 1)])
+
+        # the participant on both channels is sent the message once,
+        # it's connector then handles it once for each of it's channels...
+        self.assertEqual(both.received, [(1000, 1), (2000, 1)])
+        self.assertEqual(message_interface.routed_count - routed_count, 1)
+        self.assertEqual(message_interface.routed_bytes - routed_bytes, datagram.get_length() * 3)
+
+        # the channel nobody subscribed to is parked on it's own...
+        self.assertTrue(message_interface.has_pending(3000))
+
+    def test_multi_header_channel_count(self):
+        datagram = io.NetworkDatagram()
+
+        with self.assertRaises(io.NetworkError):
+            datagram.add_multi_header([], 0, TEST_MESSAGE)
+
+        with self.assertRaises(io.NetworkError):
+            datagram.add_multi_header(range(io.MAX_HEADER_CHANNELS + 1), 0, TEST_MESSAGE)
+
+class TestChannelRangeIndex(unittest.TestCase):
+
+    def test_overlapping_ranges(self):
+        index = messagedirector.ChannelRangeIndex()
+        first, second = object(), object()
+
+        index.add(first, 0, 10)
+        index.add(second, 5, 15)
+
+        self.assertEqual(index.get(3), {first: 1})
+        self.assertEqual(index.get(7), {first: 1, second: 1})
+        self.assertEqual(index.get(15), {second: 1})
+        self.assertEqual(index.get(16), {})
+
+        # the segments that no longer differ are merged back together...
+        index.remove(first, 0, 10)
+
+        self.assertEqual(index.get(3), {})
+        self.assertEqual(index.get(7), {second: 1})
+        self.assertEqual(index.boundaries, [5, 16])
+
+        index.remove(second, 5, 15)
+        self.assertEqual(index.boundaries, [])
+
+    def test_nested_ranges_counted(self):
+        index = messagedirector.ChannelRangeIndex()
+        participant = object()
+
+        index.add(participant, 0, 100)
+        index.add(participant, 40, 60)
+        self.assertEqual(index.get(50), {participant: 2})
+
+        index.remove(participant, 40, 60)
+        self.assertEqual(index.get(50), {participant: 1})
+        self.assertEqual(index.boundaries, [0, 101])
+
+class TestPendingMessages(unittest.TestCase):
+    MESSAGE_TIMEOUT = 0.2
+
+    def setUp(self):
+        self.port = get_free_port()
+
+        page = loadPrcFileData('tests-messagedirector', 'messagedirector-message-timeout %f\n'
+            'messagedirector-pending-resolution 0.05' % self.MESSAGE_TIMEOUT)
+
+        try:
+            self.director = messagedirector.MessageDirector('127.0.0.1', self.port)
+        finally:
+            unloadPrcFile(page)
+
+        self.director.setup()
+        self.addCleanup(self.director.shutdown)
+
+        self.message_interface = self.director.message_interface
+
+    def connect(self, channel=None):
+        participant = TestParticipant(self.port, channel)
+        participant.setup()
+
+        self.addCleanup(participant.shutdown)
+        return participant
+
+    def test_flushed_on_set_channel(self):
+        sender = self.connect()
+        sender.send_message(1000, 1)
+        sender.send_message(1000, 2)
+
+        self.assertTrue(run_tasks(2.0, lambda: len(self.message_interface.pending.get(1000, ())) == 2))
+
+        # the parked messages are handed out in the order they were sent...
+        listener = self.connect(1000)
+        self.assertTrue(run_tasks(2.0, lambda: listener.received == [(1000, 1), (1000, 2)]))
+        self.assertFalse(self.message_interface.has_pending(1000))
+
+    def test_limit_drops_oldest(self):
+        self.message_interface.pending_limit = 2
+
+        sender = self.connect()
+
+        for value in xrange(3):
+            sender.send_message(1000, value)
+
+        self.assertTrue(run_tasks(2.0, lambda: self.message_interface.dropped_count == 1))
+
+        listener = self.connect(1000)
+        self.assertTrue(run_tasks(2.0, lambda: listener.received == [(1000, 1), (1000, 2)]))
+
+    def test_expired_by_timer_wheel(self):
+        sender = self.connect()
+        sender.send_message(1000, 1)
+
+        self.assertTrue(run_tasks(2.0, lambda: self.message_interface.has_pending(1000)))
+        self.assertTrue(run_tasks(2.0, lambda: self.message_interface.expired_count == 1))
+        self.assertFalse(self.message_interface.has_pending(1000))
+
+        # nothing is left to hand out once the channel is registered...
+        listener = self.connect(1000)
+        sender.send_message(1000, 2)
+
+        self.assertTrue(run_tasks(2.0, lambda: listener.received == [(1000, 2)]))
+
+class TestTimerWheel(unittest.TestCase):
+
+    def test_advance_returns_passed_slots(self):
+        wheel = messagedirector.MessageTimerWheel(1.0, 0.1)
+        now = time.time()
+
+        wheel.add(1000, now + 0.5)
+        wheel.add(2000, now + 0.9)
+
+        self.assertEqual(wheel.advance(now + 0.2), set())
+        self.assertEqual(wheel.advance(now + 0.6), set([1000]))
+        self.assertEqual(wheel.advance(now + 5.0), set([2000]))
+
+    def test_expired_timer_lands_in_next_slot(self):
+        wheel = messagedirector.MessageTimerWheel(1.0, 0.1)
+        now = time.time()
+
+        wheel.advance(now)
+        wheel.add(1000, now - 10.0)
+
+        self.assertEqual(wheel.advance(now + 0.1), set([1000]))
+
+class TestPostRemoves(unittest.TestCase):
+
+    def setUp(self):
+        self.interface = messagedirector.MessageDirector('127.0.0.1', get_free_port()).interface
+        self.interface.post_remove_limit = 3
+        self.interface.post_remove_max_bytes = 16
+
+    def test_limit_evicts_oldest(self):
+        self.interface.post_remove_max_bytes = 1024
+
+        for index in xrange(5):
+            self.assertTrue(self.interface.add_post_remove(1, 'remove-%d' % index))
+
+        self.assertEqual(self.interface.get_post_removes(1), ['remove-2', 'remove-3', 'remove-4'])
+
+    def test_size_evicts_oldest(self):
+        self.interface.post_remove_limit = 32
+
+        self.assertTrue(self.interface.add_post_remove(1, 'a' * 8))
+        self.assertTrue(self.interface.add_post_remove(1, 'b' * 8))
+        self.assertTrue(self.interface.add_post_remove(1, 'c' * 4))
+
+        self.assertEqual(self.interface.get_post_removes(1), ['b' * 8, 'c' * 4])
+
+    def test_oversized_refused(self):
+        self.assertFalse(self.interface.add_post_remove(1, 'x' * 17))
+        self.assertFalse(self.interface.has_post_remove(1))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,815 @@
+"""
+ * Copyright (C) Caleb Marshall - All Rights Reserved
+ * Written by Caleb Marshall <anythingtechpro@gmail.com>, August 17th, 2017
+ * Licensing information can found in 'LICENSE', which is part of this source code package.
+"""
+
+import os
+import struct
+import shutil
+import tempfile
+import unittest
+
+from tests import ROOT_DIRECTORY, get_free_port, run_tasks
+from panda3d.core import loadPrcFileData, unloadPrcFile
+from panda3d.direct import DCPacker
+from realtime import io, types, stateserver, messagedirector
+from game.OtpDoGlobals import OTP_ZONE_ID_OLD_QUIET_ZONE
+
+AI_CHANNEL = 4000
+OWNER_CHANNEL = 1000000001
+
+_dc_loader = None
+
+def get_dc_loader():
+    global _dc_loader
+
+    if not _dc_loader:
+        _dc_loader = io.NetworkDCLoader()
+        _dc_loader.read_dc_files([os.path.join(ROOT_DIRECTORY, 'config', 'dclass', 'toon.dc')])
+
+    return _dc_loader
+
+class TestStateServer(stateserver.StateServer):
+    """
+    A state server that is never connected, it keeps everything
+    it sends so that the tests can look at it...
+    """
+
+    def __init__(self):
+        stateserver.StateServer.__init__(self, get_dc_loader(), '127.0.0.1', 0, 1001)
+
+        self.sent = []
+
+    def handle_send_connection_datagram(self, datagram):
+        di = io.NetworkDatagramIterator(datagram)
+        channels = [di.get_uint64() for _ in xrange(di.get_uint8())]
+
+        if types.CONTROL_MESSAGE in channels:
+            return
+
+        sender = di.get_uint64()
+        message_type = di.get_uint16()
+        self.sent.append((channels, sender, message_type, di.get_remaining_bytes()))
+
+    def get_sent(self, message_type):
+        return [(channels, sender, data) for channels, sender, sent_type, data in \
+            self.sent if sent_type == message_type]
+
+class StateServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.state_server = TestStateServer()
+        self.state_server.shard_manager.add_shard(AI_CHANNEL, 'test-shard', 0)
+
+    def generate(self, do_id, parent_id, zone_id, dclass_name, required=''):
+        dc_class = get_dc_loader().dclasses_by_name[dclass_name]
+
+        datagram = io.NetworkDatagram()
+        datagram.add_uint32(do_id)
+        datagram.add_uint32(parent_id)
+        datagram.add_uint32(zone_id)
+        datagram.add_uint16(dc_class.get_number())
+        datagram.append_data(required)
+
+        self.state_server.handle_generate(AI_CHANNEL, False, io.NetworkDatagramIterator(datagram))
+        return self.state_server.object_manager.get_state_object(do_id)
+
+    def update_field(self, do_id, dclass_name, field_name, data, sender=AI_CHANNEL):
+        field = get_dc_loader().dclasses_by_name[dclass_name].get_field_by_name(field_name)
+
+        datagram = io.NetworkDatagram()
+        datagram.add_uint32(do_id)
+        datagram.add_uint16(field.get_number())
+        datagram.append_data(data)
+
+        self.state_server.handle_object_update_field(sender, do_id, io.NetworkDatagramIterator(datagram))
+        return field
+
+    def get_updates(self):
+        """
+        Returns (channels, do_id, field_number, field_data) for every field update sent
+        """
+
+        updates = []
+
+        for channels, sender, data in self.state_server.get_sent(types.STATESERVER_OBJECT_UPDATE_FIELD):
+            do_id, field_number = struct.unpack_from('<IH', data)
+            updates.append((channels, do_id, field_number, data[6:]))
+
+        return updates
+
+    def get_generates(self, channel):
+        generates = []
+
+        for message_type in (types.STATESERVER_OBJECT_ENTER_LOCATION_WITH_REQUIRED,
+            types.STATESERVER_OBJECT_ENTER_LOCATION_WITH_REQUIRED_OTHER):
+
+            for channels, sender, data in self.state_server.get_sent(message_type):
+                if channel in channels:
+                    generates.append(struct.unpack_from('<Q', data)[0])
+
+        return sorted(generates)
+
+    def get_deletes(self, channel):
+        deletes = []
+
+        for channels, sender, data in self.state_server.get_sent(types.STATESERVER_OBJECT_DELETE_RAM):
+            if channel in channels:
+                deletes.extend(struct.unpack('<%dQ' % (len(data) / 8), data))
+
+        return sorted(deletes)
+
+class TestUpdateField(StateServerTestCase):
+
+    def test_update_forwards_validated_data(self):
+        self.generate(5000, AI_CHANNEL, 2, 'TimeManager')
+
+        # serverTime(uint8, int16, uint32) followed by bytes that are not part of it...
+        field_data = '\x01' + '\x02\x00' + '\x03\x00\x00\x00'
+        field = self.update_field(5000, 'TimeManager', 'serverTime', field_data + 'junk')
+
+        self.assertEqual(self.get_updates(), [([5000], 5000, field.get_number(), field_data)])
+
+    def test_update_rejects_invalid_data(self):
+        self.generate(5000, AI_CHANNEL, 2, 'TimeManager')
+        self.update_field(5000, 'TimeManager', 'serverTime', '\x01\x02')
+
+        self.assertEqual(self.get_updates(), [])
+
+    def test_broadcast_forwards_validated_data(self):
+        self.generate(5000, AI_CHANNEL, 2, 'DistributedNode')
+        self.generate(5001, AI_CHANNEL, 2, 'DistributedNode').owner_id = OWNER_CHANNEL
+
+        field = self.update_field(5000, 'DistributedNode', 'setX', '\x10\x00junk')
+
+        self.assertEqual(self.get_updates(), [([OWNER_CHANNEL], 5000, field.get_number(), '\x10\x00')])
+
+    def test_coalesced_forwards_validated_data(self):
+        self.state_server._coalesce_fields = set([('DistributedNode', 'setX')])
+
+        state_object = self.generate(5000, AI_CHANNEL, 2, 'DistributedNode')
+        self.generate(5001, AI_CHANNEL, 2, 'DistributedNode').owner_id = OWNER_CHANNEL
+
+        self.update_field(5000, 'DistributedNode', 'setX', '\x10\x00junk')
+        field = self.update_field(5000, 'DistributedNode', 'setX', '\x20\x00junk')
+
+        # only the latest value is sent once the updates are flushed...
+        self.assertEqual(self.get_updates(), [])
+        state_object.handle_flush_coalesced_updates()
+
+        self.assertEqual(self.get_updates(), [([OWNER_CHANNEL], 5000, field.get_number(), '\x20\x00')])
+
+    def test_coalesced_flushed_before_other_update(self):
+        self.state_server._coalesce_fields = set([('DistributedNode', 'setX')])
+
+        state_object = self.generate(5000, AI_CHANNEL, 2, 'DistributedNode')
+        self.generate(5001, AI_CHANNEL, 2, 'DistributedNode').owner_id = OWNER_CHANNEL
+
+        x_field = self.update_field(5000, 'DistributedNode', 'setX', '\x10\x00')
+        y_field = self.update_field(5000, 'DistributedNode', 'setY', '\x20\x00')
+
+        # the held back update is sent ahead of the one that came after it...
+        self.assertEqual(self.get_updates(), [
+            ([OWNER_CHANNEL], 5000, x_field.get_number(), '\x10\x00'),
+            ([OWNER_CHANNEL], 5000, y_field.get_number(), '\x20\x00')])
+
+        self.assertNotIn(5000, self.state_server.coalesced_objects)
+
+        state_object.handle_flush_coalesced_updates()
+        self.assertEqual(len(self.get_updates()), 2)
+
+class TestGenerateCache(StateServerTestCase):
+
+    def setUp(self):
+        StateServerTestCase.setUp(self)
+
+        self.dc_class = get_dc_loader().dclasses_by_name['DistributedToon']
+        self.toon = self.generate(9000, AI_CHANNEL, 2000, 'DistributedToon', self.pack_required())
+
+    def pack_required(self, values={}):
+        """
+        Returns the toon's required fields packed with their defaults,
+        or with the packed data given for any of them by name
+        """
+
+        packer = DCPacker()
+        data = ''
+
+        for field_index in xrange(self.dc_class.get_num_inherited_fields()):
+            field = self.dc_class.get_inherited_field(field_index)
+
+            if field.as_molecular_field() or not field.is_required():
+                continue
+
+            if field.get_name() in values:
+                data += packer.get_string() + values[field.get_name()]
+                packer = DCPacker()
+                continue
+
+            packer.begin_pack(field)
+            packer.pack_default_value()
+            packer.end_pack()
+
+        return data + packer.get_string()
+
+    def send_generate(self):
+        del self.state_server.sent[:]
+        self.toon.handle_send_generate(OWNER_CHANNEL)
+
+        generates = self.state_server.get_sent(types.STATESERVER_OBJECT_ENTER_LOCATION_WITH_REQUIRED)
+        self.assertEqual(len(generates), 1)
+
+        # the required fields follow the do_id, location and dclass...
+        return generates[0][2][22:]
+
+    def test_generate_reuses_packed_fields(self):
+        self.assertEqual(self.send_generate(), self.pack_required())
+
+        pack_count = self.state_server.pack_count
+        packs_avoided = self.state_server.packs_avoided
+
+        self.assertEqual(self.send_generate(), self.pack_required())
+        self.assertEqual(self.state_server.pack_count, pack_count)
+        self.assertEqual(self.state_server.packs_avoided - packs_avoided, self.toon.layout.num_required)
+
+    def test_required_update_invalidates(self):
+        self.send_generate()
+        self.update_field(9000, 'DistributedToon', 'setMoney', '\x37\x00')
+
+        self.assertEqual(self.send_generate(), self.pack_required({'setMoney': '\x37\x00'}))
+
+    def test_other_update_keeps_required(self):
+        self.send_generate()
+        pack_count = self.state_server.pack_count
+
+        self.update_field(9000, 'DistributedToon', 'setX', '\x10\x00')
+
+        self.assertEqual(self.send_generate(), self.pack_required())
+        self.assertEqual(self.state_server.pack_count, pack_count)
+
+class TestInterest(StateServerTestCase):
+    PARENT = 200000000
+    OTHER_PARENT = 300000000
+
+    def setUp(self):
+        StateServerTestCase.setUp(self)
+
+        # our owner's avatar, with an object in each zone around it...
+        self.avatar = self.generate(6000, self.PARENT, 2000, 'DistributedNode')
+        self.avatar.owner_id = OWNER_CHANNEL
+
+        self.generate(6001, self.PARENT, OTP_ZONE_ID_OLD_QUIET_ZONE, 'DistributedNode')
+        self.generate(6002, self.PARENT, 3000, 'DistributedNode')
+        self.generate(6003, self.OTHER_PARENT, 5, 'DistributedNode')
+
+        del self.state_server.sent[:]
+
+    def send_interest(self, message_type, locations, sender=AI_CHANNEL):
+        datagram = io.NetworkDatagram()
+        datagram.add_uint64(OWNER_CHANNEL)
+        datagram.add_uint16(len(locations))
+
+        for parent_id, zone_id in locations:
+            datagram.add_uint32(parent_id)
+            datagram.add_uint32(zone_id)
+
+        self.state_server.handle_datagram(self.state_server.channel, sender, message_type,
+            io.NetworkDatagramIterator(datagram))
+
+    def set_zone(self, state_object, zone_id):
+        datagram = io.NetworkDatagram()
+        datagram.add_uint32(zone_id)
+
+        state_object.handle_set_zone(AI_CHANNEL, io.NetworkDatagramIterator(datagram))
+
+    def test_add_interest(self):
+        self.send_interest(types.STATESERVER_ADD_INTEREST, [(self.PARENT, 3000)])
+
+        self.assertEqual(self.get_generates(OWNER_CHANNEL), [6002])
+        self.assertEqual(self.state_server.object_manager.get_interest(OWNER_CHANNEL),
+            frozenset([(self.PARENT, 3000)]))
+
+    def test_remove_interest(self):
+        self.send_interest(types.STATESERVER_ADD_INTEREST, [(self.PARENT, 3000), (self.OTHER_PARENT, 5)])
+        self.send_interest(types.STATESERVER_REMOVE_INTEREST, [(self.PARENT, 3000)])
+
+        self.assertEqual(self.get_generates(OWNER_CHANNEL), [6002, 6003])
+        self.assertEqual(self.get_deletes(OWNER_CHANNEL), [6002])
+
+    def test_set_interest(self):
+        self.send_interest(types.STATESERVER_SET_INTEREST, [(self.PARENT, 3000)])
+        self.send_interest(types.STATESERVER_SET_INTEREST, [(self.OTHER_PARENT, 5)])
+
+        self.assertEqual(self.get_generates(OWNER_CHANNEL), [6002, 6003])
+        self.assertEqual(self.get_deletes(OWNER_CHANNEL), [6002])
+
+    def test_interest_from_owner(self):
+        self.send_interest(types.STATESERVER_SET_INTEREST, [(self.PARENT, 3000)], sender=OWNER_CHANNEL)
+
+        self.assertEqual(self.get_generates(OWNER_CHANNEL), [6002])
+
+    def test_interest_from_other_sender_dropped(self):
+        # neither another client nor an unknown AI may change our owner's interest...
+        for message_type in (types.STATESERVER_ADD_INTEREST, types.STATESERVER_SET_INTEREST):
+            self.send_interest(message_type, [(self.PARENT, 3000)], sender=OWNER_CHANNEL + 1)
+            self.send_interest(message_type, [(self.PARENT, 3000)], sender=AI_CHANNEL + 1)
+
+        self.send_interest(types.STATESERVER_ADD_INTEREST, [(self.PARENT, 3000)])
+        self.send_interest(types.STATESERVER_REMOVE_INTEREST, [(self.PARENT, 3000)], sender=OWNER_CHANNEL + 1)
+
+        self.assertEqual(self.get_generates(OWNER_CHANNEL), [6002])
+        self.assertEqual(self.get_deletes(OWNER_CHANNEL), [])
+        self.assertEqual(self.state_server.object_manager.get_interest(OWNER_CHANNEL),
+            frozenset([(self.PARENT, 3000)]))
+
+    def test_interest_in_visible_quiet_zone(self):
+        # our avatar is under the parent, so it already sees the parent's quiet zone,
+        # gaining and losing interest in it must not generate or delete anything...
+        self.send_interest(types.STATESERVER_ADD_INTEREST, [(self.PARENT, OTP_ZONE_ID_OLD_QUIET_ZONE)])
+        self.send_interest(types.STATESERVER_REMOVE_INTEREST, [(self.PARENT, OTP_ZONE_ID_OLD_QUIET_ZONE)])
+
+        self.assertEqual(self.get_generates(OWNER_CHANNEL), [])
+        self.assertEqual(self.get_deletes(OWNER_CHANNEL), [])
+
+    def test_interest_in_other_quiet_zone(self):
+        quiet_object = self.generate(6004, self.OTHER_PARENT, OTP_ZONE_ID_OLD_QUIET_ZONE, 'DistributedNode')
+        del self.state_server.sent[:]
+
+        self.send_interest(types.STATESERVER_ADD_INTEREST, [(self.OTHER_PARENT, OTP_ZONE_ID_OLD_QUIET_ZONE)])
+        self.send_interest(types.STATESERVER_REMOVE_INTEREST, [(self.OTHER_PARENT, OTP_ZONE_ID_OLD_QUIET_ZONE)])
+
+        self.assertEqual(self.get_generates(OWNER_CHANNEL), [quiet_object.do_id])
+        self.assertEqual(self.get_deletes(OWNER_CHANNEL), [quiet_object.do_id])
+
+    def test_zone_change_into_interest(self):
+        self.send_interest(types.STATESERVER_ADD_INTEREST, [(self.PARENT, 3000)])
+        del self.state_server.sent[:]
+
+        # the avatar moves into a zone the owner already has interest in...
+        self.set_zone(self.avatar, 3000)
+
+        self.assertEqual(self.get_generates(OWNER_CHANNEL), [])
+        self.assertEqual(self.get_deletes(OWNER_CHANNEL), [])
+
+    def test_zone_change_with_other_object(self):
+        other_avatar = self.generate(6005, self.PARENT, 2000, 'DistributedNode')
+        other_avatar.owner_id = OWNER_CHANNEL
+
+        neighbour = self.generate(6006, self.PARENT, 2000, 'DistributedNode')
+        del self.state_server.sent[:]
+
+        # the owner's other object still sees the zone the avatar left...
+        self.set_zone(self.avatar, 3000)
+
+        self.assertEqual(self.get_generates(OWNER_CHANNEL), [6002])
+        self.assertNotIn(neighbour.do_id, self.get_deletes(OWNER_CHANNEL))
+
+    def test_zone_change_counts(self):
+        self.generate(6007, self.PARENT, 2000, 'DistributedNode')
+        self.generate(6008, self.PARENT, 2000, 'DistributedNode')
+        self.generate(6009, self.PARENT, OTP_ZONE_ID_OLD_QUIET_ZONE, 'DistributedNode')
+        self.generate(6010, self.PARENT, 3000, 'DistributedNode')
+        del self.state_server.sent[:]
+
+        # the quiet zone objects are visible from both zones, so only
+        # the objects of the zones themselves come and go...
+        self.set_zone(self.avatar, 3000)
+
+        self.assertEqual(self.get_deletes(OWNER_CHANNEL), [6007, 6008])
+        self.assertEqual(self.get_generates(OWNER_CHANNEL), [6002, 6010])
+        self.assertEqual(self.state_server.zone_change_count, 1)
+        self.assertEqual(self.state_server.interest_messages_sent, 4)
+        self.assertEqual(self.state_server.interest_messages_avoided, 4)
+
+        # the owner keeps it's interest in the zone the avatar leaves next,
+        # so only the objects of the new zone are generated...
+        self.send_interest(types.STATESERVER_ADD_INTEREST, [(self.PARENT, 3000)])
+        self.generate(6011, self.PARENT, 4000, 'DistributedNode')
+        del self.state_server.sent[:]
+
+        interest_messages_sent = self.state_server.interest_messages_sent
+        interest_messages_avoided = self.state_server.interest_messages_avoided
+        self.set_zone(self.avatar, 4000)
+
+        self.assertEqual(self.get_deletes(OWNER_CHANNEL), [])
+        self.assertEqual(self.get_generates(OWNER_CHANNEL), [6011])
+        self.assertEqual(self.state_server.interest_messages_sent - interest_messages_sent, 1)
+        self.assertEqual(self.state_server.interest_messages_avoided - interest_messages_avoided, 6)
+
+class TestIndexes(StateServerTestCase):
+    PARENT = 200000000
+    OTHER_PARENT = 300000000
+
+    def assert_indexes(self):
+        """
+        Checks the object manager's indexes against the ones built
+        from scratch out of every object it holds
+        """
+
+        object_manager = self.state_server.object_manager
+        locations, location_owners, parents, owner_parents = {}, {}, {}, {}
+
+        for do_id, state_object in object_manager.state_objects.items():
+            locations.setdefault(state_object.location, set()).add(do_id)
+            parents.setdefault(state_object.parent_id, set()).add(do_id)
+
+            if not state_object.owner_id:
+                continue
+
+            owners = location_owners.setdefault(state_object.location, {})
+            owners[state_object.owner_id] = owners.get(state_object.owner_id, 0) + 1
+
+            owner_parent = owner_parents.setdefault(state_object.owner_id, {})
+            owner_parent[state_object.parent_id] = owner_parent.get(state_object.parent_id, 0) + 1
+
+        self.assertEqual(object_manager.locations, locations)
+        self.assertEqual(object_manager.location_owners, location_owners)
+        self.assertEqual(object_manager.parents, parents)
+        self.assertEqual(object_manager._owner_parents, owner_parents)
+
+    def set_zone(self, state_object, zone_id):
+        datagram = io.NetworkDatagram()
+        datagram.add_uint32(zone_id)
+
+        state_object.handle_set_zone(AI_CHANNEL, io.NetworkDatagramIterator(datagram))
+
+    def set_ai(self, state_object, parent_id):
+        datagram = io.NetworkDatagram()
+        datagram.add_uint64(parent_id)
+
+        state_object.handle_set_ai(AI_CHANNEL, io.NetworkDatagramIterator(datagram))
+
+    def delete(self, do_id):
+        datagram = io.NetworkDatagram()
+        datagram.add_uint64(do_id)
+
+        self.state_server.handle_delete_object(AI_CHANNEL, io.NetworkDatagramIterator(datagram))
+
+    def test_indexes_follow_moves_and_deletes(self):
+        avatar = self.generate(8000, self.PARENT, 2000, 'DistributedNode')
+        avatar.owner_id = OWNER_CHANNEL
+        other_avatar = self.generate(8001, self.PARENT, 2000, 'DistributedNode')
+        other_avatar.owner_id = OWNER_CHANNEL
+
+        self.generate(8002, self.PARENT, 2000, 'DistributedNode')
+        self.generate(8003, self.PARENT, 3000, 'DistributedNode')
+        self.assert_indexes()
+
+        self.set_zone(avatar, 3000)
+        self.assert_indexes()
+        self.assertEqual(self.state_server.object_manager.get_location_owners((self.PARENT, 3000)),
+            {OWNER_CHANNEL: 1})
+
+        self.set_ai(avatar, self.OTHER_PARENT)
+        self.assert_indexes()
+
+        other_avatar.owner_id = OWNER_CHANNEL + 1
+        self.assert_indexes()
+
+        self.delete(8002)
+        self.delete(avatar.do_id)
+        self.assert_indexes()
+
+        self.assertEqual(self.state_server.object_manager.get_location_owners((self.OTHER_PARENT, 3000)), {})
+        self.assertEqual(sorted(self.state_server.object_manager.parents), [self.PARENT])
+
+    def test_broadcast_reaches_location_owners(self):
+        avatar = self.generate(8000, self.PARENT, 2000, 'DistributedNode')
+        avatar.owner_id = OWNER_CHANNEL
+        prop = self.generate(8001, self.PARENT, 2000, 'DistributedNode')
+
+        # the prop's updates reach the avatar's owner only while they share a zone...
+        self.set_zone(prop, 3000)
+        self.set_zone(avatar, 3000)
+        del self.state_server.sent[:]
+
+        self.update_field(8001, 'DistributedNode', 'setX', '\x10\x00')
+        self.set_zone(avatar, 4000)
+        self.update_field(8001, 'DistributedNode', 'setX', '\x20\x00')
+
+        self.assertEqual([(channels, data) for channels, do_id, field_number, data in self.get_updates()],
+            [([OWNER_CHANNEL], '\x10\x00')])
+
+class TestShardTeardown(StateServerTestCase):
+    OTHER_PARENT = 300000000
+
+    def setUp(self):
+        StateServerTestCase.setUp(self)
+
+        # the objects of the AI shard, two owners share a zone with it's props...
+        self.generate(9100, AI_CHANNEL, 2000, 'DistributedNode')
+        self.generate(9101, AI_CHANNEL, 2000, 'DistributedNode')
+        self.generate(9102, AI_CHANNEL, 2000, 'DistributedNode').owner_id = OWNER_CHANNEL
+        self.generate(9103, AI_CHANNEL, 2000, 'DistributedNode').owner_id = OWNER_CHANNEL + 1
+        self.generate(9104, AI_CHANNEL, 3000, 'DistributedNode')
+
+        self.survivor = self.generate(9105, self.OTHER_PARENT, 2000, 'DistributedNode')
+        self.survivor.owner_id = OWNER_CHANNEL + 2
+
+        del self.state_server.sent[:]
+
+    def test_deletes_grouped_by_owner(self):
+        self.state_server.handle_remove_shard(AI_CHANNEL)
+
+        # the props go to both owners in one datagram, each owned
+        # object goes to the other owner but never to it's own...
+        self.assertEqual(len(self.state_server.get_sent(types.STATESERVER_OBJECT_DELETE_RAM)), 3)
+        self.assertEqual(self.get_deletes(OWNER_CHANNEL), [9100, 9101, 9103])
+        self.assertEqual(self.get_deletes(OWNER_CHANNEL + 1), [9100, 9101, 9102])
+        self.assertEqual(self.get_deletes(OWNER_CHANNEL + 2), [])
+
+        object_manager = self.state_server.object_manager
+        self.assertEqual(object_manager.state_objects.keys(), [9105])
+        self.assertEqual(object_manager.locations, {self.survivor.location: set([9105])})
+        self.assertEqual(object_manager.location_owners, {self.survivor.location: {OWNER_CHANNEL + 2: 1}})
+        self.assertEqual(object_manager.parents, {self.OTHER_PARENT: set([9105])})
+        self.assertFalse(self.state_server.shard_manager.has_shard(AI_CHANNEL))
+
+    def test_deletes_batched(self):
+        self.state_server._delete_batch_size = 1
+        self.state_server.handle_remove_shard(AI_CHANNEL)
+
+        self.assertEqual(len(self.state_server.get_sent(types.STATESERVER_OBJECT_DELETE_RAM)), 4)
+        self.assertEqual(self.get_deletes(OWNER_CHANNEL), [9100, 9101, 9103])
+
+class TestSnapshot(StateServerTestCase):
+
+    def setUp(self):
+        StateServerTestCase.setUp(self)
+
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.filename = os.path.join(self.directory, 'stateserver.snapshot')
+
+    def test_restore_round_trip(self):
+        state_object = self.generate(7000, AI_CHANNEL, 2000, 'DistributedNode')
+        state_object.owner_id = OWNER_CHANNEL
+        field = self.update_field(7000, 'DistributedNode', 'setX', '\x10\x00')
+
+        stateserver.StateServerSnapshot(self.state_server, self.filename, 1).write_all()
+
+        restored_server = TestStateServer()
+        self.assertEqual(stateserver.StateServerSnapshot(restored_server, self.filename, 1).restore(), 1)
+        self.assertTrue(restored_server.shard_manager.has_shard(AI_CHANNEL))
+
+        restored_object = restored_server.object_manager.get_state_object(7000)
+        self.assertEqual(restored_object.location, (AI_CHANNEL, 2000))
+        self.assertEqual(restored_object.owner_id, OWNER_CHANNEL)
+        self.assertEqual(restored_object.get_field_data(field.get_number()), '\x10\x00')
+
+    def test_restore_interests(self):
+        self.state_server.object_manager.set_interest(OWNER_CHANNEL, [(AI_CHANNEL, 2000), (AI_CHANNEL, 3000)])
+        stateserver.StateServerSnapshot(self.state_server, self.filename, 1).write_all()
+
+        restored_server = TestStateServer()
+        stateserver.StateServerSnapshot(restored_server, self.filename, 1).restore()
+
+        self.assertEqual(restored_server.object_manager.get_interest(OWNER_CHANNEL),
+            frozenset([(AI_CHANNEL, 2000), (AI_CHANNEL, 3000)]))
+
+        self.assertEqual(restored_server.object_manager.get_location_interests((AI_CHANNEL, 3000)),
+            set([OWNER_CHANNEL]))
+
+    def test_restore_truncated(self):
+        self.generate(7000, AI_CHANNEL, 2000, 'DistributedNode')
+        self.generate(7001, AI_CHANNEL, 2000, 'DistributedNode')
+
+        stateserver.StateServerSnapshot(self.state_server, self.filename, 1).write_all()
+
+        # cut the last object short, as a crash partway through a write would...
+        with open(self.filename, 'rb') as snapshot_file:
+            data = snapshot_file.read()
+
+        with open(self.filename, 'wb') as snapshot_file:
+            snapshot_file.write(data[:-3])
+
+        restored_server = TestStateServer()
+        self.assertEqual(stateserver.StateServerSnapshot(restored_server, self.filename, 1).restore(), 1)
+        self.assertEqual(len(restored_server.object_manager.state_objects), 1)
+
+    def test_restore_owner_published_once(self):
+        self.generate(7000, AI_CHANNEL, 2000, 'DistributedNode').owner_id = OWNER_CHANNEL
+        stateserver.StateServerSnapshot(self.state_server, self.filename, 1).write_all()
+
+        restored_server = TestStateServer()
+        restored_server._shard_count = 2
+        stateserver.StateServerSnapshot(restored_server, self.filename, 1).restore()
+
+        self.assertEqual(len(restored_server.get_sent(types.STATESERVER_SHARD_OBJECT_LOCATION)), 1)
+        self.assertEqual(restored_server.object_manager.get_state_object(7000).owner_id, OWNER_CHANNEL)
+
+    def test_write_spread_across_ticks(self):
+        for do_id in xrange(7000, 7010):
+            self.generate(do_id, AI_CHANNEL, 2000, 'DistributedNode')
+
+        snapshot = stateserver.StateServerSnapshot(self.state_server, self.filename, 4)
+        self.assertTrue(snapshot.start())
+
+        writes = 1
+
+        while not snapshot.write():
+            writes += 1
+
+        snapshot.join()
+
+        self.assertEqual(writes, 3)
+        self.assertFalse(snapshot.active)
+        self.assertEqual(stateserver.StateServerSnapshot(TestStateServer(), self.filename, 4).restore(), 10)
+
+class ShardParticipant(io.NetworkConnector):
+
+    def __init__(self, port, channel):
+        io.NetworkConnector.__init__(self, None, '127.0.0.1', port, channel)
+
+        self.received = []
+
+    def send_message(self, channel, message_type, datagram):
+        message = io.NetworkDatagram()
+        message.add_header(channel, self.channel, message_type)
+        message.append_data(datagram.get_message())
+        self.handle_send_connection_datagram(message)
+
+    def handle_datagram(self, channel, sender, message_type, di):
+        self.received.append((message_type, di.get_remaining_bytes()))
+
+class TestShards(unittest.TestCase):
+    SHARD_COUNT = 2
+    PARENT = 200000000
+
+    def setUp(self):
+        port = get_free_port()
+
+        self.message_director = messagedirector.MessageDirector('127.0.0.1', port)
+        self.message_director.setup()
+        self.addCleanup(self.message_director.shutdown)
+
+        self.shards = []
+
+        for shard_index in xrange(self.SHARD_COUNT):
+            page = loadPrcFileData('tests-shard', 'stateserver-shards %d\nstateserver-shard-index %d' % (
+                self.SHARD_COUNT, shard_index))
+
+            try:
+                shard = stateserver.StateServer(get_dc_loader(), '127.0.0.1', port,
+                    types.STATESERVER_CHANNEL)
+            finally:
+                unloadPrcFile(page)
+
+            shard.setup()
+            self.addCleanup(shard.shutdown)
+            self.shards.append(shard)
+
+        self.ai = ShardParticipant(port, AI_CHANNEL)
+        self.ai.setup()
+        self.addCleanup(self.ai.shutdown)
+
+        self.owner = ShardParticipant(port, OWNER_CHANNEL)
+        self.owner.setup()
+        self.addCleanup(self.owner.shutdown)
+
+        datagram = io.NetworkDatagram()
+        datagram.add_string('test-shard')
+        datagram.add_uint32(0)
+        self.ai.send_message(types.STATESERVER_CHANNEL, types.STATESERVER_ADD_SHARD, datagram)
+
+        self.assertTrue(run_tasks(2.0, lambda: all(shard.shard_manager.has_shard(AI_CHANNEL) for \
+            shard in self.shards)))
+
+    def generate(self, do_id, zone_id):
+        dc_class = get_dc_loader().dclasses_by_name['DistributedNode']
+
+        datagram = io.NetworkDatagram()
+        datagram.add_uint32(do_id)
+        datagram.add_uint32(self.PARENT)
+        datagram.add_uint32(zone_id)
+        datagram.add_uint16(dc_class.get_number())
+        self.ai.send_message(types.STATESERVER_CHANNEL, types.STATESERVER_OBJECT_GENERATE_WITH_REQUIRED,
+            datagram)
+
+    def test_generate_splits_objects(self):
+        for do_id in xrange(10, 14):
+            self.generate(do_id, 2000)
+
+        self.assertTrue(run_tasks(2.0, lambda: sum(len(shard.object_manager.state_objects) for \
+            shard in self.shards) == 4))
+
+        for shard_index, shard in enumerate(self.shards):
+            self.assertEqual(sorted(shard.object_manager.state_objects),
+                [do_id for do_id in xrange(10, 14) if do_id % self.SHARD_COUNT == shard_index])
+
+    def test_broadcast_reaches_owner_on_other_shard(self):
+        self.generate(10, 2000)
+        self.generate(11, 2000)
+
+        self.assertTrue(run_tasks(2.0, lambda: self.shards[0].object_manager.has_state_object(10) and \
+            self.shards[1].object_manager.has_state_object(11)))
+
+        # the owner's object lives on the first shard...
+        datagram = io.NetworkDatagram()
+        datagram.add_uint64(OWNER_CHANNEL)
+        self.ai.send_message(10, types.STATESERVER_OBJECT_SET_OWNER, datagram)
+
+        self.assertTrue(run_tasks(2.0, lambda: self.shards[1].object_manager.get_remote_object(10) and \
+            self.shards[1].object_manager.get_remote_object(10).owner_id == OWNER_CHANNEL))
+
+        # and the object broadcasting lives on the second...
+        field = get_dc_loader().dclasses_by_name['DistributedNode'].get_field_by_name('setX')
+
+        datagram = io.NetworkDatagram()
+        datagram.add_uint32(11)
+        datagram.add_uint16(field.get_number())
+        datagram.add_int16(16)
+        self.ai.send_message(11, types.STATESERVER_OBJECT_UPDATE_FIELD, datagram)
+
+        update = (types.STATESERVER_OBJECT_UPDATE_FIELD, struct.pack('<IHh', 11, field.get_number(), 16))
+        self.assertTrue(run_tasks(2.0, lambda: update in self.owner.received))
+
+    def set_owner(self, do_id):
+        datagram = io.NetworkDatagram()
+        datagram.add_uint64(OWNER_CHANNEL)
+        self.ai.send_message(do_id, types.STATESERVER_OBJECT_SET_OWNER, datagram)
+
+    def set_zone(self, do_id, zone_id):
+        datagram = io.NetworkDatagram()
+        datagram.add_uint32(zone_id)
+        self.ai.send_message(do_id, types.STATESERVER_OBJECT_SET_ZONE, datagram)
+
+    def get_received_index(self, message_type, data):
+        for index, received in enumerate(self.owner.received):
+            if received == (message_type, data):
+                return index
+
+        return None
+
+    def test_records_only_shared_locations(self):
+        self.generate(10, 2000)
+        self.generate(11, 3000)
+
+        self.assertTrue(run_tasks(2.0, lambda: self.shards[0].object_manager.has_state_object(10) and \
+            self.shards[1].object_manager.has_state_object(11)))
+
+        self.set_owner(10)
+        self.assertTrue(run_tasks(2.0, lambda: self.shards[0].object_manager.get_state_object(
+            10).owner_id == OWNER_CHANNEL))
+
+        # the second shard has nothing in the owner's zone...
+        run_tasks(0.1)
+        self.assertIsNone(self.shards[1].object_manager.get_remote_object(10))
+
+        # until one of it's objects moves there, and it asks the first shard...
+        self.set_zone(11, 2000)
+        self.assertTrue(run_tasks(2.0, lambda: self.shards[1].object_manager.get_remote_object(10) and \
+            self.shards[1].object_manager.get_remote_object(10).owner_id == OWNER_CHANNEL))
+
+        self.set_zone(11, 3000)
+        self.assertTrue(run_tasks(2.0, lambda: not self.shards[1].object_manager.get_remote_object(10)))
+
+    def test_generate_reaches_owner_on_other_shard(self):
+        self.generate(10, 2000)
+        self.assertTrue(run_tasks(2.0, lambda: self.shards[0].object_manager.has_state_object(10)))
+
+        self.set_owner(10)
+        self.assertTrue(run_tasks(2.0, lambda: self.shards[0].object_manager.get_state_object(
+            10).owner_id == OWNER_CHANNEL))
+
+        # the second shard has never heard of the owner before...
+        self.generate(11, 2000)
+        self.assertTrue(run_tasks(2.0, lambda: any(message_type == \
+            types.STATESERVER_OBJECT_ENTER_LOCATION_WITH_REQUIRED and data.startswith(struct.pack('<Q', 11)) \
+                for message_type, data in self.owner.received)))
+
+        self.assertFalse(self.shards[1].held_objects)
+
+    def test_set_zone_resp_after_other_shards(self):
+        self.generate(10, 2000)
+        self.generate(11, 2000)
+        self.generate(13, 3000)
+
+        self.assertTrue(run_tasks(2.0, lambda: self.shards[0].object_manager.has_state_object(10) and \
+            len(self.shards[1].object_manager.state_objects) == 2))
+
+        self.set_owner(10)
+        self.assertTrue(run_tasks(2.0, lambda: self.shards[1].object_manager.get_remote_object(10)))
+
+        self.set_zone(10, 3000)
+
+        response = (types.STATESERVER_OBJECT_SET_ZONE_RESP, struct.pack('<II', 2000, 3000))
+        self.assertTrue(run_tasks(2.0, lambda: response in self.owner.received))
+
+        # the object left behind on the other shard is deleted before the response,
+        # and the one in the new zone is generated after it as it would be locally...
+        delete = (types.STATESERVER_OBJECT_DELETE_RAM, struct.pack('<Q', 11))
+        self.assertTrue(run_tasks(2.0, lambda: any(message_type == \
+            types.STATESERVER_OBJECT_ENTER_LOCATION_WITH_REQUIRED and data.startswith(struct.pack('<Q', 13)) \
+                for message_type, data in self.owner.received)))
+
+        generate_index = [index for index, (message_type, data) in enumerate(self.owner.received) if \
+            message_type == types.STATESERVER_OBJECT_ENTER_LOCATION_WITH_REQUIRED][-1]
+
+        self.assertLess(self.get_received_index(*delete), self.get_received_index(*response))
+        self.assertLess(self.get_received_index(*response), generate_index)
+        self.assertFalse(self.shards[0].shard_requests)
+
+if __name__ == '__main__':
+    unittest.main()
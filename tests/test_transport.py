@@ -0,0 +1,168 @@
+"""
+ * Copyright (C) Caleb Marshall - All Rights Reserved
+ * Written by Caleb Marshall <anythingtechpro@gmail.com>, August 17th, 2017
+ * Licensing information can found in 'LICENSE', which is part of this source code package.
+"""
+
+import time
+import struct
+import threading
+import unittest
+
+from tests import get_free_port
+from realtime import io, transport
+
+class TestTransport(unittest.TestCase):
+
+    def connect(self, name, capped=True):
+        server = transport.create_transport(name)
+        client = transport.create_transport(name, capped)
+
+        port = get_free_port()
+        rendezvous = server.open_server('127.0.0.1', port, 10)
+        connection = client.open_client('127.0.0.1', port, 5000)
+        client.add_connection(connection)
+
+        accepted = None
+        deadline = time.time() + 5.0
+
+        while accepted is None and time.time() < deadline:
+            transport.get_select_poller().poll(0)
+
+            if server.new_connection_available():
+                accepted = server.get_new_connection()
+
+        self.assertIsNotNone(accepted)
+        server.add_connection(accepted[2])
+
+        self.addCleanup(server.close_server, rendezvous)
+        self.addCleanup(client.close_connection, connection)
+
+        return server, client, connection
+
+    def receive(self, server, count):
+        received = []
+        deadline = time.time() + 10.0
+
+        while len(received) < count and time.time() < deadline:
+            transport.get_select_poller().poll(0.001)
+
+            while server.data_available():
+                datagram = io.NetworkDatagram()
+
+                if server.get_data(datagram) is None:
+                    break
+
+                received.append(datagram.get_message())
+
+        return received
+
+    def check_concurrent_send(self, name):
+        server, client, connection = self.connect(name)
+
+        thread_count = 4
+        send_count = 2000
+        done = threading.Event()
+
+        def send(index):
+            for sequence in xrange(send_count):
+                datagram = io.NetworkDatagram()
+                datagram.add_uint8(index)
+                datagram.add_uint32(sequence)
+                client.send(datagram, connection)
+
+        def flush():
+            while not done.is_set():
+                client.flush()
+
+        flusher = threading.Thread(target=flush)
+        flusher.start()
+
+        senders = [threading.Thread(target=send, args=(index,)) for index in xrange(thread_count)]
+
+        for sender in senders:
+            sender.start()
+
+        for sender in senders:
+            sender.join()
+
+        done.set()
+        flusher.join()
+        client.flush()
+
+        received = self.receive(server, thread_count * send_count)
+        self.assertEqual(len(received), thread_count * send_count)
+
+        # every sender's datagrams must arrive exactly once and in order...
+        sequences = {}
+
+        for message in received:
+            index, sequence = struct.unpack('<BI', message)
+            sequences.setdefault(index, []).append(sequence)
+
+        for index in xrange(thread_count):
+            self.assertEqual(sequences[index], range(send_count))
+
+        self.assertEqual(client.get_outbound(connection).dropped_count, 0)
+
+    def test_concurrent_send_select(self):
+        self.check_concurrent_send('select')
+
+    def test_concurrent_send_panda(self):
+        self.check_concurrent_send('panda')
+
+    def send_past_cap(self, name, capped):
+        server, client, connection = self.connect(name, capped)
+        client._max_messages = 16
+
+        for sequence in xrange(64):
+            datagram = io.NetworkDatagram()
+            datagram.add_uint32(sequence)
+            self.assertTrue(client.send(datagram, connection))
+
+        client.flush()
+        return server, client, connection
+
+    def test_uncapped_never_drops(self):
+        for name in sorted(transport.TRANSPORTS):
+            server, client, connection = self.send_past_cap(name, False)
+
+            received = self.receive(server, 64)
+            self.assertEqual([struct.unpack('<I', message)[0] for message in received], range(64))
+            self.assertEqual(client.get_outbound(connection).dropped_count, 0)
+
+            events = []
+
+            while client.pressure_event_available():
+                events.append(client.get_pressure_event()[1])
+
+            self.assertNotIn(transport.PRESSURE_OVERFLOWED, events)
+
+    def test_capped_overflow_evicts(self):
+        server, client, connection = self.send_past_cap('select', True)
+
+        outbound = client.get_outbound(connection)
+        self.assertTrue(outbound.overflowed)
+        self.assertEqual(outbound.dropped_count, 48)
+
+        events = []
+
+        while client.pressure_event_available():
+            events.append(client.get_pressure_event()[1])
+
+        self.assertEqual(events.count(transport.PRESSURE_OVERFLOWED), 1)
+
+        # clearing the outbound lets the disconnect reason through...
+        client.clear_outbound(connection)
+        self.assertFalse(outbound.overflowed)
+
+        datagram = io.NetworkDatagram()
+        datagram.add_uint32(64)
+        client.send(datagram, connection)
+        client.flush()
+
+        received = self.receive(server, 17)
+        self.assertEqual(struct.unpack('<I', received[-1])[0], 64)
+
+if __name__ == '__main__':
+    unittest.main()